@@ -0,0 +1,86 @@
+"""
+Micro benchmark for the accel/mag attitude model
+
+Compares the per sample cost of ComplementaryFilter._accel_mag_model against the old SciPy
+Rotation round trip and checks both give the same quaternion (up to sign).
+
+Run from the repository root:
+    python -m benchmarks.accel_mag_model [--session DIR | --capture FILE]
+"""
+
+import argparse
+import timeit
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+from components.complementary_filter import ComplementaryFilter
+
+
+# Previous implementation, kept here as the reference
+def scipy_accel_mag_model(accel_data : np.ndarray, mag_data : np.ndarray) -> np.ndarray:
+    accel_unit = accel_data / np.linalg.norm(accel_data)
+    mag_unit = mag_data / np.linalg.norm(mag_data)
+    y = np.cross(-accel_unit, mag_unit)
+    y = y / np.linalg.norm(y)
+    x = np.cross(y, -accel_unit)
+    x = x / np.linalg.norm(x)
+    z = -accel_unit
+    items = R.from_matrix([[x[0], y[0], z[0]],
+                            [x[1], y[1], z[1]],
+                            [x[2], y[2], z[2]]]).as_quat()
+    return np.array([items[3], items[0], items[1], items[2]])
+
+# (accel, mag) arrays from a session, a raw capture or random data
+def load_samples(session : str = None, capture : str = None, n : int = 10000) -> tuple:
+    if session is not None:
+        from components.session import SessionReader
+        filtered = np.asarray(SessionReader(session)['filtered'])
+        return filtered[:, 0:3], filtered[:, 6:9]
+
+    if capture is not None:
+        from components.replay import load_capture
+        import components.ICM20948 as ICM
+        _, _, data = load_capture(capture)
+        samples = ICM.ICM20948(start_char='&').parse_batch(data.decode(errors='ignore').splitlines())
+        return samples[:, 0:3], samples[:, 6:9]
+
+    rng = np.random.default_rng(0)
+    accel = rng.normal(scale=50, size=(n, 3)) + np.array([0, 0, 1000])
+    mag = rng.normal(scale=5, size=(n, 3)) + np.array([20, 0, 40])
+    return accel, mag
+
+def run(accel : np.ndarray, mag : np.ndarray, repeat : int = 5) -> dict:
+    estimator = ComplementaryFilter(alpha=0.5, time_step=0.005)
+    n = len(accel)
+
+    # Same quaternion up to sign on every sample
+    reference = np.array([scipy_accel_mag_model(a, b) for a, b in zip(accel, mag)])
+    current = np.array([estimator._accel_mag_model(a, b) for a, b in zip(accel, mag)])
+    batch = estimator._accel_mag_model_batch(accel, mag)
+    max_error = float(max(np.max(1 - np.abs(np.sum(reference * current, axis=1))),
+                          np.max(1 - np.abs(np.sum(reference * batch, axis=1)))))
+
+    def per_sample(fn) -> float:
+        return min(timeit.repeat(lambda: [fn(a, b) for a, b in zip(accel, mag)], number=1, repeat=repeat)) / n
+
+    return {
+        'samples' : n,
+        'scipy_us_per_sample' : per_sample(scipy_accel_mag_model) * 1e6,
+        'triad_us_per_sample' : per_sample(estimator._accel_mag_model) * 1e6,
+        'batch_us_per_sample' : min(timeit.repeat(lambda: estimator._accel_mag_model_batch(accel, mag), number=1, repeat=repeat)) / n * 1e6,
+        'max_quaternion_error' : max_error,
+    }
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--session', help='session directory with recorded samples')
+    arg_parser.add_argument('--capture', help='raw serial capture file')
+    args = arg_parser.parse_args()
+
+    results = run(*load_samples(session=args.session, capture=args.capture))
+    for key, value in results.items():
+        print(f"{key:>24} : {value:.6g}")
+
+    if results['max_quaternion_error'] > 1e-9:
+        raise SystemExit("accel/mag model does not match the reference implementation")
@@ -0,0 +1,331 @@
+"""
+Benchmark suite for the processing pipeline, CPU only
+
+Micro benchmarks time the per sample building blocks (parsing, low pass filter, estimator, quaternion
+math, plotter hand off) and the end to end runs push recorded or simulated data through
+Parser -> RCFilter -> ComplementaryFilter, one sample at a time, in batches and as a staged pipeline.
+Startup is the time from opening a port until the first valid sample. Cold start runs a headless
+decode, low pass and estimate job in a fresh interpreter and fails if it loads Qt, pyqtgraph or SciPy.
+
+Results are written as JSON. Metric names end in their unit: *_us is time per sample or call (lower
+is better) and *_per_s is throughput (higher is better). Given a baseline file, every metric that got
+worse by more than the tolerance is reported and the run exits with an error.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks [--capture FILE] [--output results.json]
+                                        [--baseline baseline.json] [--tolerance 0.25]
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+
+import components.ICM20948 as ICM
+import components.lowpass_filter as flt
+from components.complementary_filter import ComplementaryFilter
+from components.parser import Parser
+from components.pipeline import Pipeline, SerialReader, Decoder, LowPass, Estimate
+from components.rotation import RotationMatrix
+from components.shm_transport import SharedRing
+from components.simulator import ImuSimulator, SimulatedSerial, Tumble, format_ascii
+
+SAMPLE_RATE = 1000
+
+# Modules a headless job must not load, only the plotters' render processes need them
+HEAVY_MODULES = ('PyQt5', 'pyqtgraph', 'scipy')
+
+# Decode, low pass and estimate the ASCII samples given on stdin with the pipeline stages every
+# headless logger runs. The plotter modules are imported too, scripts import them at the top
+# whether they plot or not
+_COLD_START_JOB = """
+import json, sys, time
+data = sys.stdin.buffer.read()
+start = time.perf_counter()
+import components.ICM20948 as ICM
+import components.lowpass_filter as flt
+from components.complementary_filter import ComplementaryFilter
+from components.parser import Parser
+from components.pipeline import Pipeline, Decoder, LowPass, Estimate
+from components.multi_device import MultiDeviceManager
+from components.session import SessionWriter
+from components.dashboard import Dashboard
+from components.plotter2D import Plotter2D
+from components.plotter3D import Plotter3D
+from components.scatter_plotter3D import ScatterPlotter3D
+imported = time.perf_counter()
+
+batch = Decoder(ICM.ICM20948(start_char='&'), sample_time=0.001)({'data' : data, 'time' : time.time()})
+batch = LowPass(flt.RCFilter(cutoff=5, sample_time=0.001))(batch)
+batch = Estimate(ComplementaryFilter(alpha=0.5, time_step=0.001), dt=0.001, adjust_mag=ICM.adjust_mag)(batch)
+done = time.perf_counter()
+print(json.dumps({'import' : imported - start, 'first_batch' : done - imported, 'samples' : len(batch['quaternion']),
+                'heavy' : sorted(set(name.split('.')[0] for name in sys.modules) & set(%r))}))
+""" % (HEAVY_MODULES,)
+
+
+# Best time per call in microseconds over a few repeats of number calls
+def _per_call_us(fn, number : int, repeat : int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) / number * 1e6
+
+def _higher_is_better(name : str) -> bool:
+    return name.endswith('_per_s')
+
+# (N, 9) simulated samples with the hard iron offset the pipeline removes
+def synthetic_samples(n : int) -> np.ndarray:
+    simulator = ImuSimulator(Tumble(seed=0), rate=SAMPLE_RATE, hard_iron=ICM.MAG_SOFT_IRON_ADJUSTMENT,
+                            accel_noise=5, gyro_noise=0.05, mag_noise=0.3, seed=0)
+    return simulator.generate(n)[0]
+
+
+def micro_benchmarks(samples : np.ndarray, repeat : int) -> dict:
+    n = len(samples)
+    lines = format_ascii(samples).decode('ascii').splitlines()
+    accel = samples[:, 0:3]
+    gyro = samples[:, 3:6]
+    mag = ICM.adjust_mag(samples[:, 6:9])
+    results = dict()
+
+    imu = ICM.ICM20948(start_char='&')
+    results['parse_data_us'] = _per_call_us(lambda: [imu.parse_data(line) for line in lines], n, repeat)
+    results['parse_batch_us'] = _per_call_us(lambda: imu.parse_batch(lines), n, repeat)
+
+    def filter_samples():
+        rc = flt.RCFilter(cutoff=5, sample_time=1/SAMPLE_RATE)
+        for sample in samples:
+            rc.filter(sample)
+    results['rc_filter_us'] = _per_call_us(filter_samples, n, repeat)
+    results['rc_filter_chunk_us'] = _per_call_us(lambda: flt.RCFilter(cutoff=5, sample_time=1/SAMPLE_RATE).filter_chunk(samples),
+                                                n, repeat)
+
+    def estimate_samples():
+        estimator = ComplementaryFilter(alpha=0.5, time_step=1/SAMPLE_RATE)
+        for i in range(n):
+            estimator.estimate(accel_data=accel[i], mag_data=mag[i], gyro_data=gyro[i], dt=1/SAMPLE_RATE)
+    results['estimate_us'] = _per_call_us(estimate_samples, n, repeat)
+    results['estimate_batch_us'] = _per_call_us(
+        lambda: ComplementaryFilter(alpha=0.5, time_step=1/SAMPLE_RATE).estimate_batch(accel, mag, gyro, dt=1/SAMPLE_RATE), n, repeat)
+
+    # Quaternion math on the attitudes of the batch estimator
+    quats = ComplementaryFilter(alpha=0.5, time_step=1/SAMPLE_RATE).estimate_batch(accel, mag, gyro, dt=1/SAMPLE_RATE)
+    pairs = list(zip(quats[:-1], quats[1:]))
+    results['quat_multiply_us'] = _per_call_us(lambda: [RotationMatrix.quat_multiply(a, b) for a, b in pairs], len(pairs), repeat)
+    results['quat_interpolate_us'] = _per_call_us(lambda: [RotationMatrix.quat_interpolate(a, b, 0.5) for a, b in pairs],
+                                                len(pairs), repeat)
+
+    # Plotter hand off, one record per sample into shared memory and one read per frame
+    ring = SharedRing(width=9, capacity=1 << 16)
+    rows = [sample.reshape(1, 9) for sample in samples]
+    try:
+        def hand_off():
+            for i, row in enumerate(rows):
+                ring.write(row)
+                if i % 40 == 39:
+                    ring.read_all()
+            ring.read_all()
+        results['plot_hand_off_us'] = _per_call_us(hand_off, n, repeat)
+    finally:
+        ring.close()
+
+    return results
+
+
+"""
+Whole pipeline on a serial style source. capture replays a recorded file as fast as possible,
+otherwise the simulator streams samples
+"""
+def _source(capture : str, n : int, chunk_samples : int):
+    if capture is not None:
+        from components.replay import ReplaySerial
+        return ReplaySerial(capture, speed=0)
+    simulator = ImuSimulator(Tumble(seed=0), rate=SAMPLE_RATE, hard_iron=ICM.MAG_SOFT_IRON_ADJUSTMENT,
+                            accel_noise=5, gyro_noise=0.05, mag_noise=0.3, seed=0)
+    return SimulatedSerial(simulator, speed=0, duration=n/SAMPLE_RATE, chunk_samples=chunk_samples)
+
+def end_to_end(capture : str, n : int) -> dict:
+    from components.replay import EndOfCapture
+    results = dict()
+
+    # One sample at a time, like model_example.py
+    parser = Parser(dev_name="benchmark", imu=ICM.ICM20948(start_char='&'), port="benchmark", baud=0,
+                    ser=_source(capture, n, chunk_samples=1))
+    rc = flt.RCFilter(cutoff=5, sample_time=1/SAMPLE_RATE)
+    estimator = ComplementaryFilter(alpha=0.5, time_step=1/SAMPLE_RATE)
+    latencies = []
+    start = time.perf_counter()
+    try:
+        while True:
+            begin = time.perf_counter()
+            new_data = parser.run()
+            if new_data is None:
+                continue
+            filtered_vals = ICM.ICMRawData.create_from_vector(rc.filter(new_data.convert_to_vector()))
+            estimator.estimate(accel_data=filtered_vals.get_raw_accel(), mag_data=filtered_vals.get_adjusted_mag(),
+                                gyro_data=filtered_vals.get_raw_gyro(), dt=1/SAMPLE_RATE)
+            latencies.append(time.perf_counter() - begin)
+    except EndOfCapture:
+        pass
+    elapsed = time.perf_counter() - start
+    parser.cleanup()
+
+    latencies = np.array(latencies) * 1e6
+    results['e2e_samples_per_s'] = len(latencies) / elapsed
+    results['e2e_latency_p50_us'] = float(np.percentile(latencies, 50))
+    results['e2e_latency_p99_us'] = float(np.percentile(latencies, 99))
+
+    # Reader thread and batches, like simulate.py
+    rc = flt.RCFilter(cutoff=5, sample_time=1/SAMPLE_RATE)
+    estimator = ComplementaryFilter(alpha=0.5, time_step=1/SAMPLE_RATE)
+    start = time.perf_counter()
+    parser = Parser(dev_name="benchmark", imu=ICM.ICM20948(start_char='&'), port="benchmark", baud=0, threaded=True,
+                    buffer_size=1 << 16, ser=_source(capture, n, chunk_samples=64))
+    count = 0
+    try:
+        while True:
+            finished = parser.reader_error is not None
+            samples = parser.drain()
+            if len(samples) == 0:
+                if finished:
+                    break
+                time.sleep(0.0005)
+                continue
+            filtered = rc.filter_chunk(samples)
+            estimator.estimate_batch(accel_data=filtered[:, 0:3], mag_data=ICM.adjust_mag(filtered[:, 6:9]),
+                                    gyro_data=filtered[:, 3:6], dt=1/SAMPLE_RATE)
+            count += len(samples)
+    finally:
+        parser.cleanup()
+    results['e2e_batch_samples_per_s'] = count / (time.perf_counter() - start)
+
+    # Staged pipeline, every stage on its own thread
+    rc = flt.RCFilter(cutoff=5, sample_time=1/SAMPLE_RATE)
+    pipeline = Pipeline('benchmark')
+    pipeline.add_source('reader', SerialReader(_source(capture, n, chunk_samples=64)))
+    pipeline.add_stage('decode', Decoder(ICM.ICM20948(start_char='&')))
+    pipeline.add_stage('filter', LowPass(rc))
+    pipeline.add_stage('estimate', Estimate(ComplementaryFilter(alpha=0.5, time_step=1/SAMPLE_RATE), dt=1/SAMPLE_RATE,
+                                            adjust_mag=ICM.adjust_mag))
+    pipeline.add_stage('sink', lambda batch: None)
+    start = time.perf_counter()
+    pipeline.start()
+    pipeline.join()
+    results['e2e_pipeline_samples_per_s'] = pipeline.metrics()['sink']['items_in'] / (time.perf_counter() - start)
+
+    return results
+
+
+"""
+How long Parser takes from opening a port to the first valid sample, on a pty fed by the simulator in
+real time. POSIX only, left out elsewhere. Raises if the parser never saw a sample
+"""
+def time_to_first_sample() -> dict:
+    if os.name == 'nt':
+        return dict()
+    from components.replay import PtyBridge
+
+    simulator = ImuSimulator(Tumble(seed=0), rate=SAMPLE_RATE, seed=0)
+    bridge = PtyBridge(SimulatedSerial(simulator, speed=1, duration=5, timeout=0.05), name="benchmark")
+    bridge.start()
+    try:
+        parser = Parser(dev_name="benchmark", imu=ICM.ICM20948(start_char='&'), port=bridge.port_name, baud=115200, ready_timeout=5)
+        parser.cleanup()
+    finally:
+        bridge.stop()
+    if parser.time_to_first_sample is None:
+        raise RuntimeError(f"no sample from {bridge.port_name} within the ready timeout")
+    return {'time_to_first_sample_us' : parser.time_to_first_sample * 1e6}
+
+
+"""
+Imports and the first batch of a headless decode, low pass and estimate job, best of repeat fresh interpreters.
+Raises if the job loaded any of HEAVY_MODULES
+"""
+def cold_start(repeat : int) -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (root, os.environ.get('PYTHONPATH')))))
+    data = format_ascii(synthetic_samples(200))
+
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', _COLD_START_JOB], input=data, capture_output=True, env=env,
+                                cwd=root, check=True).stdout
+        runs.append(json.loads(output))
+    heavy = sorted(set(name for job in runs for name in job['heavy']))
+    if len(heavy) > 0:
+        raise RuntimeError(f"headless job loaded {', '.join(heavy)}")
+
+    return {'cold_start_import_us' : min(job['import'] for job in runs) * 1e6,
+            'cold_start_us' : min(job['import'] + job['first_batch'] for job in runs) * 1e6}
+
+
+"""
+Metrics that got worse than baseline by more than tolerance (relative), as (name, baseline, current).
+Baseline metrics this run did not produce count as well, with current None
+"""
+def compare(results : dict, baseline : dict, tolerance : float) -> list:
+    regressions = [(name, reference, None) for name, reference in baseline.items() if name not in results]
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        reference = baseline[name]
+        if _higher_is_better(name):
+            worse = value < reference * (1 - tolerance)
+        else:
+            worse = value > reference * (1 + tolerance)
+        if worse:
+            regressions.append((name, reference, value))
+    return regressions
+
+
+def run(samples : int = 5000, capture : str = None, repeat : int = 5) -> dict:
+    results = micro_benchmarks(synthetic_samples(samples), repeat=repeat)
+    results.update(end_to_end(capture, samples))
+    results.update(time_to_first_sample())
+    results.update(cold_start(repeat))
+    return {
+        'meta' : {
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'machine' : platform.machine(),
+            'processor' : platform.processor(),
+            'samples' : samples,
+            'capture' : capture,
+        },
+        'results' : results,
+    }
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--samples', type=int, default=5000, help='samples per benchmark')
+    arg_parser.add_argument('--repeat', type=int, default=5, help='repeats per micro benchmark, the best one counts')
+    arg_parser.add_argument('--capture', help='raw serial capture to use for the end to end runs')
+    arg_parser.add_argument('--output', help='write the results to this JSON file')
+    arg_parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    arg_parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown before failing')
+    args = arg_parser.parse_args()
+
+    report = run(samples=args.samples, capture=args.capture, repeat=args.repeat)
+    for name, value in report['results'].items():
+        print(f"{name:>26} : {value:.6g}")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(report['results'], baseline, args.tolerance)
+        for name, reference, value in regressions:
+            current = "missing" if value is None else f"{value:.6g}"
+            print(f"REGRESSION {name}: {reference:.6g} -> {current}")
+        if len(regressions) > 0:
+            raise SystemExit(f"{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%} or went missing")
@@ -7,9 +7,31 @@ Device specific configuration and implementation for ICM-20948 IMU
 import re
 import components.IMU
 import numpy as np
+from components.binary_frame import BinaryFrameDecoder
 
 
+# Hard iron offset and soft iron matrix, see load_mag_profile to replace them with a calibration
 MAG_SOFT_IRON_ADJUSTMENT = np.array([ 11.82052489, -11.0642615, 46.75668695])
+MAG_SOFT_IRON_MATRIX = np.eye(3)
+
+# Every value in a text frame is followed by ", "
+_VALUE_PATTERN = re.compile(r"((?:-?\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?), ")
+
+"""
+Use a profile saved by components.mag_calibrator for every magnetometer adjustment from now on
+"""
+def load_mag_profile(path : str) -> None:
+    from components.mag_calibrator import load_profile
+    global MAG_SOFT_IRON_ADJUSTMENT, MAG_SOFT_IRON_MATRIX
+    MAG_SOFT_IRON_ADJUSTMENT, MAG_SOFT_IRON_MATRIX = load_profile(path)
+
+# Hard and soft iron corrected magnetometer readings, (3,) or (N, 3). Uses the loaded profile unless
+# hard_iron and soft_iron are given
+def adjust_mag(mag : np.ndarray, hard_iron : np.ndarray = None, soft_iron : np.ndarray = None) -> np.ndarray:
+    hard_iron = MAG_SOFT_IRON_ADJUSTMENT if hard_iron is None else hard_iron
+    soft_iron = MAG_SOFT_IRON_MATRIX if soft_iron is None else soft_iron
+    return (np.asarray(mag, dtype=np.float64) - hard_iron) @ soft_iron.T
+
 
 """
 Data and operations for ICM20948 IMU data
@@ -68,9 +90,9 @@ class ICMRawData(components.IMU.IMUData):
     def get_raw_mag(self) -> np.ndarray:
         return np.array([self.mag_x, self.mag_y, self.mag_z])
 
-    # Get mag data adjusted for soft iron disturbances
+    # Get mag data adjusted for hard and soft iron disturbances
     def get_adjusted_mag(self) -> np.ndarray:
-        return np.array([self.mag_x, self.mag_y, self.mag_z]) - MAG_SOFT_IRON_ADJUSTMENT
+        return adjust_mag(np.array([self.mag_x, self.mag_y, self.mag_z]))
 
     # Get accelerometer data as x,y,z array
     def get_raw_accel(self) -> np.ndarray:
@@ -85,36 +107,69 @@ class ICMRawData(components.IMU.IMUData):
 
 class ICM20948(components.IMU.IMU):
 
+    num_channels = 9
+
     def __init__(self, start_char : str):
         self.start_char = start_char
+        self.malformed_count = 0
 
-    def parse_data(self, data : str):
+    def create_sample(self, vector : np.ndarray) -> ICMRawData:
+        return ICMRawData.create_from_vector(vector)
 
-        # check start character, don't do expensive regex operations if it is not correct
-        if len(data) > 0 and data[0] != self.start_char:
-            return None
+    """
+    Parse many text frames at once into a (N, 9) array, lines that are not valid frames are skipped.
+    Lines that start with the start character but do not hold 9 values are counted in malformed_count
+    """
+    def parse_batch(self, lines : list) -> np.ndarray:
+        values = []
+        num_frames = 0
+
+        for line in lines:
+            # check start character, don't do expensive regex operations if it is not correct
+            if len(line) == 0 or line[0] != self.start_char:
+                continue
 
-        # parse incoming string
-        search_str = "(-?\\d+(\\.\\d*)?|\\.\\d+)([eE][-+]?\\d+)?, "
-        try:
-            results = list(re.findall(search_str, data))
-        except:
+            results = _VALUE_PATTERN.findall(line)
+            if len(results) < ICM20948.num_channels:
+                self.malformed_count += 1
+                continue
+
+            values.extend(results[:ICM20948.num_channels])
+            num_frames += 1
+
+        # Convert every value in one go instead of calling float() on each
+        return np.array(values, dtype=np.float64).reshape(num_frames, ICM20948.num_channels)
+
+    def parse_data(self, data : str):
+        batch = self.parse_batch([data])
+        if len(batch) == 0:
             return None
 
         # Dispatch to IMU data holder
-        try:
-            return ICMRawData(float(results[0][0]),
-                            float(results[1][0]),
-                            float(results[2][0]),
-                            float(results[3][0]),
-                            float(results[4][0]),
-                            float(results[5][0]),
-                            float(results[6][0]),
-                            float(results[7][0]),
-                            float(results[8][0]))
-        except:
-            # something went wrong
+        return ICMRawData.create_from_vector(batch[0])
+
+"""
+ICM20948 streaming binary frames (see components.binary_frame) instead of text
+"""
+class ICM20948Binary(components.IMU.IMU):
+
+    num_channels = 9
+    framing = 'binary'
+
+    def __init__(self, max_frames : int = 4096):
+        self.decoder = BinaryFrameDecoder(max_frames=max_frames)
+
+    def create_sample(self, vector : np.ndarray) -> ICMRawData:
+        return ICMRawData.create_from_vector(vector)
+
+    def decode_stream(self, buffer : bytearray) -> np.ndarray:
+        return self.decoder.decode(buffer)['data'].astype(np.float64)
+
+    def parse_data(self, data : bytes):
+        samples = self.decode_stream(bytearray(data))
+        if len(samples) == 0:
             return None
+        return ICMRawData.create_from_vector(samples[-1])
 
 if __name__ == '__main__':
     pass
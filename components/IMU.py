@@ -17,10 +17,32 @@ class IMUData:
 
 class IMU:
 
+    # Number of values in a vectorized sample
+    num_channels = 0
+
+    # 'line' for newline terminated text frames, 'binary' for framed byte streams
+    framing = 'line'
+
     # Parse data output from specific IMU
     def parse_data(self, data : str):
         pass
 
+    # Parse many lines into a (N, num_channels) array, invalid lines are skipped
+    def parse_batch(self, lines : list) -> np.ndarray:
+        samples = [self.parse_data(line) for line in lines]
+        vectors = [sample.convert_to_vector() for sample in samples if sample is not None]
+        if len(vectors) == 0:
+            return np.empty((0, self.num_channels))
+        return np.array(vectors, dtype=np.float64)
+
+    # Decode and consume all complete frames from a raw byte buffer, line framed IMUs have none
+    def decode_stream(self, buffer : bytearray) -> np.ndarray:
+        return np.empty((0, self.num_channels))
+
+    # Create a data holder from a sample vector
+    def create_sample(self, vector : np.ndarray):
+        pass
+
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,144 @@
+"""
+Binary framed protocol for streaming IMU samples
+
+Every frame is packed little endian:
+
+    sync (u8, 0xA5) | seq (u16) | data (9 x f32) | crc (u16)
+
+The CRC is CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) over the seq and data bytes,
+the same as binascii.crc_hqx(frame[1:-2], 0xFFFF), so the firmware side can use any
+standard implementation. The sequence counter increments by one per frame and wraps at 2^16.
+"""
+
+import numpy as np
+
+SYNC_BYTE = 0xA5
+NUM_CHANNELS = 9
+FRAME_DTYPE = np.dtype([('sync', 'u1'), ('seq', '<u2'), ('data', '<f4', (NUM_CHANNELS,)), ('crc', '<u2')])
+FRAME_SIZE = FRAME_DTYPE.itemsize
+
+_CRC_POLY = 0x1021
+_CRC_INIT = 0xFFFF
+
+
+def _make_crc_table() -> np.ndarray:
+    table = np.zeros(256, dtype=np.uint16)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ _CRC_POLY) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+        table[i] = crc
+    return table
+
+_CRC_TABLE = _make_crc_table()
+
+"""
+CRC of every row of a (N, L) uint8 array at once
+
+The loop runs over the L byte columns, each step works on all N frames together
+"""
+def crc16(rows : np.ndarray) -> np.ndarray:
+    crc = np.full(rows.shape[0], _CRC_INIT, dtype=np.uint16)
+    for col in range(rows.shape[1]):
+        crc = (crc << 8) ^ _CRC_TABLE[(crc >> 8) ^ rows[:, col]]
+    return crc
+
+"""
+Pack a (N, 9) array of samples into frames, mainly for simulators and firmware testing
+"""
+def encode_frames(samples : np.ndarray, start_seq : int = 0) -> bytes:
+    frames = np.zeros(len(samples), dtype=FRAME_DTYPE)
+    frames['sync'] = SYNC_BYTE
+    frames['seq'] = (start_seq + np.arange(len(samples))) & 0xFFFF
+    frames['data'] = samples
+
+    raw = frames.view(np.uint8).reshape(len(samples), FRAME_SIZE)
+    frames['crc'] = crc16(raw[:, 1:-2])
+    return frames.tobytes()
+
+
+"""
+Decode frames from a growing byte buffer
+
+Runs of aligned frames are viewed in place with np.frombuffer, checked in bulk and copied
+into a preallocated structured array, there are no per sample Python objects. Corrupt or
+misaligned data is skipped byte by byte until the next valid sync byte and CRC.
+"""
+class BinaryFrameDecoder:
+
+    def __init__(self, max_frames : int = 4096) -> None:
+        self.frames = np.zeros(max_frames, dtype=FRAME_DTYPE)
+
+        # Counters
+        self.decoded_frames = 0
+        self.dropped_frames = 0
+        self.crc_errors = 0
+        self.discarded_bytes = 0
+        self.last_seq = None
+
+    """
+    Decode all complete frames at the start of buf and remove the consumed bytes from it.
+    Returns a view of the preallocated frame array, only valid until the next call
+    """
+    def decode(self, buf : bytearray) -> np.ndarray:
+        pos = 0
+        count = 0
+        size = len(buf)
+
+        while size - pos >= FRAME_SIZE and count < len(self.frames):
+            # Resynchronize on the next sync byte
+            if buf[pos] != SYNC_BYTE:
+                next_sync = buf.find(SYNC_BYTE, pos + 1)
+                if next_sync < 0:
+                    next_sync = size
+                self.discarded_bytes += next_sync - pos
+                pos = next_sync
+                continue
+
+            n = min((size - pos) // FRAME_SIZE, len(self.frames) - count)
+            k = self._decode_run(buf, pos, n, count)
+            count += k
+            pos += k * FRAME_SIZE
+
+            # Sync byte in place but the frame does not check out, skip past it and search again
+            if k < n and buf[pos] == SYNC_BYTE:
+                self.crc_errors += 1
+                self.discarded_bytes += 1
+                pos += 1
+
+        # All views into buf are gone by now so it can be resized
+        del buf[:pos]
+
+        frames = self.frames[:count]
+        self._count_sequence(frames['seq'])
+        self.decoded_frames += count
+        return frames
+
+    # Copy the leading run of valid frames starting at pos, returns how many were valid
+    def _decode_run(self, buf : bytearray, pos : int, n : int, count : int) -> int:
+        candidates = np.frombuffer(buf, dtype=FRAME_DTYPE, count=n, offset=pos)
+        raw = np.frombuffer(buf, dtype=np.uint8, count=n * FRAME_SIZE, offset=pos).reshape(n, FRAME_SIZE)
+
+        valid = (candidates['sync'] == SYNC_BYTE) & (crc16(raw[:, 1:-2]) == candidates['crc'])
+        k = n if valid.all() else int(np.argmin(valid))
+
+        self.frames[count:count + k] = candidates[:k]
+        return k
+
+    # Count gaps in the sequence numbers as dropped frames
+    def _count_sequence(self, seq : np.ndarray) -> None:
+        if len(seq) == 0:
+            return
+
+        seq = seq.astype(np.int64)
+        if self.last_seq is not None:
+            seq = np.concatenate(([self.last_seq], seq))
+
+        gaps = np.diff(seq) % 0x10000
+        self.dropped_frames += int(np.maximum(gaps - 1, 0).sum())
+        self.last_seq = int(seq[-1])
+
+
+if __name__ == '__main__':
+    pass
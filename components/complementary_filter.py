@@ -4,9 +4,8 @@ Basic complementary filter
 
 import numpy as np
 import math as m
-from components.rotation import RotationMatrix
+from components.rotation import RotationMatrix, matrix_to_quat_array, quat_slerp_floats
 import time
-from scipy.spatial.transform import Rotation as R
 
 class ComplementaryFilter:
 
@@ -15,57 +14,121 @@ class ComplementaryFilter:
         self.time_step = time_step
         self.first_estimate_done = False
         self.last_estimate = None
+        self.last_time = None
         self.missing_steps = 0
 
     """
     Return in terms of Quaternions
+
+    TRIAD style: the North, East, Down axes are built from the accel and mag vectors and the
+    resulting rotation matrix [X, Y, Z] is converted straight to a quaternion on plain floats
     """
     def _accel_mag_model(self, accel_data : np.ndarray, mag_data : np.ndarray) -> np.ndarray:
 
-        accel_unit = accel_data / np.linalg.norm(accel_data)
-        mag_unit = mag_data / np.linalg.norm(mag_data)
+        ax, ay, az = accel_data.tolist()
+        mx, my, mz = mag_data.tolist()
+
+        # Down (z) is negative accel
+        norm = m.sqrt(ax*ax + ay*ay + az*az)
+        zx, zy, zz = -ax/norm, -ay/norm, -az/norm
+
+        norm = m.sqrt(mx*mx + my*my + mz*mz)
+        mx, my, mz = mx/norm, my/norm, mz/norm
 
         # East (y) is cross product of downwards acceleration and magnetic field (mag points "north-down")
-        y =  np.cross(-accel_unit, mag_unit)
-        y = y / np.linalg.norm(y)
+        yx, yy, yz = zy*mz - zz*my, zz*mx - zx*mz, zx*my - zy*mx
+        norm = m.sqrt(yx*yx + yy*yy + yz*yz)
+        yx, yy, yz = yx/norm, yy/norm, yz/norm
 
         # North (x) is cross product of East (y) and down (z)
+        xx, xy, xz = yy*zz - yz*zy, yz*zx - yx*zz, yx*zy - yy*zx
+        norm = m.sqrt(xx*xx + xy*xy + xz*xz)
+        xx, xy, xz = xx/norm, xy/norm, xz/norm
+
+        # rotation matrix [X, Y, Z] to quaternion, Shepperd's method
+        trace = xx + yy + zz
+        if trace >= xx and trace >= yy and trace >= zz:
+            s = 2 * m.sqrt(1 + trace)
+            quat = (0.25 * s, (yz - zy) / s, (zx - xz) / s, (xy - yx) / s)
+        elif xx >= yy and xx >= zz:
+            s = 2 * m.sqrt(1 + xx - yy - zz)
+            quat = ((yz - zy) / s, 0.25 * s, (yx + xy) / s, (zx + xz) / s)
+        elif yy >= zz:
+            s = 2 * m.sqrt(1 - xx + yy - zz)
+            quat = ((zx - xz) / s, (yx + xy) / s, 0.25 * s, (zy + yz) / s)
+        else:
+            s = 2 * m.sqrt(1 - xx - yy + zz)
+            quat = ((xy - yx) / s, (zx + xz) / s, (zy + yz) / s, 0.25 * s)
+
+        return np.array(quat)
+
+    """
+    Same model as _accel_mag_model for (N, 3) arrays, returns (N, 4) quaternions
+    """
+    def _accel_mag_model_batch(self, accel_data : np.ndarray, mag_data : np.ndarray) -> np.ndarray:
+
+        accel_unit = accel_data / np.linalg.norm(accel_data, axis=1, keepdims=True)
+        mag_unit = mag_data / np.linalg.norm(mag_data, axis=1, keepdims=True)
+
+        y = np.cross(-accel_unit, mag_unit)
+        y = y / np.linalg.norm(y, axis=1, keepdims=True)
+
         x = np.cross(y, -accel_unit)
-        x = x / np.linalg.norm(x)
+        x = x / np.linalg.norm(x, axis=1, keepdims=True)
 
-        # Down (z) is negative accel z
         z = -accel_unit
 
-        # construct rotation matrix -> [X, Y, Z]
-        rot =  R.from_matrix([[x[0], y[0], z[0]],
-                                [x[1], y[1], z[1]],
-                                [x[2], y[2], z[2]]])
-        items = rot.as_quat() # comes out as x,y,z,w format
-        return np.array([items[3], items[0], items[1], items[2]])
+        # stack as columns -> [X, Y, Z] for every sample
+        return matrix_to_quat_array(np.stack((x, y, z), axis=2))
 
     """
     Based on aproach described here: https://lucidar.me/en/quaternions/quaternion-and-gyroscope/
     """
-    def _gyro_dead_reckoning(self, gyro_data : np.ndarray):
+    def _gyro_dead_reckoning(self, gyro_data : np.ndarray, t_delta : float):
         gyro_data_rad = gyro_data * (m.pi/ 180)
         s_w = np.array([0, gyro_data_rad[0], gyro_data_rad[1], gyro_data_rad[2]])
         dq = RotationMatrix.quat_multiply(0.5 * self.last_estimate, s_w)
-        t_delta = time.time() - self.last_time
         q_next = self.last_estimate + (dq * t_delta)
         return q_next
 
-    def estimate(self, accel_data : np.ndarray, mag_data : np.ndarray, gyro_data : np.ndarray) -> RotationMatrix:
+    """
+    Time since the previous sample and advance the estimator clock
+
+    An explicit dt wins, otherwise it is the difference to the previous timestamp. Without either,
+    wall clock time is used. Stick to one timing source per estimator
+    """
+    def _time_step(self, timestamp : float = None, dt : float = None) -> float:
+        if timestamp is None and dt is None:
+            timestamp = time.time()
+
+        if dt is None:
+            dt = timestamp - self.last_time if self.last_time is not None else self.time_step
+
+        if timestamp is not None:
+            self.last_time = timestamp
+        elif self.last_time is not None:
+            self.last_time = self.last_time + dt
+        return dt
+
+    """
+    Estimate attitude from one sample
+
+    timestamp (s, e.g. device or host receive time) or dt (s since the previous sample) make the result
+    independent of when estimate() is called, without them the wall clock is used
+    """
+    def estimate(self, accel_data : np.ndarray, mag_data : np.ndarray, gyro_data : np.ndarray,
+                timestamp : float = None, dt : float = None) -> RotationMatrix:
 
         # We need an existing model estimate to be able to factor gyro readings for proper complementary filter
         if self.first_estimate_done == False:
             self.last_estimate = self._accel_mag_model(accel_data=accel_data, mag_data=mag_data)
             self.last_estimate = self.last_estimate / np.linalg.norm(self.last_estimate)
             self.first_estimate_done = True
-            self.last_time = time.time()
+            self._time_step(timestamp=timestamp, dt=dt)
             return RotationMatrix.quaternion_rotation_matrix(self.last_estimate)
 
         # First we do the gyro integration and estimation
-        gyro_angles_estimate = self._gyro_dead_reckoning(gyro_data=gyro_data)
+        gyro_angles_estimate = self._gyro_dead_reckoning(gyro_data=gyro_data, t_delta=self._time_step(timestamp=timestamp, dt=dt))
         gyro_angles_estimate = gyro_angles_estimate / np.linalg.norm(gyro_angles_estimate)
 
         # Next we find the accelerometer/magnetometer readings
@@ -76,7 +139,79 @@ class ComplementaryFilter:
         total = RotationMatrix.quat_interpolate(accel_mag_estimate, gyro_angles_estimate, self.alpha)
 
         self.last_estimate = total / np.linalg.norm(total)
-        self.last_time = time.time()
 
         return RotationMatrix.quaternion_rotation_matrix(self.last_estimate)
 
+    """
+    Run the filter over whole (N, 3) arrays of samples, returns (N, 4) quaternions (w, x, y, z)
+
+    Timing comes from timestamps (one per sample) or dt, the time between consecutive samples as a
+    single value or one per sample (dt[0] is the time since the previous call). Without either the
+    configured time_step is used. The accel/mag model runs vectorized over all samples, only the
+    recursive gyro integration and interpolation runs per sample, on plain floats
+    """
+    def estimate_batch(self, accel_data : np.ndarray, mag_data : np.ndarray, gyro_data : np.ndarray, dt=None,
+                        timestamps : np.ndarray = None) -> np.ndarray:
+
+        accel_data = np.asarray(accel_data, dtype=np.float64).reshape(-1, 3)
+        mag_data = np.asarray(mag_data, dtype=np.float64).reshape(-1, 3)
+        gyro_data = np.asarray(gyro_data, dtype=np.float64).reshape(-1, 3)
+        n = len(accel_data)
+
+        estimates = np.empty((n, 4))
+        if n == 0:
+            return estimates
+
+        accel_mag = self._accel_mag_model_batch(accel_data=accel_data, mag_data=mag_data)
+        accel_mag = accel_mag / np.linalg.norm(accel_mag, axis=1, keepdims=True)
+
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps, dtype=np.float64).reshape(n)
+            previous = self.last_time if self.last_time is not None else timestamps[0]
+            dt = np.diff(timestamps, prepend=previous)
+        elif dt is None:
+            dt = self.time_step
+        dt = np.broadcast_to(np.asarray(dt, dtype=np.float64), (n,))
+
+        # Half the body rates in rad/s, q' = q + 0.5 * q * (0, w) * dt
+        half_rates = (gyro_data * (0.5 * m.pi / 180)).tolist()
+        steps = dt.tolist()
+        accel_mag_list = accel_mag.tolist()
+        alpha = self.alpha
+
+        start = 0
+        if self.first_estimate_done == False:
+            self.last_estimate = accel_mag[0].copy()
+            self.first_estimate_done = True
+            estimates[0] = self.last_estimate
+            start = 1
+
+        qw, qx, qy, qz = self.last_estimate.tolist()
+        for i in range(start, n):
+            gx, gy, gz = half_rates[i]
+            h = steps[i]
+
+            # Gyro dead reckoning, same as _gyro_dead_reckoning
+            pw = qw + (-qx*gx - qy*gy - qz*gz) * h
+            px = qx + (qw*gx + qy*gz - qz*gy) * h
+            py = qy + (qw*gy - qx*gz + qz*gx) * h
+            pz = qz + (qw*gz + qx*gy - qy*gx) * h
+            norm = m.sqrt(pw*pw + px*px + py*py + pz*pz)
+            pw, px, py, pz = pw/norm, px/norm, py/norm, pz/norm
+
+            # Complementary filter, same as RotationMatrix.quat_interpolate(accel_mag, gyro, alpha)
+            qw, qx, qy, qz = quat_slerp_floats(accel_mag_list[i], (pw, px, py, pz), alpha)
+            norm = m.sqrt(qw*qw + qx*qx + qy*qy + qz*qz)
+            qw, qx, qy, qz = qw/norm, qx/norm, qy/norm, qz/norm
+
+            estimates[i, 0] = qw
+            estimates[i, 1] = qx
+            estimates[i, 2] = qy
+            estimates[i, 3] = qz
+
+        self.last_estimate = estimates[-1].copy()
+        if timestamps is not None:
+            self.last_time = timestamps[-1]
+        elif self.last_time is not None:
+            self.last_time = self.last_time + dt.sum()
+        return estimates
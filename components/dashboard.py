@@ -0,0 +1,188 @@
+"""
+Many plot panels in one window and one render process
+
+Every standalone plotter runs its own process, QApplication, timer and data channel. The dashboard
+hosts 2D, 3D and scatter panels in a single grid layout instead, drawn by one process on one timer
+and fed through one shared memory ring, so all panels stay in sync
+"""
+
+import numpy as np
+from multiprocessing import Process
+from components.shm_transport import SharedRing
+
+# Panel kinds
+_PLOT2D = 'plot2d'
+_PLOT3D = 'plot3d'
+_SCATTER3D = 'scatter3d'
+
+
+"""
+Render process side: builds every panel in a grid and routes records to them by panel id
+"""
+class _DashboardWindow():
+
+    def __init__(self, ring_spec : tuple, name : str, panels : list, columns : int, sampleinterval : float):
+        # Qt only lives in the render process
+        from PyQt5.QtWidgets import QApplication, QWidget, QGridLayout
+        from pyqtgraph.Qt import QtCore
+        import pyqtgraph as pg
+        from components.plotter2D import _Plot2DPanel
+        from components.plotter3D import _Plot3DPanel
+        from components.scatter_plotter3D import _ScatterPanel
+
+        self._interval = int(sampleinterval*1000)
+        self.ring = SharedRing.attach(*ring_spec)
+
+        pg.setConfigOptions(antialias=False)
+        self.app = QApplication([])
+        self.window = QWidget()
+        self.window.setWindowTitle(name)
+        layout = QGridLayout(self.window)
+
+        self.panels = []
+        self.widths = []
+        for index, (kind, width, options) in enumerate(panels):
+            if kind == _PLOT2D:
+                panel = _Plot2DPanel(sampleinterval=sampleinterval, **options)
+            elif kind == _PLOT3D:
+                panel = _Plot3DPanel(**options)
+            else:
+                panel = _ScatterPanel(**options)
+
+            panel.widget.setMinimumSize(300, 250)
+            layout.addWidget(panel.widget, index // columns, index % columns)
+            self.panels.append(panel)
+            self.widths.append(width)
+
+        self.window.show()
+
+        # One timer for every panel
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.updateplot)
+        self.timer.start(self._interval)
+
+    def updateplot(self):
+        records = self.ring.read_all()
+
+        if len(records) > 0:
+            panel_ids = records[:, 0].astype(np.int64)
+            for index in np.unique(panel_ids):
+                rows = records[panel_ids == index, 1:1 + self.widths[index]]
+                self.panels[index].push(rows)
+
+        for panel in self.panels:
+            panel.redraw()
+        self.app.processEvents()
+
+    def run(self):
+        self.app.exec_()
+
+
+def run_dashboard(ring_spec : tuple, name : str, panels : list, columns : int, sample_period : float):
+    d = _DashboardWindow(ring_spec=ring_spec, name=name, panels=panels, columns=columns, sampleinterval=sample_period)
+    d.run()
+
+
+"""
+Handle returned when adding a panel, plot() takes the same data as the matching standalone plotter
+"""
+class _PanelHandle:
+
+    def __init__(self, dashboard, panel_id : int, to_rows) -> None:
+        self.dashboard = dashboard
+        self.panel_id = panel_id
+        self.to_rows = to_rows
+
+    def plot(self, data) -> None:
+        self.dashboard._write(self.panel_id, self.to_rows(data))
+
+
+'''
+User facing class to lay out panels and run them in one render process
+
+Add every panel first, then call start(). Panels fill a grid row by row, columns wide
+'''
+class Dashboard:
+
+    def __init__(self, name : str, fps : int = 24, columns : int = 2, buffer_size : int = 65536):
+        self.name = name
+        self.fps = fps
+        self.columns = columns
+        self.buffer_size = buffer_size
+        self.panels = []
+        self.ring = None
+        self.p = None
+
+    def _add(self, kind : str, width : int, options : dict, to_rows) -> _PanelHandle:
+        if self.p is not None:
+            raise RuntimeError('Panels have to be added before the dashboard is started')
+        self.panels.append((kind, width, options))
+        return _PanelHandle(self, len(self.panels) - 1, to_rows)
+
+    """
+    Line plot, plot() takes a dict of line -> value (or array of values) like Plotter2D.
+    sample_rate is the rate plot() is called at, leave it out when plotting one sample per frame
+    """
+    def add_plot2d(self, name : str, xlabel : str, ylabel : str, lines : list, line_colors : list,
+                    sample_rate : float = None, timewindow : float = 5) -> _PanelHandle:
+        from components.plotter2D import _rows_from_dict
+
+        options = dict(plot_name=name, xlabel=xlabel, ylabel=ylabel, lines=lines, line_colors=line_colors,
+                        timewindow=timewindow, sample_rate=sample_rate)
+        return self._add(_PLOT2D, len(lines), options, lambda data: _rows_from_dict(data, lines))
+
+    """
+    Attitude view, plot() takes a quaternion (or RotationMatrix) like Plotter3D, with the same mesh and trail options
+    """
+    def add_plot3d(self, name : str, mesh : str = None, mesh_scale : float = 1.0, trail : int = 0) -> _PanelHandle:
+        from components.plotter3D import _quaternion_row
+
+        options = dict(plot_name=name, mesh=mesh, mesh_scale=mesh_scale, trail=trail)
+        return self._add(_PLOT3D, 4, options, _quaternion_row)
+
+    """
+    Point clouds, plot() takes a dict of point collection name -> (k, 3) points like ScatterPlotter3D,
+    decimation options are the same as well
+    """
+    def add_scatter3d(self, name : str, names : list, colors : list, decimation : str = None,
+                        voxel_size : float = 1.0, max_points : int = 100000) -> _PanelHandle:
+        from components.scatter_plotter3D import _point_records
+
+        options = dict(plot_name=name, names=names, colors=colors, decimation=decimation, voxel_size=voxel_size,
+                        max_points=max_points)
+        return self._add(_SCATTER3D, 4, options, lambda data: _point_records(data, names))
+
+    """
+    Create the shared channel and start the render process
+
+    Records are [panel id, payload], padded to the widest panel
+    """
+    def start(self) -> None:
+        if len(self.panels) == 0:
+            raise RuntimeError('Add a panel before start()')
+        width = 1 + max(panel_width for _, panel_width, _ in self.panels)
+        self.ring = SharedRing(width=width, capacity=self.buffer_size)
+        self.p = Process(target=run_dashboard, args=(self.ring.spec(), self.name, self.panels, self.columns, float(1/self.fps),))
+        self.p.start()
+
+    def _write(self, panel_id : int, rows : np.ndarray) -> None:
+        if self.ring is None:
+            raise RuntimeError('Dashboard has not been started')
+        rows = np.asarray(rows, dtype=np.float64)
+        records = np.zeros((len(rows), self.ring.width))
+        records[:, 0] = panel_id
+        records[:, 1:1 + rows.shape[1]] = rows
+        self.ring.write(records)
+
+    # Records overwritten before the render process got to them
+    @property
+    def dropped(self) -> int:
+        return self.ring.dropped if self.ring is not None else 0
+
+    def close(self) -> None:
+        if self.p is not None:
+            self.p.terminate()
+            self.p.join()
+            self.ring.close()
+            self.p = None
+            self.ring = None
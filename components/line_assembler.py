@@ -0,0 +1,100 @@
+"""
+Incremental line assembly for serial byte streams
+"""
+
+import time
+
+"""
+Collect raw bytes from a serial style source and hand out complete lines
+
+Bytes are read in large chunks into a reusable buffer, partial lines are kept until
+the rest of the line arrives. Lines are split off in bulk so there is no per byte
+work and no repeated concatenation of the whole stream.
+"""
+class LineAssembler:
+
+    def __init__(self, chunk_size : int = 65536) -> None:
+        self._chunk = bytearray(chunk_size)
+        self._chunk_view = memoryview(self._chunk)
+        self._pending = bytearray()
+
+        # Throughput counters
+        self.total_bytes = 0
+        self.total_lines = 0
+        self._rate_time = time.perf_counter()
+        self._rate_bytes = 0
+        self._rate_lines = 0
+
+    """
+    Read whatever the source has waiting in a single call, blocks for at least one byte
+    (subject to the source timeout) when nothing is waiting. Returns number of bytes read
+    """
+    def read_from(self, source) -> int:
+        n = min(max(1, source.in_waiting), len(self._chunk))
+        got = source.readinto(self._chunk_view[:n])
+        if got:
+            self.feed(self._chunk_view[:got])
+        return got or 0
+
+    # Read what the source had waiting at the time of the call, never blocks
+    def read_available(self, source) -> int:
+        remaining = source.in_waiting
+        total = 0
+        while remaining > 0:
+            got = self.read_from(source)
+            if got == 0:
+                break
+            total += got
+            remaining -= got
+        return total
+
+    # Add raw bytes to the stream
+    def feed(self, data) -> None:
+        self._pending += data
+        self.total_bytes += len(data)
+
+    """
+    Split off all complete lines received so far, oldest first. Line endings are removed
+    and whatever follows the last newline is kept for the next call
+    """
+    def lines(self) -> list:
+        end = self._pending.rfind(b'\n')
+        if end < 0:
+            return []
+
+        complete = self._pending[:end]
+        del self._pending[:end + 1]
+
+        lines = complete.decode(errors='ignore').splitlines()
+        self.total_lines += len(lines)
+        return lines
+
+    # Raw bytes received but not yet consumed, framed protocols decode straight out of this
+    @property
+    def buffer(self) -> bytearray:
+        return self._pending
+
+    # Number of bytes waiting for the end of their line
+    def pending_bytes(self) -> int:
+        return len(self._pending)
+
+    """
+    Bytes/s and lines/s since the last call
+    """
+    def rates(self) -> tuple:
+        now = time.perf_counter()
+        elapsed = now - self._rate_time
+        if elapsed <= 0:
+            return 0.0, 0.0
+
+        bytes_per_sec = (self.total_bytes - self._rate_bytes) / elapsed
+        lines_per_sec = (self.total_lines - self._rate_lines) / elapsed
+
+        self._rate_time = now
+        self._rate_bytes = self.total_bytes
+        self._rate_lines = self.total_lines
+        return bytes_per_sec, lines_per_sec
+
+
+if __name__ == '__main__':
+    pass
@@ -6,6 +6,9 @@ import math
 import numpy as np
 import time
 
+# Samples per step of filter_chunk
+_BLOCK = 64
+
 class RCFilter:
 
     """
@@ -20,31 +23,77 @@ class RCFilter:
     ODE for this equation becomes Vin = Vout + RCdVout/dt
 
     Cutoff frequency at 1/(2*pi*r*c) hz
+
+    The filter state is seeded from the first sample (seed_with_first) so the output starts
+    at the input instead of ramping up from zero
     """
-    def __init__(self, cutoff : int, sample_time : float) -> None:
+    def __init__(self, cutoff : int, sample_time : float, seed_with_first : bool = True) -> None:
         self.c = 0.1
         self.r = 1/(cutoff * self.c * 2 * math.pi)
         self.sample_time = sample_time
+        self.seed_with_first = seed_with_first
 
         # Check Nyquist limits
         if (cutoff*2 > (1/sample_time)):
             raise Exception("check RC filter cutoff values!")
 
+        # v[n] = k_in * vin[n] + k_last * v[n-1]
+        self.k_in = self.sample_time / (self.sample_time + self.r*self.c)
+        self.k_last = self.r*self.c / (self.sample_time + self.r*self.c)
+
+        # The recursion unrolled over a block for chunked filtering:
+        # v[k] = k_last^(k+1) * v[-1] + sum over j <= k of k_in * k_last^(k-j) * vin[j]
+        powers = self.k_last ** np.arange(_BLOCK + 1)
+        lags = np.arange(_BLOCK)[:, np.newaxis] - np.arange(_BLOCK)[np.newaxis, :]
+        self._block_gain = np.where(lags >= 0, self.k_in * powers[np.maximum(lags, 0)], 0.0)
+        self._block_decay = powers[1:, np.newaxis]
+
         self.last = None
         self.running = False
 
+    def _start(self, first : np.ndarray) -> None:
+        if self.seed_with_first:
+            self.last = np.array(first, dtype=np.float64)
+        else:
+            self.last = np.zeros(first.shape)
+        self.running = True
+
     """
     Filter method, to be used on whole input vectors for efficiency
     """
     def filter(self, current : np.ndarray):
 
         if self.running == False:
-            self.last = np.zeros(current.shape)
-            self.running = True
+            self._start(current)
 
-        new_vals = current * (self.sample_time / (self.sample_time + self.r*self.c)) + ((self.r*self.c/(self.sample_time + self.r*self.c)) * self.last)
+        new_vals = current * self.k_in + self.k_last * self.last
         self.last = new_vals
         return new_vals
 
+    """
+    Filter a (N, channels) block of samples, _BLOCK samples at a time with one matrix product each.
+    State carries over between chunks and between filter()/filter_chunk() calls. Gives the same
+    values as calling filter() per sample, up to rounding
+    """
+    def filter_chunk(self, samples : np.ndarray) -> np.ndarray:
+        samples = np.asarray(samples, dtype=np.float64)
+        if len(samples) == 0:
+            return samples.copy()
+
+        if self.running == False:
+            self._start(samples[0])
+
+        flat = samples.reshape(len(samples), -1)
+        filtered = np.empty_like(flat)
+        last = np.asarray(self.last, dtype=np.float64).reshape(-1)
+        for start in range(0, len(flat), _BLOCK):
+            block = flat[start:start + _BLOCK]
+            k = len(block)
+            filtered[start:start + k] = self._block_gain[:k, :k] @ block + self._block_decay[:k] * last
+            last = filtered[start + k - 1]
+
+        self.last = last.reshape(np.shape(self.last)).copy()
+        return filtered.reshape(samples.shape)
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,148 @@
+"""
+Streaming magnetometer calibration
+
+Fits an ellipsoid to the raw magnetometer samples with linear least squares. Every sample adds its
+row d = [x², y², z², 2xy, 2xz, 2yz, 2x, 2y, 2z] to the normal equations of d·u = 1, so only the 9x9
+matrix DᵀD and the vector Dᵀ1 are kept and an update costs the same no matter how long the run is.
+The fitted quadric xᵀAx + 2bᵀx = 1 gives
+
+    hard iron offset    c = -A⁻¹b
+    soft iron matrix    W = sqrtm(A / k) * r,  k = 1 + cᵀAc
+
+with r the field strength that keeps the volume of the ellipsoid, so W(m - c) lies on a sphere of radius r.
+Coverage counts how many equal area patches of the sphere the sample directions (seen from the
+latest fitted center) have hit so far. The fit is refreshed every refit_every samples to keep that
+center current, a fit is a 9x9 solve so this does not depend on the run length either
+"""
+
+import json
+import numpy as np
+
+"""
+Running ellipsoid fit, feed it with update() and read the calibration with fit()
+"""
+class MagCalibrator:
+
+    def __init__(self, elevation_bins : int = 6, azimuth_bins : int = 12, refit_every : int = 100) -> None:
+        self.dtd = np.zeros((9, 9))
+        self.dt1 = np.zeros(9)
+        self.count = 0
+
+        # Samples are scaled to about unit size before they go into the normal equations
+        self.scale = None
+
+        # Equal area bins: equal height bands of the unit sphere cut into equal azimuth sectors
+        self.elevation_bins = elevation_bins
+        self.azimuth_bins = azimuth_bins
+        self.hits = np.zeros((elevation_bins, azimuth_bins), dtype=bool)
+        self.center = None
+        self.refit_every = refit_every
+        self._sum = np.zeros(3)
+
+        self.hard_iron = None
+        self.soft_iron = None
+        self.field_strength = None
+        self.residual = None
+
+    """
+    Add (k, 3) or (3,) raw magnetometer samples
+    """
+    def update(self, samples : np.ndarray) -> None:
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+        if len(samples) == 0:
+            return
+        if self.scale is None:
+            self.scale = 1 / max(np.mean(np.linalg.norm(samples, axis=1)), 1e-12)
+
+        x, y, z = (samples * self.scale).T
+        rows = np.column_stack((x*x, y*y, z*z, 2*x*y, 2*x*z, 2*y*z, 2*x, 2*y, 2*z))
+        self.dtd += rows.T @ rows
+        self.dt1 += rows.sum(axis=0)
+        previous = self.count
+        self.count += len(samples)
+        self._sum += samples.sum(axis=0)
+        if self.refit_every and self.count // self.refit_every != previous // self.refit_every:
+            self.fit()
+
+        # Until there is a fit the mean is the best guess for the center
+        center = self.center if self.center is not None else self._sum / self.count
+        directions = samples - center
+        norms = np.linalg.norm(directions, axis=1)
+        directions = directions[norms > 0] / norms[norms > 0, np.newaxis]
+        band = np.minimum(((directions[:, 2] + 1) / 2 * self.elevation_bins).astype(int), self.elevation_bins - 1)
+        sector = np.minimum(((np.arctan2(directions[:, 1], directions[:, 0]) + np.pi) / (2*np.pi) * self.azimuth_bins).astype(int),
+                            self.azimuth_bins - 1)
+        self.hits[band, sector] = True
+
+    # Fraction of the sphere the sample directions have covered
+    @property
+    def coverage(self) -> float:
+        return float(self.hits.mean())
+
+    """
+    Solve the normal equations, returns True and updates hard_iron, soft_iron, field_strength and
+    residual (RMS relative radius error) when the samples describe an ellipsoid. That needs samples
+    spread around all three axes, keep an eye on coverage
+    """
+    def fit(self) -> bool:
+        if self.count < 9:
+            return False
+        try:
+            u = np.linalg.solve(self.dtd, self.dt1)
+        except np.linalg.LinAlgError:
+            return False
+
+        a = np.array([[u[0], u[3], u[4]],
+                      [u[3], u[1], u[5]],
+                      [u[4], u[5], u[2]]])
+        b = u[6:9]
+        try:
+            center = -np.linalg.solve(a, b)
+        except np.linalg.LinAlgError:
+            return False
+
+        # (m - c)ᵀ (A / k) (m - c) = 1, only an ellipsoid if A / k is positive definite
+        k = 1 + center @ a @ center
+        shape = a / k
+        eigenvalues, eigenvectors = np.linalg.eigh(shape)
+        if np.any(eigenvalues <= 0):
+            return False
+
+        # Back from scaled units to sensor units
+        self.hard_iron = center / self.scale
+        eigenvalues = eigenvalues * self.scale**2
+        self.field_strength = float(np.prod(eigenvalues) ** (-1/6))
+        self.soft_iron = (eigenvectors * np.sqrt(eigenvalues)) @ eigenvectors.T * self.field_strength
+
+        # RMS of d·u - 1 over all samples is about 2k times the relative radius error
+        rms = np.sqrt(max(0.0, u @ self.dtd @ u - 2 * u @ self.dt1 + self.count) / self.count)
+        self.residual = float(rms / (2 * abs(k)))
+        self.center = self.hard_iron
+        return True
+
+    # Calibrated (k, 3) samples W(m - c)
+    def apply(self, samples : np.ndarray) -> np.ndarray:
+        return (np.asarray(samples, dtype=np.float64) - self.hard_iron) @ self.soft_iron.T
+
+    def to_profile(self) -> dict:
+        return {
+            'hard_iron' : self.hard_iron.tolist(),
+            'soft_iron' : self.soft_iron.tolist(),
+            'field_strength' : self.field_strength,
+            'residual' : self.residual,
+            'coverage' : self.coverage,
+            'samples' : self.count,
+        }
+
+    def save(self, path : str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.to_profile(), f, indent=2)
+
+
+"""
+Read a saved profile, returns (hard iron offset, soft iron matrix)
+"""
+def load_profile(path : str) -> tuple:
+    with open(path, 'r') as f:
+        profile = json.load(f)
+    return np.array(profile['hard_iron'], dtype=np.float64), np.array(profile['soft_iron'], dtype=np.float64)
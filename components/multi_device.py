@@ -0,0 +1,417 @@
+"""
+Acquisition from many IMUs at once
+
+One asyncio event loop, on its own thread, does the serial I/O for every port. Ports that have a
+file descriptor (serial ports and ptys on Linux and macOS) wake the loop when bytes arrive, anything
+else (Windows COM ports, replays, simulators) is polled. Every chunk read is tagged with the device
+and the host time it arrived and handed to a worker process. Devices are sharded over the workers,
+so a device is always decoded, filtered and estimated in the same process and its filter state stays
+there. Workers send finished batches back and read() merges them into one stream ordered by host time.
+
+Parsing and estimation are the expensive part, so this scales with the number of workers until the
+serial links or the single I/O thread are saturated
+"""
+
+import asyncio
+import copy
+import functools
+import os
+import queue
+import threading
+import time
+import multiprocessing
+
+import numpy as np
+import serial
+
+import components.IMU
+import components.ICM20948 as ICM
+import components.lowpass_filter as flt
+from components.complementary_filter import ComplementaryFilter
+from components.pipeline import Decoder, LowPass, Estimate, merge_batches
+from components.replay import EndOfCapture
+
+
+"""
+Decode, low pass and estimate for one device, built separately inside the worker for every device
+
+Samples keep the receive time of their chunk, which is what the merged stream is ordered by, so
+several samples can share one time. Give dt for the estimator, it would see no time pass between them.
+
+hard_iron and soft_iron are the magnetometer correction (see ICM20948.adjust_mag), passed as values
+because workers started by spawn import ICM20948 afresh and never see a profile loaded here
+"""
+class ProcessingChain:
+
+    def __init__(self, imu : components.IMU, cutoff : float, sample_time : float, alpha : float = 0.5,
+                dt : float = None, hard_iron : np.ndarray = None, soft_iron : np.ndarray = None) -> None:
+        self.imu = imu
+        self.cutoff = cutoff
+        self.sample_time = sample_time
+        self.alpha = alpha
+        self.dt = dt
+        self.hard_iron = None if hard_iron is None else np.array(hard_iron, dtype=np.float64)
+        self.soft_iron = None if soft_iron is None else np.array(soft_iron, dtype=np.float64)
+
+    def build(self) -> list:
+        adjust_mag = None
+        if self.hard_iron is not None or self.soft_iron is not None:
+            hard_iron = self.hard_iron if self.hard_iron is not None else np.zeros(3)
+            soft_iron = self.soft_iron if self.soft_iron is not None else np.eye(3)
+            adjust_mag = functools.partial(ICM.adjust_mag, hard_iron=hard_iron, soft_iron=soft_iron)
+
+        return [Decoder(copy.deepcopy(self.imu)),
+                LowPass(flt.RCFilter(cutoff=self.cutoff, sample_time=self.sample_time)),
+                Estimate(ComplementaryFilter(alpha=self.alpha, time_step=self.sample_time), dt=self.dt, adjust_mag=adjust_mag)]
+
+
+"""
+Worker process: run the chain of every device it owns on the chunks it receives. Chunks that queued
+up for the same device are joined first so a busy worker does fewer, larger batches.
+
+A device whose chain raises is reported on errors and ended, the other devices carry on. Whatever
+happens, every device still open is ended and None is sent when the worker exits
+"""
+def _shard_worker(chain : ProcessingChain, devices : list, inbox, results, errors) -> None:
+    chains = dict()
+    open_devices = set(devices)
+    try:
+        running = True
+        while running:
+            items = [inbox.get()]
+            while True:
+                try:
+                    items.append(inbox.get_nowait())
+                except queue.Empty:
+                    break
+
+            chunks = dict()
+            ended = []
+            for item in items:
+                if item is None:
+                    running = False
+                    continue
+                device, receive_time, data = item
+                if device not in open_devices:
+                    continue
+                if data is None:
+                    ended.append(device)
+                    continue
+                chunks.setdefault(device, []).append({'data' : data, 'time' : receive_time})
+
+            # (device, batch or None, chunks done, receive time of the newest chunk, device ended)
+            for device, batches in chunks.items():
+                try:
+                    if device not in chains:
+                        chains[device] = chain.build()
+                    batch = merge_batches(batches)
+                    receive_time = batch['time']
+                    for stage in chains[device]:
+                        batch = stage(batch)
+                        if batch is None:
+                            break
+                except Exception as e:
+                    errors.put((device, repr(e)))
+                    open_devices.discard(device)
+                    results.put((device, None, 0, None, True))
+                    continue
+                results.put((device, batch, len(batches), receive_time, False))
+
+            # Only after the device's last batch
+            for device in ended:
+                if device in open_devices:
+                    open_devices.discard(device)
+                    results.put((device, None, 0, None, True))
+    except Exception as e:
+        for device in open_devices:
+            errors.put((device, repr(e)))
+    finally:
+        for device in open_devices:
+            results.put((device, None, 0, None, True))
+        results.put(None)
+
+
+"""
+Orders batches from many devices by time
+
+Chunks of a device are read and processed in order, so once the workers have processed every chunk
+read from a device nothing older than the newest processed chunk can come from it, and if there is
+no chunk in flight at all nothing older than now. Rows older than that bound for every running
+device are released, an idle device does not hold the others up
+"""
+class _TimeMerger:
+
+    def __init__(self, num_devices : int) -> None:
+        self.processed = np.zeros(num_devices, dtype=np.int64)
+        self.newest = np.full(num_devices, -np.inf)
+        self.active = np.ones(num_devices, dtype=bool)
+        self.pending = []
+
+    def add(self, device : int, batch : dict, chunks : int, receive_time : float) -> None:
+        self.processed[device] += chunks
+        self.newest[device] = max(self.newest[device], receive_time)
+        if batch is None or len(batch['time']) == 0:
+            return
+        batch['device'] = np.full(len(batch['time']), device, dtype=np.int64)
+        self.pending.append(batch)
+
+    def finish(self, device : int) -> None:
+        self.active[device] = False
+
+    """
+    Everything that is safe to release as one time ordered batch, None if nothing is. now has to be
+    taken before chunks_read (chunks handed to the workers per device) is looked at. flush releases
+    everything
+    """
+    def pop(self, now : float, chunks_read : np.ndarray, flush : bool = False):
+        if len(self.pending) == 0:
+            return None
+
+        if flush:
+            watermark = np.inf
+        else:
+            bound = np.where(self.processed >= chunks_read, now, self.newest)
+            watermark = bound[self.active].min() if np.any(self.active) else np.inf
+
+        merged = merge_batches(self.pending)
+        ready = merged['time'] <= watermark
+        if not np.any(ready):
+            self.pending = [merged]
+            return None
+
+        order = np.lexsort((merged['device'][ready], merged['time'][ready]))
+        batch = {key : value[ready][order] for key, value in merged.items()}
+        rest = {key : value[~ready] for key, value in merged.items()}
+        self.pending = [rest] if len(rest['time']) > 0 else []
+        return batch
+
+
+def _fileno(ser):
+    if os.name == 'nt':
+        return None
+    try:
+        return ser.fileno()
+    except (AttributeError, OSError, ValueError, NotImplementedError, serial.serialutil.SerialException):
+        return None
+
+
+"""
+Read N serial ports concurrently and process them on a pool of worker processes
+
+devices maps a device id to a port name (opened with baud through Parser, so the usual startup
+handling applies) or to an already open serial style object such as a SimulatedSerial or ReplaySerial.
+Ports are opened concurrently. workers defaults to one per core, at most one per device.
+
+read() returns merged batches {'device', 'time', 'raw', 'filtered', 'quaternion'}, 'device' being the
+index into device_ids and 'time' the host receive time, oldest first
+"""
+class MultiDeviceManager:
+
+    def __init__(self, devices : dict, chain : ProcessingChain, baud : int = 115200, workers : int = None,
+                poll_interval : float = 0.002, ready_timeout : float = 10) -> None:
+        self.device_ids = list(devices.keys())
+        self.ports = list(devices.values())
+        self.chain = chain
+        self.baud = baud
+        self.workers = max(1, min(workers or os.cpu_count() or 1, len(self.device_ids)))
+        self.poll_interval = poll_interval
+        self.ready_timeout = ready_timeout
+
+        self._merger = _TimeMerger(len(self.device_ids))
+        self._results = multiprocessing.Queue()
+        self._worker_errors = multiprocessing.Queue()
+        self._inboxes = [multiprocessing.Queue() for _ in range(self.workers)]
+        self._processes = []
+        self._io_thread = None
+        self._stopping = False
+        self._parsers = dict()
+        self._workers_done = 0
+
+        # Per device counters, written by the I/O thread
+        num_devices = len(self.device_ids)
+        self.bytes_read = np.zeros(num_devices, dtype=np.int64)
+        self.chunks_read = np.zeros(num_devices, dtype=np.int64)
+        self.samples = np.zeros(num_devices, dtype=np.int64)
+        self.finished = np.zeros(num_devices, dtype=bool)
+        self.errors = dict()
+
+        # Devices whose chain failed in a worker, set by read()
+        self.failed = np.zeros(num_devices, dtype=bool)
+
+    # Worker that owns a device
+    def shard(self, device : int) -> int:
+        return device % self.workers
+
+    def start(self) -> None:
+        for worker, inbox in enumerate(self._inboxes):
+            devices = [device for device in range(len(self.device_ids)) if self.shard(device) == worker]
+            process = multiprocessing.Process(target=_shard_worker, args=(self.chain, devices, inbox, self._results, self._worker_errors),
+                                            daemon=True)
+            process.start()
+            self._processes.append(process)
+
+        self._io_thread = threading.Thread(target=asyncio.run, args=(self._io_main(),), name="multi device I/O", daemon=True)
+        self._io_thread.start()
+
+    # Ask every reader to stop, read() returns what is left and then None
+    def stop(self) -> None:
+        self._stopping = True
+
+    def _open(self, index : int):
+        port = self.ports[index]
+        if not isinstance(port, str):
+            return port
+
+        from components.parser import Parser
+        parser = Parser(dev_name=self.device_ids[index], imu=copy.deepcopy(self.chain.imu), port=port, baud=self.baud,
+                        ready_timeout=self.ready_timeout)
+        self._parsers[index] = parser
+        return parser.ser
+
+    async def _io_main(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            # Opening waits for every device to send its first frame, do all ports at the same time
+            ports = await asyncio.gather(*[loop.run_in_executor(None, self._open, i) for i in range(len(self.ports))],
+                                        return_exceptions=True)
+            readers = []
+            for device, ser in enumerate(ports):
+                if isinstance(ser, Exception):
+                    self.errors[self.device_ids[device]] = repr(ser)
+                    self.finished[device] = True
+                    continue
+                readers.append(self._read_device(device, ser))
+            await asyncio.gather(*readers)
+        finally:
+            for inbox in self._inboxes:
+                inbox.put(None)
+
+    async def _read_device(self, device : int, ser) -> None:
+        loop = asyncio.get_running_loop()
+        inbox = self._inboxes[self.shard(device)]
+        ser.timeout = 0
+        fileno = _fileno(ser)
+        readable = asyncio.Event()
+        if fileno is not None:
+            loop.add_reader(fileno, readable.set)
+
+        try:
+            while not self._stopping and not self.failed[device]:
+                waiting = ser.in_waiting
+                if waiting == 0:
+                    if getattr(ser, 'finished', False):
+                        break
+                    if fileno is not None:
+                        readable.clear()
+                        try:
+                            await asyncio.wait_for(readable.wait(), timeout=0.1)
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await asyncio.sleep(self.poll_interval)
+                    continue
+
+                data = ser.read(waiting)
+                if len(data) == 0:
+                    continue
+
+                # Counted before the time is taken, see _TimeMerger
+                self.chunks_read[device] += 1
+                inbox.put((device, time.time(), data))
+                self.bytes_read[device] += len(data)
+
+                # Let the other ports have a go
+                await asyncio.sleep(0)
+        except EndOfCapture:
+            pass
+        except (serial.serialutil.SerialException, OSError) as e:
+            self.errors[self.device_ids[device]] = repr(e)
+        finally:
+            if fileno is not None:
+                loop.remove_reader(fileno)
+            self.finished[device] = True
+            inbox.put((device, None, None))
+
+    """
+    Next time ordered batch, None if nothing was ready within timeout or everything has been read
+    """
+    def read(self, timeout : float = None):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            flush = self._workers_done == self.workers
+            batch = self._merger.pop(time.time(), self.chunks_read.copy(), flush=flush)
+            if batch is not None or flush:
+                return batch
+
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                return None
+            try:
+                item = self._results.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            self._add_result(item)
+
+            # Take whatever else has arrived before merging
+            while True:
+                try:
+                    item = self._results.get_nowait()
+                except queue.Empty:
+                    break
+                self._add_result(item)
+
+    def _add_result(self, item) -> None:
+        if item is None:
+            self._workers_done += 1
+            return
+        device, batch, chunks, receive_time, ended = item
+        if ended:
+            self._merger.finish(device)
+            self._collect_errors()
+            return
+        if batch is not None:
+            self.samples[device] += len(batch['time'])
+        self._merger.add(device, batch, chunks, receive_time)
+
+    # Chains that failed in a worker, their devices are not read any more
+    def _collect_errors(self) -> None:
+        while True:
+            try:
+                device, error = self._worker_errors.get_nowait()
+            except queue.Empty:
+                break
+            self.failed[device] = True
+            self.errors[self.device_ids[device]] = error
+
+    # True once every device has ended and every batch has been read
+    @property
+    def done(self) -> bool:
+        return self._workers_done == self.workers and len(self._merger.pending) == 0
+
+    # Counters per device, its worker and how long its port took to deliver a first sample
+    def stats(self) -> dict:
+        self._collect_errors()
+        return {device_id : {'bytes' : int(self.bytes_read[i]), 'chunks' : int(self.chunks_read[i]),
+                            'samples' : int(self.samples[i]), 'worker' : self.shard(i), 'finished' : bool(self.finished[i]),
+                            'time_to_first_sample' : self._parsers[i].time_to_first_sample if i in self._parsers else None,
+                            'error' : self.errors.get(device_id)}
+                for i, device_id in enumerate(self.device_ids)}
+
+    def cleanup(self) -> None:
+        self.stop()
+        if self._io_thread is not None:
+            self._io_thread.join()
+            self._io_thread = None
+
+        # Workers finish once their queues are empty, read() hands out the rest until then
+        for process in self._processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+        for parser in self._parsers.values():
+            parser.cleanup()
+
+
+if __name__ == '__main__':
+    pass
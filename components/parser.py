@@ -6,45 +6,226 @@ import serial
 import json
 import os
 import time
+import threading
 import components.IMU
+from components.ring_buffer import SampleRingBuffer
+from components.line_assembler import LineAssembler
 
 class Parser:
 
-    def __init__(self, dev_name: str, imu: components.IMU, port : str, baud : int) -> None:
+    """
+    imu selects the wire format, e.g. ICM20948 for text lines or ICM20948Binary for binary frames.
+    threaded=True hands the serial port to a background reader thread which parses every
+    incoming line into a bounded ring buffer, use drain()/latest() to consume the samples.
+    ser replaces the serial port with an already open serial style object. record saves every
+    chunk read from the port to a capture file, from the very first byte on (see SerialRecorder).
+    A port opened here is only handed out once the device is ready, see wait_until_ready,
+    ready_timeout=0 skips that
+    """
+    def __init__(self, dev_name: str, imu: components.IMU, port : str, baud : int, threaded : bool = False,
+                buffer_size : int = 4096, ready_timeout : float = 10, banner : str = None, reset : bool = False,
+                ser=None, record : str = None) -> None:
 
         self.port = port
         self.baud = baud
+        self.time_to_first_sample = None
+        open_time = time.perf_counter()
+
+        # Anything with the pyserial read interface can be handed in directly, e.g. a replay source
+        if ser is not None:
+            self.ser = ser
+        else:
+            print(f"Setting up connection on port {self.port} at baud {self.baud}")
+            self.ser = serial.Serial(baudrate=self.baud, port=self.port)
+            try:
+                self.ser.open()
+            except serial.serialutil.SerialException:
+                self.ser.close()
+                self.ser.open()
+
+        if record is not None:
+            # Wrapped before the startup handshake reads anything, so the capture starts at the beginning
+            from components.replay import SerialRecorder
+            self.ser = SerialRecorder(self.ser, record)
 
-        print(f"Setting up connection on port {self.port} at baud {self.baud}")
-        self.ser = serial.Serial(baudrate=self.baud, port=self.port)
-        try:
-            self.ser.open()
-        except serial.serialutil.SerialException:
-            self.ser.close()
-            self.ser.open()
+        self.imu = imu
+        self.assembler = LineAssembler()
+
+        # Background reader state
+        self.threaded = threaded
+        self.buffer = None
+        self.rejected_lines = 0
+        self.reader_error = None
+        self._latest_sample = None
+        self._last_returned = 0
+        self.last_receive_time = None
+        self._stop_event = threading.Event()
+        self._reader = None
 
         # There is this known issue where reading data using pyserial from an Arduino requires a delay...
         # https://arduino.stackexchange.com/questions/23950/arduino-serial-monitor-works-but-not-on-pyserial-and-putty
-        time.sleep(10)
-        self.ser.read_all()
-
-        self.imu = imu
+        # Opening the port resets the board, wait until it talks instead of sleeping a fixed time
+        if ser is None and ready_timeout > 0:
+            self.wait_until_ready(timeout=ready_timeout, banner=banner, reset=reset, open_time=open_time)
+
+        if self.threaded:
+            self.buffer = SampleRingBuffer(capacity=buffer_size, width=self.imu.num_channels)
+            self.start_reader()
+
+    """
+    Read from the port until the first valid frame, or a line containing banner, arrives and
+    throw away what came before. reset pulses DTR first, which restarts boards with auto reset.
+    Returns False if the device stayed quiet for timeout seconds. time_to_first_sample is how
+    long it took since open_time (default now)
+    """
+    def wait_until_ready(self, timeout : float = 10, banner : str = None, reset : bool = False,
+                        open_time : float = None) -> bool:
+        if open_time is None:
+            open_time = time.perf_counter()
+
+        if reset:
+            self.ser.dtr = False
+            time.sleep(0.1)
+            self.ser.reset_input_buffer()
+            self.ser.dtr = True
+
+        previous_timeout = self.ser.timeout
+        self.ser.timeout = 0.05
+        deadline = time.perf_counter() + timeout
+        ready = False
+        try:
+            while not ready and time.perf_counter() < deadline:
+                if self.assembler.read_from(self.ser) > 0:
+                    ready = self._ready_marker(banner)
+        finally:
+            self.ser.timeout = previous_timeout
+
+        if not ready:
+            print(f"No data from {self.port} after {timeout} s, carrying on")
+            return False
+
+        self.time_to_first_sample = time.perf_counter() - open_time
+        print(f"{self.port} ready, first sample after {self.time_to_first_sample:.3f} s")
+        return True
+
+    # Whether what the assembler holds contains a valid frame or the banner, consumes what it looked at
+    def _ready_marker(self, banner : str) -> bool:
+        if self.imu.framing == 'binary':
+            if banner is not None:
+                found = self.assembler.buffer.find(banner.encode())
+                if found >= 0:
+                    del self.assembler.buffer[:found + len(banner)]
+                    return True
+            return len(self.imu.decode_stream(self.assembler.buffer)) > 0
+
+        for line in self.assembler.lines():
+            if (banner is not None and banner in line) or self.imu.parse_data(line) is not None:
+                return True
+        return False
+
+    def start_reader(self) -> None:
+        # Use a read timeout so the thread can notice when it is asked to stop
+        self.ser.timeout = 0.1
+        self._stop_event.clear()
+        self._reader = threading.Thread(target=self._reader_loop, name=f"Parser reader {self.port}", daemon=True)
+        self._reader.start()
+
+    def stop_reader(self) -> None:
+        if self._reader is None:
+            return
+        self._stop_event.set()
+        self._reader.join()
+        self._reader = None
+
+    """
+    Background thread, owns the serial port and parses every line it receives
+    """
+    def _reader_loop(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                got = self.assembler.read_from(self.ser)
+            except serial.serialutil.SerialException as e:
+                self.reader_error = e
+                return
+
+            if got == 0:
+                continue
+
+            receive_time = self._receive_time()
+            samples = self._decode_pending()
+            if len(samples) == 0:
+                continue
+
+            self.buffer.push_many(samples, receive_time)
+            self._latest_sample = self.imu.create_sample(samples[-1])
+
+    # Host time the latest data arrived, replay sources report the originally recorded time
+    def _receive_time(self) -> float:
+        receive_time = getattr(self.ser, 'receive_time', None)
+        return receive_time if receive_time is not None else time.time()
+
+    # Decode everything complete in the assembler into a (N, channels) array
+    def _decode_pending(self):
+        if self.imu.framing == 'binary':
+            return self.imu.decode_stream(self.assembler.buffer)
+
+        lines = [line for line in self.assembler.lines() if len(line) > 0]
+        samples = self.imu.parse_batch(lines)
+        self.rejected_lines += len(lines) - len(samples)
+        return samples
+
+    # Newest parsed sample, does not consume anything from the buffer
+    def latest(self):
+        return self._latest_sample
+
+    # All samples received since the last drain as a (N, channels) array, oldest first. Only the
+    # reader thread fills the buffer, an unthreaded parser has nothing to drain
+    def drain(self, with_timestamps : bool = False):
+        if self.buffer is None:
+            raise RuntimeError(f"parser on {self.port} is not threaded, use run() or create it with threaded=True")
+        return self.buffer.drain(with_timestamps=with_timestamps)
+
+    # Number of samples lost because the consumer did not drain fast enough
+    @property
+    def overflow_count(self) -> int:
+        return self.buffer.overflow_count if self.buffer is not None else 0
+
+    # Incoming bytes/s and lines/s since the last call
+    def rates(self) -> tuple:
+        return self.assembler.rates()
 
     def run(self):
 
-        # read all the incoming data directly, this clears the buffer at the same time as reading
-        data = self.ser.read_all()
-
-        # make sure that the current line is finished off, read all incoming bytes until we hit the newline char
-        while len(data) == 0 or data[-1] != 10:
-            data += self.ser.read(1)
-
-        # split into lines, we analyze the "newest" line first for valid data
-        data_decoded = data.decode()
-
-        d_list = data_decoded.split('\r\n')
-        d_list = d_list[::-1]
-        for string in d_list:
+        # With the reader thread running just hand out the newest sample we have not returned yet
+        if self.threaded:
+            if self.buffer.total_pushed == self._last_returned:
+                return None
+            self._last_returned = self.buffer.total_pushed
+            self.last_receive_time = self.buffer.timestamps[(self.buffer.head - 1) % self.buffer.capacity]
+            return self._latest_sample
+
+        # binary frames are decoded in bulk straight from the byte buffer, wait until at least one is complete
+        if self.imu.framing == 'binary':
+            self.assembler.read_available(self.ser)
+            samples = self.imu.decode_stream(self.assembler.buffer)
+            while len(samples) == 0:
+                self.assembler.read_from(self.ser)
+                samples = self.imu.decode_stream(self.assembler.buffer)
+            self.last_receive_time = self._receive_time()
+            return self.imu.create_sample(samples[-1])
+
+        # read all the incoming data in bulk, partial lines stay in the assembler for next time
+        self.assembler.read_available(self.ser)
+        lines = self.assembler.lines()
+
+        # make sure we have at least one finished line, wait for more data if needed
+        while len(lines) == 0:
+            self.assembler.read_from(self.ser)
+            lines = self.assembler.lines()
+        self.last_receive_time = self._receive_time()
+
+        # we analyze the "newest" line first for valid data
+        for string in reversed(lines):
             parsed_data = self.imu.parse_data(string)
             if parsed_data != None:
                 return parsed_data
@@ -52,8 +233,9 @@ class Parser:
         return None
 
     def cleanup(self) -> None:
+        self.stop_reader()
         self.ser.close()
 
 
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,677 @@
+"""
+Staged acquisition pipeline
+
+Reading, decoding, filtering, estimation and output run as stages, each on its own thread or
+process, connected by bounded queues of batches. A slow stage only backs up its own queue instead of
+stalling the serial reads. What happens when a queue is full is chosen per edge:
+
+    block         the producer waits for room, nothing is lost
+    drop_oldest   the oldest queued batch is thrown away and counted as dropped
+    coalesce      the new batch joins the newest queued one and is counted as coalesced, the
+                  consumer then takes everything queued as one batch
+
+A batch is a dict of arrays with one row per sample, keyed like the session columns ('time', 'raw',
+'filtered', 'quaternion'), so SessionWriter.append(**batch) stores it. The reader hands on
+{'data' : bytes, 'time' : receive time} instead.
+
+A stage is a callable that takes a batch and returns the batch for the next stage, or None to pass
+nothing on. The source is called without arguments, returns None when it has nothing yet and ends
+the stream by raising StopIteration or EndOfCapture. start() and close() methods of a stage are
+called on the stage's own thread or process, so files and devices can be opened there. Process
+stages and everything they hold must be picklable
+"""
+
+import queue
+import threading
+import time
+import multiprocessing
+from collections import deque
+
+import numpy as np
+
+from components.line_assembler import LineAssembler
+from components.replay import EndOfCapture
+from components.scheduler import FixedRateScheduler
+
+# Queue policies
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+_POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+# Shared metric slots per stage
+_BATCHES = 0
+_ITEMS_IN = 1
+_ITEMS_OUT = 2
+_BUSY = 3
+_LATENCY_SUM = 4
+_LATENCY_MAX = 5
+_STARTED = 6
+_STOPPED = 7
+_TICKS = 8
+_OVERRUNS = 9
+_SKIPPED = 10
+_LATE_SUM = 11
+_LATE_MAX = 12
+_METRIC_SLOTS = 13
+
+# How long a waiting stage sleeps before it looks at its queue again
+_POLL_TIMEOUT = 0.1
+
+
+"""
+Join batches in arrival order, arrays are stacked and bytes appended. Anything else (e.g. the
+receive time of a byte chunk) is taken from the newest batch
+"""
+def merge_batches(batches : list) -> dict:
+    if len(batches) == 1:
+        return batches[0]
+
+    merged = dict()
+    for key, value in batches[-1].items():
+        parts = [batch[key] for batch in batches if key in batch]
+        if isinstance(value, np.ndarray) and value.ndim > 0:
+            merged[key] = np.concatenate(parts)
+        elif isinstance(value, (bytes, bytearray)):
+            merged[key] = b''.join(parts)
+        else:
+            merged[key] = value
+    return merged
+
+# Queue items are (time the source produced it, batch), a merged item keeps the oldest time
+def _merge_items(items : list) -> tuple:
+    return min(created for created, _ in items), merge_batches([batch for _, batch in items])
+
+# Samples in a batch, bytes for a reader batch
+def _batch_length(batch : dict) -> int:
+    for value in batch.values():
+        if isinstance(value, (bytes, bytearray)) or (isinstance(value, np.ndarray) and value.ndim > 0):
+            return len(value)
+    return 1
+
+
+"""
+Bounded queue between two thread stages
+
+The producer calls put() and close() at the end of the stream, the consumer calls get() until
+finished is True, or cancel() to stop accepting anything. Queued items are kept in groups so
+coalescing only appends to a list, the group is merged once when it is taken
+"""
+class BatchQueue:
+
+    def __init__(self, maxsize : int = 16, policy : str = BLOCK) -> None:
+        if policy not in _POLICIES:
+            raise ValueError(f"unknown queue policy {policy}, use one of {_POLICIES}")
+        if maxsize <= 0:
+            raise ValueError("queue size must be positive")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self._groups = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._cancelled = False
+
+        # Counters
+        self.max_depth = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    """
+    Queue an item, returns False when the consumer has cancelled and the item was discarded
+    """
+    def put(self, item : tuple) -> bool:
+        with self._cond:
+            if self.policy == BLOCK:
+                while len(self._groups) >= self.maxsize and not self._cancelled:
+                    self._cond.wait()
+            if self._cancelled:
+                return False
+
+            if len(self._groups) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self.dropped += len(self._groups.popleft())
+                else:
+                    self._groups[-1].append(item)
+                    self.coalesced += 1
+                    self._cond.notify_all()
+                    return True
+
+            self._groups.append([item])
+            self.max_depth = max(self.max_depth, len(self._groups))
+            self._cond.notify_all()
+            return True
+
+    """
+    Oldest item, or with the coalesce policy everything queued merged into one. None when nothing
+    arrived within timeout or the stream has ended
+    """
+    def get(self, timeout : float = None):
+        with self._cond:
+            if len(self._groups) == 0 and not self._closed:
+                self._cond.wait(timeout)
+            if len(self._groups) == 0:
+                return None
+
+            if self.policy == COALESCE:
+                items = [item for group in self._groups for item in group]
+                self._groups.clear()
+            else:
+                items = self._groups.popleft()
+            self._cond.notify_all()
+
+        return _merge_items(items) if len(items) > 1 else items[0]
+
+    # Producer side, no more items will come
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    # Consumer side, discard everything queued and from now on
+    def cancel(self) -> None:
+        with self._cond:
+            self._cancelled = True
+            self._groups.clear()
+            self._cond.notify_all()
+
+    # Closed and everything taken
+    @property
+    def finished(self) -> bool:
+        with self._cond:
+            return self._closed and len(self._groups) == 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._groups)
+
+
+# Shared state slots of a ProcessBatchQueue
+_DEPTH = 0
+_MAX_DEPTH = 1
+_DROPPED = 2
+_COALESCED = 3
+_CANCELLED = 4
+
+"""
+Bounded queue for edges that cross a process boundary, same interface as BatchQueue
+
+Built on multiprocessing.Queue with the counters in shared memory. The end of the stream travels
+through the queue as None. With the coalesce policy a full queue makes the producer hold batches
+back and send them as one item with its next put
+"""
+class ProcessBatchQueue:
+
+    def __init__(self, maxsize : int = 16, policy : str = BLOCK) -> None:
+        if policy not in _POLICIES:
+            raise ValueError(f"unknown queue policy {policy}, use one of {_POLICIES}")
+        if maxsize <= 0:
+            raise ValueError("queue size must be positive")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self._queue = multiprocessing.Queue(maxsize)
+        self._state = multiprocessing.Array('q', 5)
+
+        # Local to the producer and the consumer process respectively
+        self._held = []
+        self._ended = False
+
+    def _count(self, slot : int, n : int = 1) -> None:
+        with self._state.get_lock():
+            self._state[slot] += n
+            if slot == _DEPTH:
+                self._state[_MAX_DEPTH] = max(self._state[_MAX_DEPTH], self._state[_DEPTH])
+
+    # Blocking put that gives up once the consumer cancels
+    def _put_blocking(self, item) -> bool:
+        while True:
+            if self._state[_CANCELLED]:
+                return False
+            try:
+                self._queue.put(item, timeout=_POLL_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+
+    def put(self, item : tuple) -> bool:
+        if self._state[_CANCELLED]:
+            return False
+
+        # Counted before it is sent so the consumer never sees a negative depth
+        if self.policy == BLOCK:
+            self._count(_DEPTH)
+            if not self._put_blocking(item):
+                self._count(_DEPTH, -1)
+                return False
+        elif self.policy == DROP_OLDEST:
+            self._count(_DEPTH)
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self._count(_DEPTH, -1)
+                        self._count(_DROPPED)
+                    except queue.Empty:
+                        pass
+        else:
+            self._held.append(item)
+            self._count(_DEPTH)
+            try:
+                self._queue.put_nowait(_merge_items(self._held))
+                self._held = []
+            except queue.Full:
+                self._count(_DEPTH, -1)
+                self._count(_COALESCED)
+        return True
+
+    def get(self, timeout : float = None):
+        if self._ended:
+            return None
+        try:
+            item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if item is None:
+            self._ended = True
+            return None
+        self._count(_DEPTH, -1)
+
+        if self.policy == COALESCE:
+            items = [item]
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._ended = True
+                    break
+                self._count(_DEPTH, -1)
+                items.append(item)
+            item = _merge_items(items) if len(items) > 1 else items[0]
+        return item
+
+    def close(self) -> None:
+        if len(self._held) > 0:
+            self._count(_DEPTH)
+            if not self._put_blocking(_merge_items(self._held)):
+                self._count(_DEPTH, -1)
+            self._held = []
+        self._put_blocking(None)
+
+    def cancel(self) -> None:
+        self._state[_CANCELLED] = 1
+        # Empty the queue so a producer stuck in put() gets going again
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+    @property
+    def finished(self) -> bool:
+        return self._ended
+
+    @property
+    def depth(self) -> int:
+        return max(0, self._state[_DEPTH])
+
+    @property
+    def max_depth(self) -> int:
+        return self._state[_MAX_DEPTH]
+
+    @property
+    def dropped(self) -> int:
+        return self._state[_DROPPED]
+
+    @property
+    def coalesced(self) -> int:
+        return self._state[_COALESCED]
+
+
+# Everything queued right now merged into one item, None if the queue is empty
+def _take_all(inbox):
+    items = []
+    while True:
+        item = inbox.get(timeout=0)
+        if item is None:
+            break
+        items.append(item)
+    if len(items) == 0:
+        return None
+    return _merge_items(items) if len(items) > 1 else items[0]
+
+def _record_schedule(metrics, scheduler : FixedRateScheduler) -> None:
+    metrics[_TICKS] = scheduler.ticks
+    metrics[_OVERRUNS] = scheduler.overruns
+    metrics[_SKIPPED] = scheduler.skipped
+    metrics[_LATE_SUM] = scheduler.late_sum
+    metrics[_LATE_MAX] = scheduler.late_max
+
+"""
+Body of every stage thread or process: take a batch, run the stage on it, pass the result on.
+With a rate the stage runs on a fixed rate schedule and takes everything queued on every tick
+"""
+def _run_stage(name : str, fn, inbox, outbox, metrics, stop_event, errors, rate : float = None) -> None:
+    start = getattr(fn, 'start', None)
+    close = getattr(fn, 'close', None)
+    scheduler = FixedRateScheduler(rate) if rate is not None else None
+    metrics[_STARTED] = time.perf_counter()
+
+    try:
+        if start is not None:
+            start()
+
+        while True:
+            if scheduler is not None:
+                scheduler.wait()
+                _record_schedule(metrics, scheduler)
+
+            if inbox is None:
+                if stop_event.is_set():
+                    break
+                created = begin = time.perf_counter()
+                try:
+                    batch = fn()
+                except (StopIteration, EndOfCapture):
+                    break
+                items_in = 0
+            else:
+                item = inbox.get(timeout=_POLL_TIMEOUT) if scheduler is None else _take_all(inbox)
+                if item is None:
+                    if inbox.finished:
+                        break
+                    continue
+                created, batch = item
+                items_in = _batch_length(batch)
+                begin = time.perf_counter()
+                batch = fn(batch)
+
+            end = time.perf_counter()
+            if batch is None and items_in == 0:
+                continue
+
+            latency = end - created
+            metrics[_BATCHES] += 1
+            metrics[_ITEMS_IN] += items_in
+            metrics[_ITEMS_OUT] += _batch_length(batch) if batch is not None else 0
+            metrics[_BUSY] += end - begin
+            metrics[_LATENCY_SUM] += latency
+            metrics[_LATENCY_MAX] = max(metrics[_LATENCY_MAX], latency)
+
+            if batch is not None and outbox is not None:
+                outbox.put((created, batch))
+
+    except Exception as e:
+        errors.put((name, repr(e)))
+        stop_event.set()
+        if inbox is not None:
+            inbox.cancel()
+    finally:
+        try:
+            if close is not None:
+                close()
+        finally:
+            if outbox is not None:
+                outbox.close()
+            metrics[_STOPPED] = time.perf_counter()
+
+
+class _Stage:
+
+    def __init__(self, name : str, fn, process : bool, queue_size : int, policy : str, rate : float) -> None:
+        self.name = name
+        self.fn = fn
+        self.process = process
+        self.rate = rate
+        self.queue_size = queue_size
+        self.policy = policy
+        self.inbox = None
+        self.worker = None
+        self.metrics = multiprocessing.Array('d', _METRIC_SLOTS, lock=False)
+
+
+"""
+A linear chain of stages, the first one added is the source
+
+    pipeline = Pipeline()
+    pipeline.add_source('reader', SerialReader(parser.ser))
+    pipeline.add_stage('decode', Decoder(imu, sample_time=0.005))
+    pipeline.add_stage('filter', LowPass(rc), process=True)
+    pipeline.add_stage('output', plot, policy=COALESCE)
+    pipeline.start()
+
+queue_size and policy describe the queue into a stage. rate runs a stage on a FixedRateScheduler,
+e.g. to estimate at a fixed 200 Hz on whatever arrived since the last tick. Stages run until the
+source ends or stop() is called, then everything still queued is processed before the stages finish
+"""
+class Pipeline:
+
+    def __init__(self, name : str = 'pipeline') -> None:
+        self.name = name
+        self.stages = []
+        self._stop_event = multiprocessing.Event()
+        self._errors = multiprocessing.Queue()
+        self._error_list = []
+
+    def add_source(self, name : str, fn, process : bool = False, rate : float = None) -> None:
+        if len(self.stages) > 0:
+            raise RuntimeError("the source has to be the first stage")
+        self.stages.append(_Stage(name, fn, process, 0, BLOCK, rate))
+
+    def add_stage(self, name : str, fn, process : bool = False, queue_size : int = 16, policy : str = BLOCK,
+                rate : float = None) -> None:
+        if len(self.stages) == 0:
+            raise RuntimeError("add a source before the other stages")
+        if policy not in _POLICIES:
+            raise ValueError(f"unknown queue policy {policy}, use one of {_POLICIES}")
+        if any(stage.name == name for stage in self.stages):
+            raise ValueError(f"stage {name} already exists")
+        self.stages.append(_Stage(name, fn, process, queue_size, policy, rate))
+
+    def start(self) -> None:
+        # Edges that touch a process stage need a queue that crosses processes
+        for producer, consumer in zip(self.stages[:-1], self.stages[1:]):
+            queue_type = ProcessBatchQueue if producer.process or consumer.process else BatchQueue
+            consumer.inbox = queue_type(maxsize=consumer.queue_size, policy=consumer.policy)
+
+        self._stop_event.clear()
+        for i, stage in enumerate(self.stages):
+            outbox = self.stages[i + 1].inbox if i + 1 < len(self.stages) else None
+            args = (stage.name, stage.fn, stage.inbox, outbox, stage.metrics, self._stop_event, self._errors, stage.rate)
+            if stage.process:
+                stage.worker = multiprocessing.Process(target=_run_stage, args=args, name=f"{self.name} {stage.name}", daemon=True)
+            else:
+                stage.worker = threading.Thread(target=_run_stage, args=args, name=f"{self.name} {stage.name}", daemon=True)
+
+        # Start from the sink so nothing is queued before its consumer runs
+        for stage in reversed(self.stages):
+            stage.worker.start()
+
+    # Ask the source to stop, the other stages finish what is queued
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    # Wait for every stage to finish, returns False if timeout ran out first
+    def join(self, timeout : float = None) -> bool:
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        for stage in self.stages:
+            if stage.worker is None:
+                continue
+            remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            stage.worker.join(remaining)
+            if stage.worker.is_alive():
+                return False
+        return True
+
+    @property
+    def running(self) -> bool:
+        return any(stage.worker is not None and stage.worker.is_alive() for stage in self.stages)
+
+    # (stage name, error) for every stage that failed, a failing stage stops the whole pipeline
+    @property
+    def errors(self) -> list:
+        while True:
+            try:
+                self._error_list.append(self._errors.get_nowait())
+            except queue.Empty:
+                break
+        return list(self._error_list)
+
+    """
+    Per stage counters: batches, items in and out (bytes for the reader, samples otherwise), items
+    per second put out (taken in for sinks), fraction of the time busy (for the source that includes
+    waiting for data), mean and max latency since the source produced the data, and depth, peak
+    depth, dropped and coalesced batches of the queue into the stage. Stages with a rate also report
+    ticks, overruns, skipped ticks and mean and max jitter
+    """
+    def metrics(self) -> dict:
+        now = time.perf_counter()
+        report = dict()
+        for stage in self.stages:
+            m = stage.metrics
+            elapsed = ((m[_STOPPED] or now) - m[_STARTED]) if m[_STARTED] > 0 else 0.0
+            batches = int(m[_BATCHES])
+            processed = m[_ITEMS_OUT] if m[_ITEMS_OUT] > 0 else m[_ITEMS_IN]
+            report[stage.name] = {
+                'batches' : batches,
+                'items_in' : int(m[_ITEMS_IN]),
+                'items_out' : int(m[_ITEMS_OUT]),
+                'items_per_s' : processed / elapsed if elapsed > 0 else 0.0,
+                'busy' : m[_BUSY] / elapsed if elapsed > 0 else 0.0,
+                'latency_ms' : m[_LATENCY_SUM] / batches * 1000 if batches > 0 else 0.0,
+                'latency_max_ms' : m[_LATENCY_MAX] * 1000,
+                'queue_depth' : stage.inbox.depth if stage.inbox is not None else 0,
+                'queue_max_depth' : stage.inbox.max_depth if stage.inbox is not None else 0,
+                'dropped' : stage.inbox.dropped if stage.inbox is not None else 0,
+                'coalesced' : stage.inbox.coalesced if stage.inbox is not None else 0,
+            }
+            if stage.rate is not None:
+                ticks = int(m[_TICKS])
+                report[stage.name].update({
+                    'rate' : stage.rate,
+                    'ticks' : ticks,
+                    'overruns' : int(m[_OVERRUNS]),
+                    'skipped' : int(m[_SKIPPED]),
+                    'jitter_ms' : m[_LATE_SUM] / ticks * 1000 if ticks > 0 else 0.0,
+                    'jitter_max_ms' : m[_LATE_MAX] * 1000,
+                })
+        return report
+
+    # metrics() as a table
+    def report(self) -> str:
+        metrics = self.metrics()
+        lines = [f"{'stage':>10} {'batches':>8} {'items/s':>10} {'busy':>6} {'lat ms':>8} {'max ms':>8} {'queue':>7} {'dropped':>8} {'merged':>7}"]
+        for name, m in metrics.items():
+            lines.append(f"{name:>10} {m['batches']:>8} {m['items_per_s']:>10.0f} {m['busy']:>6.0%} {m['latency_ms']:>8.2f} "
+                        f"{m['latency_max_ms']:>8.2f} {m['queue_depth']:>3}/{m['queue_max_depth']:<3} {m['dropped']:>8} {m['coalesced']:>7}")
+        for name, m in metrics.items():
+            if 'rate' in m:
+                lines.append(f"{name} at {m['rate']:g} Hz: {m['ticks']} ticks, {m['overruns']} overruns, {m['skipped']} skipped, "
+                            f"jitter {m['jitter_ms']:.2f} ms mean, {m['jitter_max_ms']:.2f} ms max")
+        return '\n'.join(lines)
+
+
+"""
+Source stage: whatever bytes a serial style port has waiting, with their host receive time
+(replays report the recorded time). The port timeout keeps the stage responsive to stop()
+"""
+class SerialReader:
+
+    def __init__(self, ser, chunk_size : int = 65536, timeout : float = 0.1) -> None:
+        self.ser = ser
+        self.ser.timeout = timeout
+        self._chunk = bytearray(chunk_size)
+        self._chunk_view = memoryview(self._chunk)
+
+    def __call__(self):
+        n = min(max(1, self.ser.in_waiting), len(self._chunk))
+        got = self.ser.readinto(self._chunk_view[:n])
+        if not got:
+            return None
+
+        receive_time = getattr(self.ser, 'receive_time', None)
+        return {'data' : bytes(self._chunk_view[:got]), 'time' : receive_time if receive_time is not None else time.time()}
+
+
+"""
+Turn byte chunks into {'time', 'raw'} sample batches with the wire format of imu
+
+A chunk holds every sample that arrived since the last read, so they all share one receive time.
+With sample_time the samples are stepped back from it at that period, the newest one getting the
+receive time, and squeezed in after the previous chunk where they would overlap it, so times always
+increase. Without it every sample gets the receive time of its chunk
+"""
+class Decoder:
+
+    def __init__(self, imu, sample_time : float = None) -> None:
+        self.imu = imu
+        self.sample_time = sample_time
+        self.assembler = LineAssembler()
+        self.rejected_lines = 0
+        self._last_time = None
+
+    def __call__(self, batch : dict):
+        self.assembler.feed(batch['data'])
+        if self.imu.framing == 'binary':
+            samples = self.imu.decode_stream(self.assembler.buffer)
+        else:
+            lines = [line for line in self.assembler.lines() if len(line) > 0]
+            samples = self.imu.parse_batch(lines)
+            self.rejected_lines += len(lines) - len(samples)
+
+        if len(samples) == 0:
+            return None
+        return {'time' : self._sample_times(len(samples), batch['time']), 'raw' : samples}
+
+    def _sample_times(self, n : int, receive_time : float) -> np.ndarray:
+        if self.sample_time is None:
+            return np.full(n, receive_time, dtype=np.float64)
+
+        times = receive_time - self.sample_time * np.arange(n - 1, -1, -1, dtype=np.float64)
+        if self._last_time is not None and times[0] <= self._last_time:
+            if receive_time > self._last_time:
+                times = self._last_time + (receive_time - self._last_time) * np.arange(1, n + 1) / n
+            else:
+                # Same or older receive time (a chunk from the same record, a clock step), carry on at the sample period
+                times = self._last_time + self.sample_time * np.arange(1, n + 1)
+        self._last_time = times[-1]
+        return times
+
+
+# Adds the low pass filtered samples as 'filtered'
+class LowPass:
+
+    def __init__(self, filter) -> None:
+        self.filter = filter
+
+    def __call__(self, batch : dict) -> dict:
+        batch['filtered'] = self.filter.filter_chunk(batch['raw'])
+        return batch
+
+
+"""
+Adds the attitude of every filtered sample as 'quaternion'. Without dt the sample times are used.
+adjust_mag corrects the magnetometer columns, e.g. ICM20948.adjust_mag
+"""
+class Estimate:
+
+    def __init__(self, estimator, dt : float = None, adjust_mag=None) -> None:
+        self.estimator = estimator
+        self.dt = dt
+        self.adjust_mag = adjust_mag
+
+    def __call__(self, batch : dict) -> dict:
+        filtered = batch['filtered']
+        mag = filtered[:, 6:9] if self.adjust_mag is None else self.adjust_mag(filtered[:, 6:9])
+        batch['quaternion'] = self.estimator.estimate_batch(accel_data=filtered[:, 0:3], mag_data=mag, gyro_data=filtered[:, 3:6],
+                                                            dt=self.dt, timestamps=batch['time'] if self.dt is None else None)
+        return batch
+
+
+if __name__ == '__main__':
+    pass
@@ -4,57 +4,239 @@ Plot data in 2D quickly in real time
 This was hard
 """
 
-import collections
 import numpy as np
-from multiprocessing import Process, Queue
+from multiprocessing import Process
 from functools import partial
-from PyQt5.QtWidgets import QApplication
-from pyqtgraph.Qt import QtCore
-import pyqtgraph as pg
+from components.shm_transport import SharedRing
+
+# Qt is only imported by the render process, the side calling plot() never needs it
+pg = None
+QtCore = None
+QApplication = None
+
+
+def _load_qt() -> None:
+    global pg, QtCore, QApplication
+    if pg is not None:
+        return
+    from PyQt5.QtWidgets import QApplication
+    from pyqtgraph.Qt import QtCore
+    import pyqtgraph as pg
+
+
+# Dict of line -> value (or array of values) to a (k, num_lines) block
+def _rows_from_dict(data : dict, lines : list) -> np.ndarray:
+    return np.column_stack([np.atleast_1d(np.asarray(data[line], dtype=np.float64)) for line in lines])
 
 
 """
-Plot data in real time using Qt framework
+Multi-resolution min/max buffer for line plots
+
+Level 0 holds the raw samples, every level above holds the min and max of factor buckets of the
+level below, so a bucket on level l spans factor**l samples. Lower levels are capped at max_buckets
+and only reach back as far as that allows, the top level covers the whole window. New samples are
+carried up all levels at once with reshape and min/max, the incomplete bucket of each level waits in
+a small pending array until it fills up. Levels are added until the whole window fits in
+min_buckets buckets.
 
-Data comes from queue filled by parent task
+Drawing picks the finest level that fits the visible span into the available pixel columns, so the
+number of points per frame is bounded no matter how long the window is, and a single sample spike
+still shows up as the max of its bucket
 """
-class _DynamicPlotter():
+class _MinMaxPyramid():
 
-    def __init__(self, data_queue : Queue, plot_name : str, xlabel : str, ylabel : str, lines : list,
-                line_colors : list, sampleinterval=0.0416, timewindow=5, size=(600,350)):
-        # Figure out intervals and number of points
-        self._interval = int(sampleinterval*1000)
-        self._bufsize = int(timewindow/sampleinterval)
+    def __init__(self, num_lines : int, window : int, factor : int = 4, max_buckets : int = 8192, min_buckets : int = 256):
+        self.num_lines = num_lines
+        self.factor = factor
+
+        self.capacities = []
+        buckets = max(1, window)
+        while True:
+            self.capacities.append(min(buckets, max_buckets) + 1)
+            if buckets <= min_buckets:
+                break
+            buckets = -(-buckets // factor)
+
+        num_levels = len(self.capacities)
+        # Level 0 min and max are the samples themselves, both names point to the same array
+        self.mins = [np.zeros((cap, num_lines)) for cap in self.capacities]
+        self.maxs = [self.mins[0]] + [np.zeros((cap, num_lines)) for cap in self.capacities[1:]]
+        self.counts = [0] * num_levels
+        self.pending_min = [np.empty((0, num_lines)) for _ in range(num_levels)]
+        self.pending_max = [np.empty((0, num_lines)) for _ in range(num_levels)]
+
+    # Samples pushed so far
+    @property
+    def total(self) -> int:
+        return self.counts[0]
+
+    def _append(self, level : int, mins : np.ndarray, maxs : np.ndarray) -> None:
+        cap = self.capacities[level]
+        k = len(mins)
+        keep = min(k, cap)
+        idx = (self.counts[level] + k - keep + np.arange(keep)) % cap
+        self.mins[level][idx] = mins[-keep:]
+        if level > 0:
+            self.maxs[level][idx] = maxs[-keep:]
+        self.counts[level] += k
+
+    # Add a (k, num_lines) block of samples
+    def push(self, block : np.ndarray) -> None:
+        block = np.asarray(block, dtype=np.float64).reshape(-1, self.num_lines)
+        if len(block) == 0:
+            return
+        self._append(0, block, block)
+
+        mins = maxs = block
+        for level in range(1, len(self.capacities)):
+            mins = np.concatenate((self.pending_min[level], mins))
+            maxs = np.concatenate((self.pending_max[level], maxs))
+            groups = len(mins) // self.factor
+            done = groups * self.factor
+            self.pending_min[level] = mins[done:]
+            self.pending_max[level] = maxs[done:]
+            if groups == 0:
+                break
+
+            mins = mins[:done].reshape(groups, self.factor, self.num_lines).min(axis=1)
+            maxs = maxs[:done].reshape(groups, self.factor, self.num_lines).max(axis=1)
+            self._append(level, mins, maxs)
+
+    # Min and max of the incomplete bucket of a level, None while it is empty
+    def _open_bucket(self, level : int):
+        if level == 0:
+            return None
+        mins = self.pending_min[level]
+        maxs = self.pending_max[level]
+        below = self._open_bucket(level - 1)
+        if below is not None:
+            mins = np.concatenate((mins, below[0][np.newaxis, :]))
+            maxs = np.concatenate((maxs, below[1][np.newaxis, :]))
+        if len(mins) == 0:
+            return None
+        return mins.min(axis=0), maxs.max(axis=0)
+
+    """
+    Buckets covering samples [start, end) using at most max_points buckets
+
+    Returns the level used, the first sample of every bucket and (n, num_lines) min and max arrays
+    """
+    def select(self, start : int, end : int, max_points : int):
+        start = max(0, start)
+        end = min(self.total, end)
+
+        # Finest level with few enough buckets that still reaches back to start
+        level = len(self.capacities) - 1
+        for candidate in range(len(self.capacities)):
+            size = self.factor ** candidate
+            oldest = max(0, self.counts[candidate] - self.capacities[candidate]) * size
+            if (end - start) / size <= max_points and oldest <= start:
+                level = candidate
+                break
+
+        size = self.factor ** level
+        cap = self.capacities[level]
+        count = self.counts[level]
+        first = max(start // size, count - cap)
+        last = min(count, -(-end // size))
+        idx = np.arange(first, max(first, last)) % cap
+        positions = np.arange(first, max(first, last)) * size
+        mins = self.mins[level][idx]
+        maxs = self.maxs[level][idx]
+
+        # The newest samples are still in the incomplete bucket
+        open_bucket = self._open_bucket(level)
+        if open_bucket is not None and end > count * size:
+            positions = np.append(positions, count * size)
+            mins = np.concatenate((mins, open_bucket[0][np.newaxis, :]))
+            maxs = np.concatenate((maxs, open_bucket[1][np.newaxis, :]))
+        return level, positions, mins, maxs
+
+
+"""
+Line plot panel, holds the sample buffers and curves for one plot widget
+
+Used on its own by _DynamicPlotter or as one of many panels in a Dashboard. Samples are kept in a
+_MinMaxPyramid so long windows draw at most two points per pixel column. Zooming in with the mouse
+switches to finer levels, down to the raw samples
+"""
+class _Plot2DPanel():
+
+    def __init__(self, plot_name : str, xlabel : str, ylabel : str, lines : list, line_colors : list,
+                sampleinterval=0.0416, timewindow=5, size=(600,350), sample_rate=None):
+        _load_qt()
+        # Figure out number of points, without a sample rate we assume one sample per frame
+        if sample_rate is None:
+            sample_rate = 1/sampleinterval
+        self.sample_rate = sample_rate
+        self.timewindow = timewindow
 
-        # Use dictionaries to hold each lines data, TODO: should allow index by name
         self.line_colors = line_colors
-        self.buffer_dict = dict()
         self.curve_dict = dict()
         self.num_lines = len(lines)
         self.lines = lines
 
-        # Init each line seperately
-        for line in lines:
-            self.buffer_dict[line] = collections.deque([0.0]*self._bufsize, self._bufsize)
+        self.pyramid = _MinMaxPyramid(num_lines=self.num_lines, window=int(timewindow*sample_rate))
 
-        # used for initialization of plot window
-        self.x = np.linspace(-timewindow, 0.0, self._bufsize)
-        self.y = np.zeros(self._bufsize, dtype=np.float64)
-        self.data_queue = data_queue
-        # Set graph configuration options
-        pg.setConfigOptions(antialias=False)
-        self.app = QApplication([])
-        self.plt = pg.plot(title=plot_name, color='b')
-        self.plt.resize(*size)
-        self.plt.showGrid(x=True, y=True)
-        self.plt.setLabel('left', ylabel)
-        self.plt.setLabel('bottom', xlabel)
-        self.plt.addLegend()
+        self.widget = pg.PlotWidget(title=plot_name)
+        self.widget.resize(*size)
+        self.widget.showGrid(x=True, y=True)
+        self.widget.setLabel('left', ylabel)
+        self.widget.setLabel('bottom', xlabel)
+        self.widget.addLegend()
+
+        # Time axis is fixed to the window (until the user zooms), only y follows the data
+        self.widget.setXRange(-timewindow, 0, padding=0)
+        self.widget.enableAutoRange(axis='y')
 
         # Plot each line with each associated color
         for line in lines:
             line_ind = lines.index(line)
-            self.curve_dict[line] = self.plt.plot(self.x, self.y, pen=(line_colors[line_ind]), name=line)
+            self.curve_dict[line] = self.widget.plot([], [], pen=(line_colors[line_ind]), name=line)
+
+    # Add a (k, num_lines) block of samples
+    def push(self, block : np.ndarray):
+        self.pyramid.push(block)
+
+    def redraw(self):
+        # Visible part of the time axis in samples, time 0 is the newest sample
+        total = self.pyramid.total
+        t_min, t_max = self.widget.getViewBox().viewRange()[0]
+        start = total + int(np.floor(max(t_min, -self.timewindow) * self.sample_rate))
+        end = total + int(np.ceil(t_max * self.sample_rate)) + 1
+        pixels = max(1, self.widget.width())
+
+        level, positions, mins, maxs = self.pyramid.select(start, end, pixels)
+        times = (positions - total) / self.sample_rate
+
+        for row, line in enumerate(self.lines):
+            if level == 0:
+                self.curve_dict[line].setData(times, mins[:, row])
+            else:
+                # Every bucket is drawn as a vertical stroke from its min to its max
+                self.curve_dict[line].setData(np.repeat(times, 2), np.column_stack((mins[:, row], maxs[:, row])).ravel())
+
+
+"""
+Plot data in real time using Qt framework
+
+Data comes from shared memory ring filled by parent task
+"""
+class _DynamicPlotter():
+
+    def __init__(self, ring_spec : tuple, plot_name : str, xlabel : str, ylabel : str, lines : list,
+                line_colors : list, sampleinterval=0.0416, timewindow=5, size=(600,350), sample_rate=None):
+        _load_qt()
+        # Figure out intervals
+        self._interval = int(sampleinterval*1000)
+        self.ring = SharedRing.attach(*ring_spec)
+
+        # Set graph configuration options
+        pg.setConfigOptions(antialias=False)
+        self.app = QApplication([])
+        self.panel = _Plot2DPanel(plot_name=plot_name, xlabel=xlabel, ylabel=ylabel, lines=lines, line_colors=line_colors,
+                                sampleinterval=sampleinterval, timewindow=timewindow, size=size, sample_rate=sample_rate)
+        self.panel.widget.show()
 
         # QTimer
         self.timer = QtCore.QTimer()
@@ -62,17 +244,13 @@ class _DynamicPlotter():
         self.timer.start(self._interval)
 
     def updateplot(self):
-        try :
-            new_item = self.data_queue.get(block=False)
-            for line in self.lines:
-                self.buffer_dict[line].append(new_item[line])
-                self.curve_dict[line].setData(self.x, self.buffer_dict[line])
-            self.app.processEvents()
-        except:
-            # queue is empty, don't update data
-            for line in self.lines:
-                self.curve_dict[line].setData(self.x, self.buffer_dict[line])
-            self.app.processEvents()
+        # every sample written since the last frame
+        block = self.ring.read_all()
+        if len(block) > 0:
+            self.panel.push(block)
+
+        self.panel.redraw()
+        self.app.processEvents()
 
     def run(self):
         self.app.exec_()
@@ -80,12 +258,12 @@ class _DynamicPlotter():
 """
 Helper to create and run a dynamic plotter in a new process
 """
-def run_plotter(data_queue : Queue, plot_name : str, xlabel : str, ylabel : str, lines : list, line_colors : list,
-                sample_period : float):
+def run_plotter(ring_spec : tuple, plot_name : str, xlabel : str, ylabel : str, lines : list, line_colors : list,
+                sample_period : float, sample_rate : float, timewindow : float):
 
     # create plot
-    p = _DynamicPlotter(data_queue=data_queue, plot_name=plot_name, xlabel=xlabel, ylabel=ylabel, lines=lines,
-                        line_colors=line_colors, sampleinterval=sample_period)
+    p = _DynamicPlotter(ring_spec=ring_spec, plot_name=plot_name, xlabel=xlabel, ylabel=ylabel, lines=lines,
+                        line_colors=line_colors, sampleinterval=sample_period, timewindow=timewindow, sample_rate=sample_rate)
     p.run()
 
 
@@ -96,20 +274,34 @@ TODO: Log data and maybe generate static graph when done
 '''
 class Plotter2D:
 
-    def __init__(self, name : str, xlabel : str, ylabel : str, lines : list, line_colors : list, fps : int):
+    """
+    sample_rate is the rate plot() is called at, leave it out when plotting one sample per frame.
+    Every sample is drawn, buffer_size bounds how many can wait between frames
+    """
+    def __init__(self, name : str, xlabel : str, ylabel : str, lines : list, line_colors : list, fps : int,
+                sample_rate : float = None, timewindow : float = 5, buffer_size : int = 16384):
 
         # Setup child process with realtime plotter
         sample_period = float(1/fps)
-        self.q = Queue(maxsize=1)
-        self.p = Process(target=run_plotter, args=(self.q, name, xlabel, ylabel, lines, line_colors, sample_period,))
+        self.lines = lines
+        self.ring = SharedRing(width=len(lines), capacity=buffer_size)
+        self.p = Process(target=run_plotter, args=(self.ring.spec(), name, xlabel, ylabel, lines, line_colors, sample_period,
+                                                    sample_rate, timewindow,))
         self.p.start()
 
-    # Try and stick item into the queue, if its full, that is ok, we can just ignore it for now
+    # Copy the values (single values or arrays of samples) for every line into shared memory
     def plot(self, data : dict):
-        try:
-            self.q.put(data, block = False)
-        except:
-            pass
+        self.ring.write(_rows_from_dict(data, self.lines))
+
+    # Samples overwritten before the plotter got to them
+    @property
+    def dropped(self) -> int:
+        return self.ring.dropped
+
+    def close(self) -> None:
+        self.p.terminate()
+        self.p.join()
+        self.ring.close()
 
 
 if __name__ == '__main__':
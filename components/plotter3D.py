@@ -5,28 +5,71 @@ This was hard
 """
 
 import numpy as np
-from multiprocessing import Process, Queue
+from multiprocessing import Process
 from functools import partial
-from PyQt5.QtWidgets import QApplication
-import pyqtgraph.opengl as gl
-from pyqtgraph.Qt import QtCore
-import pyqtgraph as pg
+from components.rotation import RotationMatrix, quat_normalize_array, quat_to_matrix_array
+from components.shm_transport import SharedRing
+
+# Qt is only imported by the render process, the side calling plot() never needs it
+gl = None
+QtCore = None
+QtGui = None
+QApplication = None
+
+
+def _load_qt() -> None:
+    global gl, QtCore, QtGui, QApplication
+    if gl is not None:
+        return
+    from PyQt5.QtWidgets import QApplication
+    import pyqtgraph.opengl as gl
+    from pyqtgraph.Qt import QtCore, QtGui
+
+
+# RotationMatrix (kept for older callers) or (w, x, y, z) quaternion to a (1, 4) record
+def _quaternion_row(data) -> np.ndarray:
+    if isinstance(data, RotationMatrix):
+        data = data.get_quaternion()
+    return np.asarray(data, dtype=np.float64).reshape(1, 4)
 
 
 """
-Plot data in real time using Qt framework
+Minimal Wavefront .obj reader, vertices and faces only. Polygons are split into triangle fans
+"""
+def _load_obj(path : str):
+    vertices = []
+    faces = []
+    with open(path, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == 'v':
+                vertices.append([float(value) for value in parts[1:4]])
+            elif parts[0] == 'f':
+                # Entries look like v, v/vt, v//vn or v/vt/vn, indices start at 1 and can be negative
+                indices = [int(part.split('/')[0]) for part in parts[1:]]
+                indices = [index - 1 if index > 0 else len(vertices) + index for index in indices]
+                for i in range(1, len(indices) - 1):
+                    faces.append([indices[0], indices[i], indices[i + 1]])
+    return np.array(vertices, dtype=np.float32), np.array(faces, dtype=np.int32)
+
 
-Data comes from queue filled by parent task
 """
-class _DynamicPlotter():
+Attitude panel, axes of the body frame drawn inside fixed world frame grids
 
-    def __init__(self, data_queue : Queue, plot_name : str, sampleinterval=0.0416):
-        # Figure out intervals and number of points
-        self._interval = int(sampleinterval*1000)
-        self.app = QApplication([])
+Used on its own by _DynamicPlotter or as one of many panels in a Dashboard
+"""
+class _Plot3DPanel():
+
+    """
+    mesh is an optional .obj file drawn with the body axes, scaled by mesh_scale. trail is the number of
+    past attitudes to draw as a fading line, 0 for none
+    """
+    def __init__(self, plot_name : str, mesh : str = None, mesh_scale : float = 1.0, trail : int = 0):
+        _load_qt()
         self.view = gl.GLViewWidget()
-
-        self.data_queue = data_queue
+        self.widget = self.view
         self.plot_name = plot_name
 
         self.view.opts['distance'] = 20
@@ -74,15 +117,85 @@ class _DynamicPlotter():
         sh4 = gl.GLLinePlotItem(pos=pts_z, width=2, antialias=False, color='b')
         self.view.addItem(sh4)
 
-        # Create moving object
-        self.x_vec = gl.GLLinePlotItem(pos=pts_x, width=1, antialias=False, color='r')
-        self.y_vec = gl.GLLinePlotItem(pos=pts_y, width=1, antialias=False, color='g')
-        self.z_vec = gl.GLLinePlotItem(pos=pts_z, width=1, antialias=False, color='b')
-        self.view.addItem(self.x_vec)
-        self.view.addItem(self.y_vec)
-        self.view.addItem(self.z_vec)
+        # Body frame object, built once and only moved by its transform. Axes point along
+        # [1,0,0], [0,-1,0] and [0,0,-1] of the body frame
+        body_x = np.array([self.center, (1,0,0)])
+        body_y = np.array([self.center, (0,-1,0)])
+        body_z = np.array([self.center, (0,0,-1)])
+        self.body = [
+            gl.GLLinePlotItem(pos=body_x, width=1, antialias=False, color='r'),
+            gl.GLLinePlotItem(pos=body_y, width=1, antialias=False, color='g'),
+            gl.GLLinePlotItem(pos=body_z, width=1, antialias=False, color='b'),
+        ]
+        if mesh is not None:
+            vertices, faces = _load_obj(mesh)
+            self.body.append(gl.GLMeshItem(vertexes=vertices * mesh_scale, faces=faces, smooth=False, shader='shaded',
+                                        color=(0.7, 0.7, 0.7, 1)))
+        for item in self.body:
+            self.view.addItem(item)
+
+        # Optional trail of where the body x axis pointed, kept in a ring written twice (at i and
+        # i + trail) so the newest points are always one contiguous view, oldest faded out
+        self.trail = None
+        if trail > 0:
+            self.trail = trail
+            self.trail_points = np.zeros((2*trail, 3), dtype=np.float32)
+            self.trail_colors = np.ones((trail, 4), dtype=np.float32)
+            self.trail_colors[:, 3] = np.linspace(0, 1, trail)
+            self.trail_index = 0
+            self.trail_count = 0
+            self.trail_item = gl.GLLinePlotItem(pos=self.trail_points[:1], width=1, antialias=False, color=(1, 1, 0, 1),
+                                                mode='line_strip')
+            self.view.addItem(self.trail_item)
+
+    # Show the newest of a (k, 4) block of quaternions, older ones only extend the trail
+    def push(self, block : np.ndarray):
+        if len(block) == 0:
+            return
+        matrices = quat_to_matrix_array(quat_normalize_array(block))
+
+        # Rotation as a model transform, QMatrix4x4 takes its values row by row
+        rotation = np.eye(4)
+        rotation[:3, :3] = matrices[-1]
+        transform = QtGui.QMatrix4x4(*rotation.ravel().tolist())
+        for item in self.body:
+            item.setTransform(transform)
+
+        if self.trail is not None:
+            # Body x axis in the world frame is the first matrix column
+            tips = matrices[-self.trail:, :, 0]
+            k = len(tips)
+            idx = (self.trail_index + np.arange(k)) % self.trail
+            self.trail_points[idx] = tips
+            self.trail_points[idx + self.trail] = tips
+            self.trail_index = (self.trail_index + k) % self.trail
+            self.trail_count = min(self.trail, self.trail_count + k)
+
+    def redraw(self):
+        if self.trail is None or self.trail_count < 2:
+            return
+        # Newest trail_count points in time order
+        end = self.trail_index + self.trail
+        self.trail_item.setData(pos=self.trail_points[end - self.trail_count:end],
+                                color=self.trail_colors[self.trail - self.trail_count:])
 
-        self.view.show()
+
+"""
+Plot data in real time using Qt framework
+
+Data comes from a shared memory ring of quaternions filled by parent task
+"""
+class _DynamicPlotter():
+
+    def __init__(self, ring_spec : tuple, plot_name : str, sampleinterval=0.0416, **panel_options):
+        _load_qt()
+        # Figure out intervals and number of points
+        self._interval = int(sampleinterval*1000)
+        self.ring = SharedRing.attach(*ring_spec)
+
+        self.app = QApplication([])
+        self.panel = _Plot3DPanel(plot_name=plot_name, **panel_options)
+        self.panel.view.show()
 
         # QTimer
         self.timer = QtCore.QTimer()
@@ -90,25 +203,16 @@ class _DynamicPlotter():
         self.timer.start(self._interval)
 
     def updateplot(self):
-        try :
-            new_item = self.data_queue.get(block=False)
-
-            # Calculate new vectors from elementary X, Y and Z vectors
-            xvec_new = tuple(new_item.calc_vec(np.array([1,0,0])))
-            yvec_new = tuple(new_item.calc_vec(np.array([0,-1,0])))
-            zvec_new = tuple(new_item.calc_vec(np.array([0,0,-1])))
+        # Without a trail only the newest attitude matters
+        if self.panel.trail is not None:
+            self.panel.push(self.ring.read_all())
+        else:
+            latest = self.ring.latest()
+            if latest is not None:
+                self.panel.push(latest[np.newaxis, :])
 
-            pts_x = np.array([self.center, xvec_new])
-            pts_y = np.array([self.center, yvec_new])
-            pts_z = np.array([self.center, zvec_new])
-
-            self.x_vec.setData(pos=pts_x, width=1, color='r')
-            self.y_vec.setData(pos=pts_y, width=1, antialias=False, color='g')
-            self.z_vec.setData(pos=pts_z, width=1, antialias=False, color='b')
-
-            self.app.processEvents()
-        except:
-            self.app.processEvents()
+        self.panel.redraw()
+        self.app.processEvents()
 
     def run(self):
         self.app.exec_()
@@ -116,10 +220,10 @@ class _DynamicPlotter():
 """
 Helper to create and run a dynamic plotter in a new process
 """
-def run_plotter(data_queue : Queue, plot_name : str, sample_period : float):
+def run_plotter(ring_spec : tuple, plot_name : str, sample_period : float, panel_options : dict):
 
     # create plot
-    p = _DynamicPlotter(data_queue=data_queue, plot_name=plot_name, sampleinterval=sample_period)
+    p = _DynamicPlotter(ring_spec=ring_spec, plot_name=plot_name, sampleinterval=sample_period, **panel_options)
     p.run()
 
 
@@ -130,20 +234,27 @@ TODO: Log data and maybe generate static graph when done
 '''
 class Plotter3D:
 
-    def __init__(self, name : str, fps : int):
+    """
+    mesh is an optional .obj model to draw with the body axes, trail the number of past attitudes to keep
+    on screen as a fading line
+    """
+    def __init__(self, name : str, fps : int, mesh : str = None, mesh_scale : float = 1.0, trail : int = 0):
 
         # Setup child process with realtime plotter
         sample_period = float(1/fps)
-        self.q = Queue(maxsize=1)
-        self.p = Process(target=run_plotter, args=(self.q, name, sample_period,))
+        self.ring = SharedRing(width=4, capacity=max(16, 2*trail))
+        panel_options = dict(mesh=mesh, mesh_scale=mesh_scale, trail=trail)
+        self.p = Process(target=run_plotter, args=(self.ring.spec(), name, sample_period, panel_options,))
         self.p.start()
 
-    # Try and stick item into the queue, if its full, that is ok, we can just ignore it for now
-    def plot(self, data : dict):
-        try:
-            self.q.put(data, block = False)
-        except:
-            pass
+    # Copy the attitude quaternion (w, x, y, z) into shared memory, a RotationMatrix works as well
+    def plot(self, data):
+        self.ring.write(_quaternion_row(data))
+
+    def close(self) -> None:
+        self.p.terminate()
+        self.p.join()
+        self.ring.close()
 
 
 if __name__ == '__main__':
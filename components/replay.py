@@ -0,0 +1,315 @@
+"""
+Record raw serial streams and replay them without hardware
+
+Capture file layout: the magic bytes followed by one record per chunk read from the port,
+each record is a little endian (float64 host receive time, uint32 length) header and the raw bytes.
+"""
+
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left, bisect_right
+
+import serial
+
+import components.IMU
+from components.parser import Parser
+
+CAPTURE_MAGIC = b'IMUCAP1\n'
+_RECORD_HEADER = struct.Struct('<dI')
+
+
+"""
+Raised by replay sources once every byte of the capture has been read
+"""
+class EndOfCapture(serial.serialutil.SerialException):
+    pass
+
+
+"""
+Write raw chunks and their receive time to a capture file
+"""
+class CaptureWriter:
+
+    def __init__(self, path : str) -> None:
+        self.file = open(path, 'wb')
+        self.file.write(CAPTURE_MAGIC)
+
+    def write(self, data, receive_time : float = None) -> None:
+        if len(data) == 0:
+            return
+        if receive_time is None:
+            receive_time = time.time()
+        self.file.write(_RECORD_HEADER.pack(receive_time, len(data)))
+        self.file.write(data)
+
+    def close(self) -> None:
+        self.file.close()
+
+"""
+Load a capture file, returns (receive times, end offset of every record, all bytes joined)
+"""
+def load_capture(path : str) -> tuple:
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    if raw[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise ValueError(f"{path} is not a serial capture file")
+
+    times = []
+    ends = []
+    chunks = []
+    total = 0
+    pos = len(CAPTURE_MAGIC)
+    while pos + _RECORD_HEADER.size <= len(raw):
+        receive_time, length = _RECORD_HEADER.unpack_from(raw, pos)
+        pos += _RECORD_HEADER.size
+        chunks.append(raw[pos:pos + length])
+        pos += length
+        total += length
+        times.append(receive_time)
+        ends.append(total)
+
+    return times, ends, b''.join(chunks)
+
+
+"""
+Wrap an open serial port and save every chunk read from it to a capture file
+"""
+class SerialRecorder:
+
+    def __init__(self, ser, path : str) -> None:
+        self.ser = ser
+        self.writer = CaptureWriter(path)
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    # Forwarded explicitly so that setting it reaches the real port
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, value) -> None:
+        self.ser.timeout = value
+
+    # Forwarded as well, the startup handshake resets the board through it
+    @property
+    def dtr(self):
+        return self.ser.dtr
+
+    @dtr.setter
+    def dtr(self, value) -> None:
+        self.ser.dtr = value
+
+    def read(self, size : int = 1) -> bytes:
+        data = self.ser.read(size)
+        self.writer.write(data)
+        return data
+
+    def readinto(self, b) -> int:
+        n = self.ser.readinto(b)
+        if n:
+            self.writer.write(bytes(b[:n]))
+        return n
+
+    def read_all(self) -> bytes:
+        data = self.ser.read_all()
+        self.writer.write(data)
+        return data
+
+    def close(self) -> None:
+        self.writer.close()
+        self.ser.close()
+
+
+"""
+Serial port stand in that plays back a capture
+
+speed=1 reproduces the original timing, speed=N runs N times faster and speed=0 hands out
+recorded chunks as soon as a read asks for them so the consumer runs as fast as it can.
+Once everything has been read, reads raise EndOfCapture
+"""
+class ReplaySerial:
+
+    def __init__(self, path : str, speed : float = 1.0, timeout : float = None) -> None:
+        self._receive_times, self._ends, self._data = load_capture(path)
+        self._times = [t - self._receive_times[0] for t in self._receive_times] if len(self._receive_times) > 0 else []
+        self.speed = speed
+        self.timeout = timeout
+        self.port = path
+        self.is_open = True
+
+        self._pos = 0
+        self._start = None
+
+    def open(self) -> None:
+        self.is_open = True
+
+    def close(self) -> None:
+        self.is_open = False
+
+    # Replay clock starts on first access so setup time does not eat into the capture
+    def _elapsed(self) -> float:
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now
+        return (now - self._start) * self.speed
+
+    # Offset of the end of the data released so far, a read of size bytes is pending
+    def _available_end(self, size : int = 1) -> int:
+        # As fast as possible, every record the read reaches into is there as soon as it is asked for
+        if not self.speed or self.speed <= 0:
+            current = bisect_left(self._ends, self._pos + max(size, 1))
+            return self._ends[current] if current < len(self._ends) else len(self._data)
+
+        released = bisect_right(self._times, self._elapsed())
+        return self._ends[released - 1] if released > 0 else 0
+
+    # Seconds until the next record is released
+    def _next_release(self) -> float:
+        if not self.speed or self.speed <= 0:
+            return 0.0
+        released = bisect_right(self._times, self._elapsed())
+        if released >= len(self._times):
+            return 0.0
+        return (self._times[released] - self._elapsed()) / self.speed
+
+    @property
+    def in_waiting(self) -> int:
+        return self._available_end() - self._pos
+
+    # Recorded host receive time of the last byte read, lets consumers reuse the original timing
+    @property
+    def receive_time(self) -> float:
+        if len(self._receive_times) == 0:
+            return None
+        record = min(bisect_right(self._ends, self._pos - 1), len(self._ends) - 1)
+        return self._receive_times[record]
+
+    @property
+    def finished(self) -> bool:
+        return self._pos >= len(self._data)
+
+    def read(self, size : int = 1) -> bytes:
+        if self.finished:
+            raise EndOfCapture(f"end of capture {self.port}")
+
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        while True:
+            end = self._available_end(size)
+            if end - self._pos >= size or end == len(self._data):
+                break
+
+            wait = self._next_release()
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                wait = min(wait, remaining)
+            time.sleep(max(wait, 0.0))
+
+        n = min(size, end - self._pos)
+        data = self._data[self._pos:self._pos + n]
+        self._pos += n
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def read_all(self) -> bytes:
+        return self.read(self.in_waiting) if self.in_waiting > 0 else b''
+
+
+"""
+Copy everything a serial style source produces into a local pseudo terminal so the regular serial
+code path can open it by name. The source needs in_waiting, read() and finished, and should have a
+short timeout so the writer notices when it is asked to stop
+"""
+class PtyBridge:
+
+    def __init__(self, source, name : str = "pty") -> None:
+        import tty # POSIX only
+
+        self.source = source
+        self.master, self.slave = os.openpty()
+
+        # No echo or newline translation, the bytes must arrive untouched
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+
+        self._stop_event = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, name=f"Pty bridge {name}", daemon=True)
+
+    def start(self) -> None:
+        self._writer.start()
+
+    def _write_loop(self) -> None:
+        while not self._stop_event.is_set() and not self.source.finished:
+            view = memoryview(self.source.read(max(1, self.source.in_waiting)))
+            try:
+                while len(view) > 0:
+                    view = view[os.write(self.master, view):]
+            except OSError:
+                # pty was closed underneath us
+                return
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        # Closing the pty also unblocks a writer stuck on a full buffer
+        os.close(self.master)
+        os.close(self.slave)
+        self._writer.join()
+
+
+"""
+Play a capture into a local pseudo terminal
+"""
+class PtyReplay(PtyBridge):
+
+    def __init__(self, path : str, speed : float = 1.0) -> None:
+        # Short timeout so the writer notices when it is asked to stop
+        super().__init__(ReplaySerial(path, speed=speed, timeout=0.1), name=f"replay {path}")
+
+
+"""
+Parser running off a capture file instead of a device, either read directly or through a pty
+"""
+class ReplayParser(Parser):
+
+    def __init__(self, imu : components.IMU, path : str, speed : float = 1.0, use_pty : bool = False,
+                threaded : bool = False, buffer_size : int = 4096) -> None:
+        self.pty = None
+        if use_pty:
+            self.pty = PtyReplay(path, speed=speed)
+            self.pty.start()
+            super().__init__(dev_name="replay", imu=imu, port=self.pty.port_name, baud=115200, threaded=threaded,
+                            buffer_size=buffer_size, ready_timeout=0)
+        else:
+            super().__init__(dev_name="replay", imu=imu, port=path, baud=0, threaded=threaded,
+                            buffer_size=buffer_size, ser=ReplaySerial(path, speed=speed))
+
+    def cleanup(self) -> None:
+        super().cleanup()
+        if self.pty is not None:
+            self.pty.stop()
+
+
+"""
+Create a Parser for a live port, optionally recording it, or a ReplayParser when replay is given.
+reset pulses DTR on a live port before waiting for the device
+"""
+def open_source(imu : components.IMU, port : str, baud : int, replay : str = None, speed : float = 1.0,
+                record : str = None, use_pty : bool = False, reset : bool = False, **kwargs) -> Parser:
+    if replay is not None:
+        return ReplayParser(imu=imu, path=replay, speed=speed, use_pty=use_pty, **kwargs)
+
+    return Parser(dev_name=port, imu=imu, port=port, baud=baud, reset=reset, record=record, **kwargs)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,105 @@
+"""
+Bounded ring buffer holding fixed width IMU samples
+"""
+
+import threading
+import numpy as np
+
+"""
+Thread safe ring buffer of fixed width sample vectors
+
+One thread pushes samples while another drains them at its own rate. When the buffer
+is full the oldest samples are overwritten and counted as overflows so the consumer
+knows data has been lost.
+"""
+class SampleRingBuffer:
+
+    def __init__(self, capacity : int, width : int, dtype=np.float64) -> None:
+        if capacity <= 0 or width <= 0:
+            raise ValueError("ring buffer capacity and width must be positive")
+
+        self.capacity = capacity
+        self.width = width
+        self.data = np.zeros((capacity, width), dtype=dtype)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+
+        # Index of the next slot to write and number of unread samples
+        self.head = 0
+        self.count = 0
+
+        # Counters
+        self.total_pushed = 0
+        self.overflow_count = 0
+
+        self.lock = threading.Lock()
+
+    # Add a single sample
+    def push(self, sample : np.ndarray, timestamp : float = 0.0) -> None:
+        with self.lock:
+            self.data[self.head] = sample
+            self.timestamps[self.head] = timestamp
+            self.head = (self.head + 1) % self.capacity
+            if self.count == self.capacity:
+                self.overflow_count += 1
+            else:
+                self.count += 1
+            self.total_pushed += 1
+
+    # Add a (N, width) block of samples in one go
+    def push_many(self, samples : np.ndarray, timestamps) -> None:
+        n = len(samples)
+        if n == 0:
+            return
+
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=np.float64), (n,))
+
+        with self.lock:
+            lost = max(0, self.count + n - self.capacity)
+
+            # Anything beyond capacity would be overwritten straight away, only keep the tail
+            if n > self.capacity:
+                samples = samples[-self.capacity:]
+                timestamps = timestamps[-self.capacity:]
+
+            start = self.head + n - len(samples)
+            idx = (start + np.arange(len(samples))) % self.capacity
+            self.data[idx] = samples
+            self.timestamps[idx] = timestamps
+
+            self.head = (self.head + n) % self.capacity
+            self.count = min(self.capacity, self.count + n)
+            self.overflow_count += lost
+            self.total_pushed += n
+
+    # Unread sample indices, oldest first. Caller must hold the lock
+    def _pending_indices(self) -> np.ndarray:
+        start = (self.head - self.count) % self.capacity
+        return (start + np.arange(self.count)) % self.capacity
+
+    """
+    Remove and return all pending samples as a (N, width) array, oldest first
+    """
+    def drain(self, with_timestamps : bool = False):
+        with self.lock:
+            idx = self._pending_indices()
+            samples = self.data[idx]
+            timestamps = self.timestamps[idx]
+            self.count = 0
+
+        if with_timestamps:
+            return timestamps, samples
+        return samples
+
+    # Newest sample without consuming anything, None if nothing has been pushed yet
+    def latest(self):
+        with self.lock:
+            if self.total_pushed == 0:
+                return None
+            return self.data[(self.head - 1) % self.capacity].copy()
+
+    def __len__(self) -> int:
+        return self.count
+
+
+if __name__ == '__main__':
+    pass
@@ -5,6 +5,199 @@ Rotation matrix utilities
 import numpy as np
 import math as m
 
+"""
+Vectorized quaternion operations
+
+Every function works on (..., 4) arrays of quaternions in (w, x, y, z) order, so the same code
+handles a single quaternion of shape (4,) and a whole (N, 4) block
+"""
+
+def quat_multiply_array(quat0 : np.ndarray, quat1 : np.ndarray) -> np.ndarray:
+    qw, qx, qy, qz = np.moveaxis(np.asarray(quat0, dtype=np.float64), -1, 0)
+    pw, px, py, pz = np.moveaxis(np.asarray(quat1, dtype=np.float64), -1, 0)
+
+    return np.stack((
+        qw*pw - qx*px - qy*py - qz*pz,
+        qw*px + qx*pw + qy*pz - qz*py,
+        qw*py - qx*pz + qy*pw + qz*px,
+        qw*pz + qx*py - qy*px + qz*pw
+    ), axis=-1)
+
+def quat_normalize_array(quat : np.ndarray) -> np.ndarray:
+    quat = np.asarray(quat, dtype=np.float64)
+    return quat / np.linalg.norm(quat, axis=-1, keepdims=True)
+
+def quat_conjugate_array(quat : np.ndarray) -> np.ndarray:
+    return np.asarray(quat, dtype=np.float64) * np.array([1.0, -1.0, -1.0, -1.0])
+
+"""
+SLERP between quaternion blocks, same rules as RotationMatrix.quat_interpolate: quat0 is returned
+where the quaternions are (nearly) equal or opposite, t can be a scalar or one value per quaternion
+"""
+def quat_slerp_array(quat0 : np.ndarray, quat1 : np.ndarray, t) -> np.ndarray:
+    quat0 = np.asarray(quat0, dtype=np.float64)
+    quat1 = np.asarray(quat1, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+
+    cos_half_theta = np.sum(quat0 * quat1, axis=-1)
+
+    # Invert so that we are not sensitive to a positive or negative representation
+    quat1 = np.where((cos_half_theta < 0)[..., np.newaxis], -quat1, quat1)
+    cos_half_theta = np.abs(cos_half_theta)
+
+    clipped = np.minimum(cos_half_theta, 1.0)
+    half_theta = np.arccos(clipped)
+    sin_half_theta = np.sqrt(1 - clipped*clipped)
+    safe_sin = np.where(sin_half_theta < 0.01, 1.0, sin_half_theta)
+
+    ratio_a = np.sin((1 - t) * half_theta) / safe_sin
+    ratio_b = np.sin(t * half_theta) / safe_sin
+
+    keep_first = (cos_half_theta >= 1) | (sin_half_theta < 0.01) | (ratio_a >= 1) | (ratio_b >= 1)
+    ratio_a = np.where(keep_first, 1.0, ratio_a)
+    ratio_b = np.where(keep_first, 0.0, ratio_b)
+
+    return quat0 * ratio_a[..., np.newaxis] + quat1 * ratio_b[..., np.newaxis]
+
+"""
+SLERP between two single quaternions given as plain float (w, x, y, z) tuples, returns a tuple. Same
+rules as quat_slerp_array without the numpy overhead, for per sample loops
+"""
+def quat_slerp_floats(quat0 : tuple, quat1 : tuple, t : float) -> tuple:
+    qw, qx, qy, qz = quat0
+    pw, px, py, pz = quat1
+
+    cos_half_theta = qw*pw + qx*px + qy*py + qz*pz
+    if cos_half_theta < 0:
+        pw, px, py, pz = -pw, -px, -py, -pz
+        cos_half_theta = -cos_half_theta
+
+    ratio_a = 1.0
+    ratio_b = 0.0
+    if cos_half_theta < 1:
+        sin_half_theta = m.sqrt(1 - cos_half_theta*cos_half_theta)
+        if sin_half_theta >= 0.01:
+            half_theta = m.acos(cos_half_theta)
+            ratio_a = m.sin((1 - t) * half_theta) / sin_half_theta
+            ratio_b = m.sin(t * half_theta) / sin_half_theta
+            if ratio_a >= 1 or ratio_b >= 1:
+                ratio_a = 1.0
+                ratio_b = 0.0
+
+    return (qw * ratio_a + pw * ratio_b,
+            qx * ratio_a + px * ratio_b,
+            qy * ratio_a + py * ratio_b,
+            qz * ratio_a + pz * ratio_b)
+
+# (..., 4) quaternions to (..., 3, 3) rotation matrices
+def quat_to_matrix_array(quat : np.ndarray) -> np.ndarray:
+    q0, q1, q2, q3 = np.moveaxis(np.asarray(quat, dtype=np.float64), -1, 0)
+
+    return np.stack((
+        np.stack((2 * (q0 * q0 + q1 * q1) - 1, 2 * (q1 * q2 - q0 * q3), 2 * (q1 * q3 + q0 * q2)), axis=-1),
+        np.stack((2 * (q1 * q2 + q0 * q3), 2 * (q0 * q0 + q2 * q2) - 1, 2 * (q2 * q3 - q0 * q1)), axis=-1),
+        np.stack((2 * (q1 * q3 - q0 * q2), 2 * (q2 * q3 + q0 * q1), 2 * (q0 * q0 + q3 * q3) - 1), axis=-1),
+    ), axis=-2)
+
+"""
+(..., 3, 3) rotation matrices to (..., 4) unit quaternions
+
+Uses Shepperd's method, every matrix is converted from whichever of the trace or the diagonal
+elements is largest so there is no loss of precision near 180 degree rotations
+"""
+def matrix_to_quat_array(matrix : np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float64)
+    batch_shape = matrix.shape[:-2]
+    mat = matrix.reshape(-1, 3, 3)
+
+    m00, m01, m02 = mat[:, 0, 0], mat[:, 0, 1], mat[:, 0, 2]
+    m10, m11, m12 = mat[:, 1, 0], mat[:, 1, 1], mat[:, 1, 2]
+    m20, m21, m22 = mat[:, 2, 0], mat[:, 2, 1], mat[:, 2, 2]
+
+    choice = np.argmax(np.stack((m00 + m11 + m22, m00, m11, m22), axis=-1), axis=-1)
+    quat = np.empty((len(mat), 4))
+
+    sel = choice == 0
+    s = 2 * np.sqrt(1 + m00[sel] + m11[sel] + m22[sel])
+    quat[sel] = np.stack((0.25 * s, (m21[sel] - m12[sel]) / s, (m02[sel] - m20[sel]) / s, (m10[sel] - m01[sel]) / s), axis=-1)
+
+    sel = choice == 1
+    s = 2 * np.sqrt(1 + m00[sel] - m11[sel] - m22[sel])
+    quat[sel] = np.stack(((m21[sel] - m12[sel]) / s, 0.25 * s, (m01[sel] + m10[sel]) / s, (m02[sel] + m20[sel]) / s), axis=-1)
+
+    sel = choice == 2
+    s = 2 * np.sqrt(1 - m00[sel] + m11[sel] - m22[sel])
+    quat[sel] = np.stack(((m02[sel] - m20[sel]) / s, (m01[sel] + m10[sel]) / s, 0.25 * s, (m12[sel] + m21[sel]) / s), axis=-1)
+
+    sel = choice == 3
+    s = 2 * np.sqrt(1 - m00[sel] - m11[sel] + m22[sel])
+    quat[sel] = np.stack(((m10[sel] - m01[sel]) / s, (m02[sel] + m20[sel]) / s, (m12[sel] + m21[sel]) / s, 0.25 * s), axis=-1)
+
+    return quat_normalize_array(quat).reshape(batch_shape + (4,))
+
+# Rotate (..., 3) vectors by (..., 4) quaternions, same as multiplying by the rotation matrix
+def quat_rotate_array(quat : np.ndarray, vectors : np.ndarray) -> np.ndarray:
+    quat = np.asarray(quat, dtype=np.float64)
+    vectors = np.asarray(vectors, dtype=np.float64)
+
+    # v' = v + 2w(u x v) + 2u x (u x v) with u the vector part
+    w = quat[..., :1]
+    u = quat[..., 1:]
+    uv = np.cross(u, vectors)
+    return vectors + 2 * w * uv + 2 * np.cross(u, uv)
+
+
+"""
+Block of N quaternions (w, x, y, z) in one contiguous (N, 4) array
+
+Operations work on the whole block at once, so estimators and visualizers can handle many
+attitudes without creating an object per sample
+"""
+class QuaternionArray:
+
+    def __init__(self, data) -> None:
+        self.data = np.ascontiguousarray(np.asarray(data, dtype=np.float64).reshape(-1, 4))
+
+    @classmethod
+    def identity(cls, n : int):
+        data = np.zeros((n, 4))
+        data[:, 0] = 1
+        return cls(data)
+
+    @classmethod
+    def from_matrices(cls, matrices : np.ndarray):
+        return cls(matrix_to_quat_array(np.asarray(matrices).reshape(-1, 3, 3)))
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return QuaternionArray(self.data[index])
+
+    def __array__(self, dtype=None, copy=None):
+        return self.data if dtype is None else self.data.astype(dtype)
+
+    def multiply(self, other):
+        return QuaternionArray(quat_multiply_array(self.data, np.asarray(other)))
+
+    def normalize(self):
+        return QuaternionArray(quat_normalize_array(self.data))
+
+    def conjugate(self):
+        return QuaternionArray(quat_conjugate_array(self.data))
+
+    def slerp(self, other, t):
+        return QuaternionArray(quat_slerp_array(self.data, np.asarray(other), t))
+
+    # (N, 3, 3) rotation matrices
+    def to_matrices(self) -> np.ndarray:
+        return quat_to_matrix_array(self.data)
+
+    # Rotate (N, 3) vectors (or one (3,) vector by every quaternion)
+    def rotate(self, vectors : np.ndarray) -> np.ndarray:
+        return quat_rotate_array(self.data, vectors)
+
+
 class RotationMatrix:
 
     def __init__(self, a11, a12, a13, a21, a22, a23, a31, a32, a33):
@@ -13,6 +206,13 @@ class RotationMatrix:
                                 [ a21, a22, a23],
                                 [ a31, a32, a33]])
 
+    # Wrap an existing 3x3 array without unpacking it into floats
+    @classmethod
+    def from_array(cls, matrix : np.ndarray):
+        obj = cls.__new__(cls)
+        obj.matrix = np.asarray(matrix, dtype=np.float64).reshape(3, 3)
+        return obj
+
     def calc_vec(self, invec : np.ndarray) -> np.ndarray:
         return np.matmul(self.matrix, invec)
 
@@ -29,45 +229,18 @@ class RotationMatrix:
 
         Credit to: https://automaticaddison.com/how-to-convert-a-quaternion-to-a-rotation-matrix/
         """
-        # Extract the values from Q
-        q0 = quaternion[0]
-        q1 = quaternion[1]
-        q2 = quaternion[2]
-        q3 = quaternion[3]
-
-        # First row of the rotation matrix
-        r00 = 2 * (q0 * q0 + q1 * q1) - 1
-        r01 = 2 * (q1 * q2 - q0 * q3)
-        r02 = 2 * (q1 * q3 + q0 * q2)
-
-        # Second row of the rotation matrix
-        r10 = 2 * (q1 * q2 + q0 * q3)
-        r11 = 2 * (q0 * q0 + q2 * q2) - 1
-        r12 = 2 * (q2 * q3 - q0 * q1)
-
-        # Third row of the rotation matrix
-        r20 = 2 * (q1 * q3 - q0 * q2)
-        r21 = 2 * (q2 * q3 + q0 * q1)
-        r22 = 2 * (q0 * q0 + q3 * q3) - 1
-
-        # 3x3 rotation matrix
-        return cls(r00,
-                    r01,
-                    r02,
-                    r10,
-                    r11,
-                    r12,
-                    r20,
-                    r21,
-                    r22)
+        if np.shape(quaternion) != (4,):
+            raise ValueError(f"expected one (w, x, y, z) quaternion, got shape {np.shape(quaternion)}, "
+                            "use quat_to_matrix_array for many")
 
-    def get_quaternion(self) -> np.ndarray:
-        r = np.sqrt(float(1)+self.matrix[0,0]+self.matrix[1,1]+self.matrix[2,2])*0.5
-        i = (self.matrix[2,1]-self.matrix[1,2])/(4*r)
-        j = (self.matrix[0,2]-self.matrix[2,0])/(4*r)
-        k = (self.matrix[1,0]-self.matrix[0,1])/(4*r)
+        # Plain floats, the array version costs several times more per call
+        q0, q1, q2, q3 = np.asarray(quaternion, dtype=np.float64).tolist()
+        return cls(2 * (q0 * q0 + q1 * q1) - 1, 2 * (q1 * q2 - q0 * q3), 2 * (q1 * q3 + q0 * q2),
+                    2 * (q1 * q2 + q0 * q3), 2 * (q0 * q0 + q2 * q2) - 1, 2 * (q2 * q3 - q0 * q1),
+                    2 * (q1 * q3 - q0 * q2), 2 * (q2 * q3 + q0 * q1), 2 * (q0 * q0 + q3 * q3) - 1)
 
-        return np.array([r, i, j, k])
+    def get_quaternion(self) -> np.ndarray:
+        return matrix_to_quat_array(self.matrix)
 
     """
     Multiply quaternions qp
@@ -76,17 +249,12 @@ class RotationMatrix:
     """
     @staticmethod
     def quat_multiply(quat0, quat1):
+        if np.ndim(quat0) != 1 or np.ndim(quat1) != 1:
+            return quat_multiply_array(quat0, quat1)
 
-        qw = quat0[0]
-        qx = quat0[1]
-        qy = quat0[2]
-        qz = quat0[3]
-
-        pw = quat1[0]
-        px = quat1[1]
-        py = quat1[2]
-        pz = quat1[3]
-
+        # Single quaternions on plain floats
+        qw, qx, qy, qz = np.asarray(quat0, dtype=np.float64).tolist()
+        pw, px, py, pz = np.asarray(quat1, dtype=np.float64).tolist()
         return np.array([
             qw*pw - qx*px - qy*py - qz*pz,
             qw*px + qx*pw + qy*pz - qz*py,
@@ -99,49 +267,9 @@ class RotationMatrix:
     """
     @staticmethod
     def quat_interpolate(quat0, quat1, t) -> np.ndarray:
+        if np.ndim(quat0) != 1 or np.ndim(quat1) != 1 or np.ndim(t) != 0:
+            return quat_slerp_array(quat0, quat1, t)
 
-        qw = quat0[0]
-        qx = quat0[1]
-        qy = quat0[2]
-        qz = quat0[3]
-
-        pw = quat1[0]
-        px = quat1[1]
-        py = quat1[2]
-        pz = quat1[3]
-
-        cos_half_theta = qw*pw + qx*px + qy*py + qz*pz
-
-        # Invert so that we are not sensitive to a positive or negative representation
-        # (w, x, y, z) = (-w, -x, -y, -z)
-        if cos_half_theta < 0:
-            pw = -pw
-            px = -px
-            py = -py
-            pz = pz
-            cos_half_theta = -cos_half_theta
-
-        # If quat0 = quat1  or quat0 = -quat1, then we can just return quat0
-        if abs(cos_half_theta) >= 1:
-            return np.array([qw, qx, qy, qz])
-
-        half_theta = m.acos(cos_half_theta)
-        sin_half_theta = m.sqrt(1 - cos_half_theta*cos_half_theta)
-
-        # When theta = 180 degrees, the result is not fully defined, we can rotate around any axis normal to either quaternion
-        if abs(sin_half_theta) < 0.01:
-            return np.array([qw, qx, qy, qz])
-
-        ratioA = m.sin((1-t) * half_theta) / sin_half_theta
-        ratioB = m.sin(t * half_theta) / sin_half_theta
-
-        # Make sure there are no undefined areas where the ratios get boosted over 1
-        if ratioA >= 1 or ratioB >= 1:
-            ratioA = 1
-            ratioB = 0
-
-        return np.array([qw * ratioA + pw * ratioB,
-                        qx * ratioA + px * ratioB,
-                        qy * ratioA + py * ratioB,
-                        qz * ratioA + pz * ratioB])
-
+        # Single quaternions on plain floats
+        return np.array(quat_slerp_floats(np.asarray(quat0, dtype=np.float64).tolist(),
+                                          np.asarray(quat1, dtype=np.float64).tolist(), float(t)))
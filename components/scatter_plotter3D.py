@@ -5,28 +5,151 @@ This was hard
 """
 
 import numpy as np
-from multiprocessing import Process, Queue
+from multiprocessing import Process
 from functools import partial
-from PyQt5.QtWidgets import QApplication
-import pyqtgraph.opengl as gl
-from pyqtgraph.Qt import QtCore
-import pyqtgraph as pg
+from components.shm_transport import SharedRing
+
+# Qt is only imported by the render process, the side calling plot() never needs it
+gl = None
+QtCore = None
+QApplication = None
+
+
+def _load_qt() -> None:
+    global gl, QtCore, QApplication
+    if gl is not None:
+        return
+    from PyQt5.QtWidgets import QApplication
+    import pyqtgraph.opengl as gl
+    from pyqtgraph.Qt import QtCore
+
+
+# Dict of point collection name -> (k, 3) points to (n, 4) records [collection index, x, y, z]
+def _point_records(data : dict, names : list) -> np.ndarray:
+    blocks = []
+    for name, points in data.items():
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        blocks.append(np.column_stack((np.full(len(points), names.index(name)), points)))
+    if len(blocks) == 0:
+        return np.empty((0, 4))
+    return np.concatenate(blocks, axis=0)
+
+
+# Voxel indices are packed into one int64 key, 21 bits per axis
+_VOXEL_BITS = 21
+_VOXEL_OFFSET = 1 << (_VOXEL_BITS - 1)
 
 
 """
-Plot data in real time using Qt framework
+Point storage for one point collection
+
+Points live in one preallocated float32 array that doubles in size when full, so adding k points
+costs O(k) instead of copying the whole history. The array is handed to the renderer in fixed size
+blocks, add() reports which blocks changed so only those are uploaded again.
 
-Data comes from queue filled by parent task
+decimation bounds the number of points kept for long runs:
+    None        keep every point
+    'voxel'     keep the first point that lands in each voxel_size cube
+    'reservoir' keep a uniform random sample of max_points points of everything seen
 """
-class _DynamicPlotter():
+class _PointCloud():
+
+    def __init__(self, decimation : str = None, voxel_size : float = 1.0, max_points : int = 100000,
+                block_size : int = 4096, seed : int = None):
+        if decimation not in (None, 'voxel', 'reservoir'):
+            raise ValueError(f"Unknown decimation mode {decimation}")
+
+        self.decimation = decimation
+        self.voxel_size = voxel_size
+        self.max_points = max_points
+        self.block_size = block_size
+
+        capacity = max_points if decimation == 'reservoir' else block_size
+        self.points = np.empty((capacity, 3), dtype=np.float32)
+        self.count = 0
+        self.seen = 0
+
+        # Sorted keys of occupied voxels
+        self.voxels = np.empty(0, dtype=np.int64)
+        self.rng = np.random.default_rng(seed)
+
+    def _voxel_keys(self, points : np.ndarray) -> np.ndarray:
+        cells = np.floor(points / self.voxel_size).astype(np.int64) + _VOXEL_OFFSET
+        return (cells[:, 0] << (2*_VOXEL_BITS)) | (cells[:, 1] << _VOXEL_BITS) | cells[:, 2]
+
+    def _append(self, points : np.ndarray) -> set:
+        start = self.count
+        end = start + len(points)
+        if end > len(self.points):
+            capacity = len(self.points)
+            while capacity < end:
+                capacity *= 2
+            grown = np.empty((capacity, 3), dtype=np.float32)
+            grown[:start] = self.points[:start]
+            self.points = grown
+
+        self.points[start:end] = points
+        self.count = end
+        return set(range(start // self.block_size, (end - 1) // self.block_size + 1))
+
+    """
+    Add (k, 3) points, returns the indices of the blocks that changed
+    """
+    def add(self, points : np.ndarray) -> set:
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        first_seen = self.seen
+        self.seen += len(points)
+        if len(points) == 0:
+            return set()
+
+        if self.decimation == 'voxel':
+            keys = self._voxel_keys(points)
+            # First point per voxel within the batch, then only voxels not occupied yet
+            keys, first = np.unique(keys, return_index=True)
+            new = ~np.isin(keys, self.voxels, assume_unique=True)
+            if not new.any():
+                return set()
+            self.voxels = np.union1d(self.voxels, keys[new])
+            return self._append(points[np.sort(first[new])])
+
+        if self.decimation == 'reservoir':
+            # Fill the reservoir first, afterwards point number n replaces a random slot with probability max_points/n
+            fill = min(len(points), self.max_points - self.count)
+            dirty = self._append(points[:fill]) if fill > 0 else set()
+
+            rest = points[fill:]
+            if len(rest) > 0:
+                seen_before = first_seen + fill + np.arange(1, len(rest) + 1)
+                slots = (self.rng.random(len(rest)) * seen_before).astype(np.int64)
+                keep = slots < self.max_points
+                # Later points win when the same slot is hit twice, like adding them one by one
+                self.points[slots[keep]] = rest[keep]
+                dirty |= set((slots[keep] // self.block_size).tolist())
+            return dirty
+
+        return self._append(points)
+
+    # Points of one block, a view into the storage
+    def block(self, index : int) -> np.ndarray:
+        return self.points[index*self.block_size:min(self.count, (index + 1)*self.block_size)]
+
+    def num_blocks(self) -> int:
+        return -(-self.count // self.block_size)
 
-    def __init__(self, data_queue : Queue, plot_name : str, names : list, colors : list, sampleinterval=0.0416):
-        # Figure out intervals and number of points
-        self._interval = int(sampleinterval*1000)
-        self.app = QApplication([])
-        self.view = gl.GLViewWidget()
 
-        self.data_queue = data_queue
+"""
+Scatter panel, one growing point cloud per named point collection
+
+Used on its own by _DynamicPlotter or as one of many panels in a Dashboard
+"""
+class _ScatterPanel():
+
+    def __init__(self, plot_name : str, names : list, colors : list, decimation : str = None,
+                voxel_size : float = 1.0, max_points : int = 100000):
+        _load_qt()
+        self.view = gl.GLViewWidget()
+        self.widget = self.view
+        self.names = names
         self.plot_name = plot_name
 
         self.view.opts['distance'] = 300
@@ -74,20 +197,55 @@ class _DynamicPlotter():
         sh4 = gl.GLLinePlotItem(pos=pts_z, width=2, antialias=False, color='b')
         self.view.addItem(sh4)
 
-        # create scatter plot for every point collection, indexible by the plot name
+        # Every point collection is drawn as a list of scatter items, one per storage block. Full blocks
+        # are left alone, only blocks that changed get new data
+        self.clouds = dict()
         self.plots = dict()
-        self.plots_data = dict()
         self.plots_colors = dict()
 
         for name in names:
-            self.plots_data[name] = np.array([[0,0,0]])
+            self.clouds[name] = _PointCloud(decimation=decimation, voxel_size=voxel_size, max_points=max_points)
             self.plots_colors[name] = colors[names.index(name)]
-            self.plots[name] = gl.GLScatterPlotItem(pos=self.plots_data[name], size=1, color = self.plots_colors[name], pxMode = False)
-            self.view.addItem(self.plots[name])
+            self.plots[name] = []
+
+    # Add (n, 4) records [collection index, x, y, z]
+    def push(self, records : np.ndarray):
+        # update plot data for each plot seperately
+        for index, name in enumerate(self.names):
+            new_points = records[records[:, 0] == index, 1:4]
+            if len(new_points) == 0:
+                continue
+
+            cloud = self.clouds[name]
+            items = self.plots[name]
+            for block in sorted(cloud.add(new_points)):
+                if block < len(items):
+                    items[block].setData(pos=cloud.block(block))
+                else:
+                    item = gl.GLScatterPlotItem(pos=cloud.block(block), size=1, color=self.plots_colors[name], pxMode=False)
+                    self.view.addItem(item)
+                    items.append(item)
+
+    def redraw(self):
+        pass
+
+
+"""
+Plot data in real time using Qt framework
+
+Data comes from shared memory ring filled by parent task, every record is [point collection index, x, y, z]
+"""
+class _DynamicPlotter():
+
+    def __init__(self, ring_spec : tuple, plot_name : str, names : list, colors : list, sampleinterval=0.0416, **panel_options):
+        _load_qt()
+        # Figure out intervals and number of points
+        self._interval = int(sampleinterval*1000)
+        self.app = QApplication([])
+        self.ring = SharedRing.attach(*ring_spec)
 
-        #self.points_collected = np.array([[0,0,0]])
-        #self.colors = [1, 0, 0, 1]
-        self.view.show()
+        self.panel = _ScatterPanel(plot_name=plot_name, names=names, colors=colors, **panel_options)
+        self.panel.view.show()
 
         # QTimer
         self.timer = QtCore.QTimer()
@@ -95,18 +253,12 @@ class _DynamicPlotter():
         self.timer.start(self._interval)
 
     def updateplot(self):
-        try:
-            new_item = self.data_queue.get(block=False)
-            keylist = list(new_item.keys())
-
-            # update plot data for each plot seperately
-            for name in keylist:
-                self.plots_data[name] = np.concatenate((self.plots_data[name], new_item[name]), axis=0)
-                self.plots[name].setData(pos=self.plots_data[name], size=1, color = self.plots_colors[name], pxMode = False)
+        records = self.ring.read_all()
+        if len(records) > 0:
+            self.panel.push(records)
 
-            self.app.processEvents()
-        except:
-            self.app.processEvents()
+        self.panel.redraw()
+        self.app.processEvents()
 
     def run(self):
         self.app.exec_()
@@ -114,10 +266,11 @@ class _DynamicPlotter():
 """
 Helper to create and run a dynamic plotter in a new process
 """
-def run_plotter(data_queue : Queue, plot_name : str, sample_period : float, names : list, colors : list):
+def run_plotter(ring_spec : tuple, plot_name : str, sample_period : float, names : list, colors : list, panel_options : dict):
 
     # create plot
-    p = _DynamicPlotter(data_queue=data_queue, plot_name=plot_name, sampleinterval=sample_period, names=names, colors=colors)
+    p = _DynamicPlotter(ring_spec=ring_spec, plot_name=plot_name, sampleinterval=sample_period, names=names, colors=colors,
+                        **panel_options)
     p.run()
 
 
@@ -128,19 +281,33 @@ TODO: Log data and maybe generate static graph when done
 '''
 class ScatterPlotter3D:
 
-    def __init__(self, name : str, fps : int, names : list, colors : list):
+    """
+    decimation keeps long runs interactive: 'voxel' keeps one point per voxel_size cube, 'reservoir' keeps
+    a uniform random sample of max_points points. By default every point is kept
+    """
+    def __init__(self, name : str, fps : int, names : list, colors : list, buffer_size : int = 65536,
+                decimation : str = None, voxel_size : float = 1.0, max_points : int = 100000):
 
         # Setup child process with realtime plotter
         sample_period = float(1/fps)
-        self.q = Queue(maxsize=1)
-        self.p = Process(target=run_plotter, args=(self.q, name, sample_period, names, colors,))
+        self.names = names
+        self.ring = SharedRing(width=4, capacity=buffer_size)
+        panel_options = dict(decimation=decimation, voxel_size=voxel_size, max_points=max_points)
+        self.p = Process(target=run_plotter, args=(self.ring.spec(), name, sample_period, names, colors, panel_options,))
         self.p.start()
 
-    # Try and stick item into the queue, if its full, that is ok, we can just ignore it for now
+    # Copy (k, 3) point arrays for any of the point collections into shared memory
     def plot(self, data : dict):
-        try:
-            self.q.put(data, block = False)
-        except:
-            pass
-
-
+        records = _point_records(data, self.names)
+        if len(records) > 0:
+            self.ring.write(records)
+
+    # Points overwritten before the plotter got to them
+    @property
+    def dropped(self) -> int:
+        return self.ring.dropped
+
+    def close(self) -> None:
+        self.p.terminate()
+        self.p.join()
+        self.ring.close()
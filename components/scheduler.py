@@ -0,0 +1,152 @@
+"""
+Fixed rate loop scheduling
+
+Sleeping for the loop period after the work makes the real period work time plus sleep, so the
+loop runs slow and drifts with load. The scheduler instead keeps absolute deadlines
+start + k * period on time.perf_counter and only waits for what is left of the current period.
+A tick that starts late does not shift the ones after it.
+
+When a tick runs past the next deadline it counts as an overrun and the policy decides what
+happens to the deadlines that have passed:
+
+    catch_up    run the missed ticks straight away, at most max_catch_up of them, the rest are skipped
+    skip        drop the missed ticks and run once for the newest deadline that has passed
+
+How late every tick started is kept as jitter.
+"""
+
+import time
+import numpy as np
+
+# Missed tick policies
+CATCH_UP = 'catch_up'
+SKIP = 'skip'
+
+
+"""
+Run something rate times per second
+
+    scheduler = FixedRateScheduler(rate=200)
+    scheduler.run(step, duration=10)
+
+or drive the loop yourself with wait(). Most platforms only sleep to about a millisecond (Windows
+to about 15 ms unless the timer resolution is raised), the last spin seconds before a deadline are
+spent polling the clock instead
+"""
+class FixedRateScheduler:
+
+    def __init__(self, rate : float, policy : str = CATCH_UP, max_catch_up : int = 5, spin : float = 0.001,
+                jitter_window : int = 1024) -> None:
+        if rate <= 0:
+            raise ValueError("scheduler rate must be positive")
+        if policy not in (CATCH_UP, SKIP):
+            raise ValueError(f"unknown scheduler policy {policy}, use {CATCH_UP} or {SKIP}")
+
+        self.rate = rate
+        self.period = 1 / rate
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.spin = spin
+
+        self._start = None
+        self._tick = 0
+        self._backlog = 0
+
+        # Statistics
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.late_sum = 0.0
+        self.late_max = 0.0
+        self._late = np.zeros(jitter_window)
+
+    # Deadline of tick k
+    def _deadline(self, tick : int) -> float:
+        return self._start + tick * self.period
+
+    def reset(self) -> None:
+        self._start = None
+        self._tick = 0
+        self._backlog = 0
+
+    """
+    Block until the next tick is due and return its deadline. The first call starts the schedule
+    and returns straight away
+    """
+    def wait(self) -> float:
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now
+            return self._record(self._deadline(0), now)
+
+        self._tick += 1
+        deadline = self._deadline(self._tick)
+
+        if now >= deadline:
+            if self._backlog > 0:
+                # Catching up on ticks missed earlier
+                self._backlog -= 1
+            else:
+                # The previous tick ran past this deadline and maybe past some after it as well
+                self.overruns += 1
+                missed = int((now - deadline) // self.period)
+                keep = min(missed, self.max_catch_up) if self.policy == CATCH_UP else 0
+                self.skipped += missed - keep
+                self._tick += missed - keep
+                self._backlog = keep
+                deadline = self._deadline(self._tick)
+            return self._record(deadline, now)
+
+        self._backlog = 0
+        remaining = deadline - now
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+        return self._record(deadline, now)
+
+    def _record(self, deadline : float, now : float) -> float:
+        late = now - deadline
+        self._late[self.ticks % len(self._late)] = late
+        self.ticks += 1
+        self.late_sum += late
+        self.late_max = max(self.late_max, late)
+        return deadline
+
+    """
+    Call callback() once per tick until it returns False, duration seconds have passed or
+    stop_event is set
+    """
+    def run(self, callback, duration : float = None, stop_event=None) -> None:
+        end = None if duration is None else time.perf_counter() + duration
+        while True:
+            self.wait()
+            if callback() is False:
+                break
+            if stop_event is not None and stop_event.is_set():
+                break
+            if end is not None and time.perf_counter() >= end:
+                break
+
+    """
+    ticks, overruns (ticks that ran past the next deadline), skipped ticks, the rate
+    achieved and how late ticks started in ms (mean and max overall, p99 of the recent ones)
+    """
+    def stats(self) -> dict:
+        recent = self._late[:min(self.ticks, len(self._late))]
+        elapsed = time.perf_counter() - self._start if self._start is not None else 0.0
+        return {
+            'ticks' : self.ticks,
+            'overruns' : self.overruns,
+            'skipped' : self.skipped,
+            'rate' : self.ticks / elapsed if elapsed > 0 else 0.0,
+            'jitter_ms' : self.late_sum / self.ticks * 1000 if self.ticks > 0 else 0.0,
+            'jitter_p99_ms' : float(np.percentile(recent, 99)) * 1000 if len(recent) > 0 else 0.0,
+            'jitter_max_ms' : self.late_max * 1000,
+        }
+
+
+if __name__ == '__main__':
+    pass
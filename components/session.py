@@ -0,0 +1,153 @@
+"""
+Append only columnar storage for IMU sessions
+
+A session is a directory holding one raw binary file per column plus meta.json describing
+the dtype and row shape of every column and the number of rows written. Columns are
+written a chunk at a time and opened later with np.memmap, so slicing long captures
+never loads the whole file.
+"""
+
+import json
+import os
+import numpy as np
+
+META_FILE = 'meta.json'
+
+# time (s), the 9 ICM channels raw and filtered, attitude quaternion (w, x, y, z)
+DEFAULT_COLUMNS = {
+    'time' : ('<f8', ()),
+    'raw' : ('<f8', (9,)),
+    'filtered' : ('<f8', (9,)),
+    'quaternion' : ('<f8', (4,)),
+}
+
+
+def _column_file(path : str, name : str) -> str:
+    return os.path.join(path, f"{name}.bin")
+
+
+"""
+Write rows to a session, only one chunk per column is held in memory
+"""
+class SessionWriter:
+
+    def __init__(self, path : str, columns : dict = DEFAULT_COLUMNS, chunk_size : int = 4096) -> None:
+        if os.path.exists(os.path.join(path, META_FILE)):
+            raise FileExistsError(f"session {path} already exists")
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.columns = {name : (np.dtype(dtype), tuple(shape)) for name, (dtype, shape) in columns.items()}
+        self.chunk_size = chunk_size
+        self.count = 0
+
+        # One preallocated chunk per column, flushed to disk whenever it fills up
+        self._chunks = {name : np.zeros((chunk_size,) + shape, dtype=dtype) for name, (dtype, shape) in self.columns.items()}
+        self._fill = 0
+        self._files = {name : open(_column_file(path, name), 'wb') for name in self.columns}
+        self._write_meta()
+
+    """
+    Append N rows, every keyword is a column name with an array of N rows (or a single row).
+    Columns that are left out are filled with NaN (zero for integer columns) for this block
+    """
+    def append(self, **data) -> None:
+        unknown = set(data) - set(self.columns)
+        if len(unknown) > 0:
+            raise KeyError(f"unknown session columns {sorted(unknown)}")
+
+        blocks = dict()
+        n = None
+        for name, values in data.items():
+            dtype, shape = self.columns[name]
+            blocks[name] = np.asarray(values, dtype=dtype).reshape((-1,) + shape)
+            if n is not None and len(blocks[name]) != n:
+                raise ValueError("all session columns must be appended with the same number of rows")
+            n = len(blocks[name])
+
+        if n is None:
+            return
+
+        done = 0
+        while done < n:
+            take = min(n - done, self.chunk_size - self._fill)
+            for name, chunk in self._chunks.items():
+                if name in blocks:
+                    chunk[self._fill:self._fill + take] = blocks[name][done:done + take]
+                else:
+                    chunk[self._fill:self._fill + take] = np.nan if chunk.dtype.kind == 'f' else 0
+            self._fill += take
+            done += take
+
+            if self._fill == self.chunk_size:
+                self.flush()
+
+    # Write out the current chunk
+    def flush(self) -> None:
+        if self._fill == 0:
+            return
+
+        for name, chunk in self._chunks.items():
+            chunk[:self._fill].tofile(self._files[name])
+            self._files[name].flush()
+
+        self.count += self._fill
+        self._fill = 0
+        self._write_meta()
+
+    def _write_meta(self) -> None:
+        meta = {
+            'count' : self.count,
+            'columns' : {name : {'dtype' : dtype.str, 'shape' : list(shape)} for name, (dtype, shape) in self.columns.items()},
+        }
+        tmp_path = os.path.join(self.path, META_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, META_FILE))
+
+    def close(self) -> None:
+        self.flush()
+        for f in self._files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+"""
+Open a session for reading, every column is a read only memory map
+"""
+class SessionReader:
+
+    def __init__(self, path : str) -> None:
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+
+        self.path = path
+        self.count = meta['count']
+        self.columns = dict()
+        for name, info in meta['columns'].items():
+            dtype = np.dtype(info['dtype'])
+            shape = (self.count,) + tuple(info['shape'])
+            if self.count == 0:
+                self.columns[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(_column_file(path, name), dtype=dtype, mode='r', shape=shape)
+
+    def __getitem__(self, name : str) -> np.ndarray:
+        return self.columns[name]
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Row range covering t_start <= time < t_end, needs a sorted 'time' column
+    def time_slice(self, t_start : float, t_end : float) -> slice:
+        times = self.columns['time']
+        return slice(int(np.searchsorted(times, t_start, side='left')), int(np.searchsorted(times, t_end, side='left')))
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,158 @@
+"""
+Shared memory transport between the estimator process and renderer processes
+
+A single producer writes fixed width float64 records into a ring in a shared memory block,
+plus a "latest value" slot. Nothing is pickled, a write is a copy into the block. The consumer
+either reads every record it has not seen yet or only the newest one.
+
+Block layout: int64 header | float64 ring (capacity, width) | float64 latest slot (width)
+"""
+
+import numpy as np
+from multiprocessing import shared_memory
+
+# Header slots
+_WRITE_INDEX = 0
+_READ_INDEX = 1
+_LATEST_SEQ = 2
+_PRODUCER_DROPPED = 3
+_CONSUMER_OVERRUNS = 4
+_HEADER_SLOTS = 8
+_HEADER_BYTES = _HEADER_SLOTS * 8
+
+"""
+Single producer, single consumer ring of fixed width records
+
+Create it in the producer with SharedRing(width, capacity), hand spec() to the consumer process
+and open it there with SharedRing.attach(*spec). Indices only ever grow and each side only writes
+its own, so no locks are needed. When the consumer falls behind by more than the capacity the oldest
+records are overwritten, the producer counts those as dropped and the consumer as overruns
+"""
+class SharedRing:
+
+    def __init__(self, width : int, capacity : int = 4096, name : str = None) -> None:
+        self.width = width
+        self.capacity = capacity
+        self.owner = name is None
+
+        size = _HEADER_BYTES + (capacity + 1) * width * 8
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self.header = np.ndarray((_HEADER_SLOTS,), dtype=np.int64, buffer=self.shm.buf, offset=0)
+        self.ring = np.ndarray((capacity, width), dtype=np.float64, buffer=self.shm.buf, offset=_HEADER_BYTES)
+        self.latest_slot = np.ndarray((width,), dtype=np.float64, buffer=self.shm.buf,
+                                    offset=_HEADER_BYTES + capacity * width * 8)
+        if self.owner:
+            self.header[:] = 0
+
+        # Consumer side position and the newest record latest() managed to read
+        self.read_index = int(self.header[_READ_INDEX])
+        self._latest = None
+
+    @classmethod
+    def attach(cls, name : str, width : int, capacity : int):
+        return cls(width=width, capacity=capacity, name=name)
+
+    # Everything a consumer process needs to attach
+    def spec(self) -> tuple:
+        return (self.shm.name, self.width, self.capacity)
+
+    @property
+    def dropped(self) -> int:
+        return int(self.header[_PRODUCER_DROPPED])
+
+    @property
+    def overruns(self) -> int:
+        return int(self.header[_CONSUMER_OVERRUNS])
+
+    # Records written but not read yet
+    def pending(self) -> int:
+        return int(self.header[_WRITE_INDEX]) - self.read_index
+
+    """
+    Producer: append a (k, width) block (or a single record) and update the latest slot
+    """
+    def write(self, records : np.ndarray) -> None:
+        records = np.asarray(records, dtype=np.float64).reshape(-1, self.width)
+        k = len(records)
+        if k == 0:
+            return
+
+        write_index = int(self.header[_WRITE_INDEX])
+        unread = write_index - int(self.header[_READ_INDEX])
+        # Unread records pushed out of the ring by this write
+        self.header[_PRODUCER_DROPPED] += max(0, unread + k - self.capacity) - max(0, unread - self.capacity)
+
+        # Only the last capacity records can survive anyway
+        start = write_index + k - min(k, self.capacity)
+        records = records[-self.capacity:]
+        idx = (start + np.arange(len(records))) % self.capacity
+        self.ring[idx] = records
+
+        # Publish the data before moving the index
+        self.header[_WRITE_INDEX] = write_index + k
+        self._write_latest(records[-1])
+
+    # Seqlock: odd sequence while writing, readers retry if it changed underneath them
+    def _write_latest(self, record : np.ndarray) -> None:
+        self.header[_LATEST_SEQ] += 1
+        self.latest_slot[:] = record
+        self.header[_LATEST_SEQ] += 1
+
+    """
+    Consumer: every record written since the last read as a (n, width) array, oldest first
+    """
+    def read_all(self) -> np.ndarray:
+        write_index = int(self.header[_WRITE_INDEX])
+        read_index = self.read_index
+
+        if write_index - read_index > self.capacity:
+            self.header[_CONSUMER_OVERRUNS] += write_index - read_index - self.capacity
+            read_index = write_index - self.capacity
+
+        idx = (read_index + np.arange(write_index - read_index)) % self.capacity
+        records = self.ring[idx]
+
+        # The producer may have lapped us while copying, those records can be torn so drop them
+        lapped = int(self.header[_WRITE_INDEX]) - read_index - self.capacity
+        if lapped > 0:
+            records = records[lapped:]
+            self.header[_CONSUMER_OVERRUNS] += lapped
+
+        self.read_index = write_index
+        self.header[_READ_INDEX] = write_index
+        return records
+
+    """
+    Consumer: newest record only, None if nothing has been written yet. Gives up after max_tries
+    attempts and returns the last record it did read, a producer killed halfway through a write
+    leaves the sequence odd for good
+    """
+    def latest(self, max_tries : int = 1000):
+        for _ in range(max_tries):
+            seq = int(self.header[_LATEST_SEQ])
+            if seq == 0:
+                return None
+            if seq % 2 == 1:
+                continue
+            record = self.latest_slot.copy()
+            if int(self.header[_LATEST_SEQ]) == seq:
+                self._latest = record
+                return record
+        return self._latest
+
+    def close(self) -> None:
+        # numpy views have to go before the block can be closed
+        self.header = None
+        self.ring = None
+        self.latest_slot = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+if __name__ == '__main__':
+    pass
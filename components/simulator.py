@@ -0,0 +1,353 @@
+"""
+Simulated ICM20948 streams for running the whole pipeline without hardware
+
+The ground truth attitude follows a configurable body rate trajectory and the sensor readings are
+generated from it, with noise, bias, vibration and hard/soft iron distortion on top. Frame conventions
+match ComplementaryFilter: the attitude quaternion q rotates world (North, East, Down) vectors into
+the body frame through M = R(q), body rates advance it as q ⊗ exp(0.5 * w * dt) and
+
+    accel = M @ [0, 0, -g]          (mg)
+    gyro = w                        (dps)
+    mag = S @ (M @ m_world) + b     (uT, soft iron S, hard iron b)
+
+Samples come out as ICM20948 text lines or binary frames through a serial style source, which can be
+handed to Parser directly or copied into a pty
+"""
+
+import math as m
+import time
+from collections import deque
+
+import numpy as np
+
+import components.IMU
+from components.binary_frame import encode_frames
+from components.parser import Parser
+from components.replay import EndOfCapture, PtyBridge
+from components.rotation import quat_multiply_array, quat_normalize_array, quat_to_matrix_array
+
+# Gravity in mg and a mid latitude magnetic field in uT, pointing north and down
+GRAVITY = 1000.0
+MAG_FIELD = np.array([20.0, 0.0, 45.0])
+
+
+"""
+Body rate trajectories, rates(t) returns (N, 3) body rates in dps for (N,) times in s
+"""
+class Static:
+
+    def rates(self, t : np.ndarray) -> np.ndarray:
+        return np.zeros((len(t), 3))
+
+
+class ConstantRate:
+
+    def __init__(self, rate) -> None:
+        self.rate = np.broadcast_to(np.asarray(rate, dtype=np.float64), (3,))
+
+    def rates(self, t : np.ndarray) -> np.ndarray:
+        return np.tile(self.rate, (len(t), 1))
+
+
+"""
+Swinging back and forth around every axis, amplitude in dps and frequency in Hz per axis
+"""
+class Oscillation:
+
+    def __init__(self, amplitude, frequency, phase=0.0) -> None:
+        self.amplitude = np.broadcast_to(np.asarray(amplitude, dtype=np.float64), (3,))
+        self.frequency = np.broadcast_to(np.asarray(frequency, dtype=np.float64), (3,))
+        self.phase = np.broadcast_to(np.asarray(phase, dtype=np.float64), (3,))
+
+    def rates(self, t : np.ndarray) -> np.ndarray:
+        return self.amplitude * np.sin(2 * m.pi * self.frequency * t[:, np.newaxis] + self.phase)
+
+
+"""
+Slow random tumbling (a few sines with random frequencies per axis), covers every orientation over time
+"""
+class Tumble:
+
+    def __init__(self, max_rate : float = 60.0, seed : int = None) -> None:
+        rng = np.random.default_rng(seed)
+        self.amplitude = rng.uniform(0.2, 1.0, (3, 3)) * max_rate / 3
+        self.frequency = rng.uniform(0.05, 0.5, (3, 3))
+        self.phase = rng.uniform(0, 2 * m.pi, (3, 3))
+
+    def rates(self, t : np.ndarray) -> np.ndarray:
+        # (N, component, axis) summed over the components
+        waves = np.sin(2 * m.pi * self.frequency * t[:, np.newaxis, np.newaxis] + self.phase)
+        return np.sum(self.amplitude * waves, axis=1)
+
+
+# Quaternions exp(0.5 * w * dt) for (N, 3) body rates in dps
+def _rate_quaternions(rates : np.ndarray, dt : float) -> np.ndarray:
+    rotvec = rates * (m.pi / 180) * dt
+    angle = np.linalg.norm(rotvec, axis=1, keepdims=True)
+    safe = np.where(angle > 0, angle, 1.0)
+    return np.concatenate((np.cos(angle / 2), rotvec / safe * np.sin(angle / 2)), axis=1)
+
+# Running products q[0] ⊗ q[1] ⊗ ... ⊗ q[i] in log2(N) vectorized steps
+def _cumulative_product(quats : np.ndarray) -> np.ndarray:
+    result = quats.copy()
+    step = 1
+    while step < len(result):
+        result[step:] = quat_multiply_array(result[:-step], result[step:])
+        step *= 2
+    return result
+
+
+"""
+Ground truth and sensor model
+
+Noise values are standard deviations and biases constant offsets, both per sample in the units of
+the channel (scalar or one value per axis). Vibration adds a sine of vibration_amplitude mg at
+vibration_frequency Hz to the accelerometer
+"""
+class ImuSimulator:
+
+    def __init__(self, trajectory=None, rate : float = 200.0, initial : np.ndarray = None,
+                accel_noise=0.0, gyro_noise=0.0, mag_noise=0.0, accel_bias=0.0, gyro_bias=0.0,
+                hard_iron=0.0, soft_iron : np.ndarray = None, vibration_amplitude=0.0, vibration_frequency : float = 50.0,
+                gravity : float = GRAVITY, mag_field : np.ndarray = MAG_FIELD, seed : int = None) -> None:
+        self.trajectory = trajectory if trajectory is not None else Static()
+        self.rate = rate
+        self.dt = 1 / rate
+
+        self.accel_noise = accel_noise
+        self.gyro_noise = gyro_noise
+        self.mag_noise = mag_noise
+        self.accel_bias = np.broadcast_to(np.asarray(accel_bias, dtype=np.float64), (3,))
+        self.gyro_bias = np.broadcast_to(np.asarray(gyro_bias, dtype=np.float64), (3,))
+        self.hard_iron = np.broadcast_to(np.asarray(hard_iron, dtype=np.float64), (3,))
+        self.soft_iron = np.eye(3) if soft_iron is None else np.asarray(soft_iron, dtype=np.float64)
+        self.vibration_amplitude = vibration_amplitude
+        self.vibration_frequency = vibration_frequency
+
+        self.gravity = np.array([0.0, 0.0, -gravity])
+        self.mag_field = np.asarray(mag_field, dtype=np.float64)
+
+        self.rng = np.random.default_rng(seed)
+        self.vibration_phase = self.rng.uniform(0, 2 * m.pi, 3)
+        self.quat = np.array([1.0, 0.0, 0.0, 0.0]) if initial is None else quat_normalize_array(initial)
+        self.count = 0
+
+    """
+    Next n samples, returns ((n, 9) sensor samples, (n, 4) true attitude, (n,) sample times)
+    """
+    def generate(self, n : int) -> tuple:
+        times = (self.count + np.arange(n)) * self.dt
+        rates = self.trajectory.rates(times)
+
+        # The very first sample sits at the initial attitude
+        steps = _rate_quaternions(rates, self.dt)
+        if self.count == 0 and n > 0:
+            steps[0] = (1.0, 0.0, 0.0, 0.0)
+        truth = quat_normalize_array(quat_multiply_array(self.quat, _cumulative_product(steps)))
+
+        matrices = quat_to_matrix_array(truth)
+        accel = matrices @ self.gravity
+        mag = (matrices @ self.mag_field) @ self.soft_iron.T + self.hard_iron
+
+        if self.vibration_amplitude:
+            accel += self.vibration_amplitude * np.sin(2 * m.pi * self.vibration_frequency * times[:, np.newaxis] + self.vibration_phase)
+
+        samples = np.empty((n, 9))
+        samples[:, 0:3] = accel + self.accel_bias + self.rng.normal(0, 1, (n, 3)) * self.accel_noise
+        samples[:, 3:6] = rates + self.gyro_bias + self.rng.normal(0, 1, (n, 3)) * self.gyro_noise
+        samples[:, 6:9] = mag + self.rng.normal(0, 1, (n, 3)) * self.mag_noise
+
+        if n > 0:
+            self.quat = truth[-1]
+        self.count += n
+        return samples, truth, times
+
+
+# (N, 9) samples to ICM20948 text lines, every value followed by ", "
+def format_ascii(samples : np.ndarray, start_char : str = '&', decimals : int = 4) -> bytes:
+    row = start_char + f"%.{decimals}f, " * 9 + "\r\n"
+    return ((row * len(samples)) % tuple(samples.ravel().tolist())).encode('ascii')
+
+
+"""
+Serial port stand in producing a simulated stream
+
+speed=1 produces samples at the simulated rate in real time, speed=N N times faster and speed=0
+hands out chunk_samples samples per read as fast as the consumer reads them. After duration seconds
+of simulated time (None runs forever) and once everything has been read, reads raise EndOfCapture.
+receive_time is the simulated time of the data read last. With keep_truth, truth() returns the true
+attitude of every sample produced so far, leave it off for long or endless runs as it keeps them all
+"""
+class SimulatedSerial:
+
+    def __init__(self, simulator : ImuSimulator, binary : bool = False, speed : float = 1.0, duration : float = None,
+                chunk_samples : int = 64, timeout : float = None, start_char : str = '&', keep_truth : bool = False) -> None:
+        self.simulator = simulator
+        self.binary = binary
+        self.speed = speed
+        self.chunk_samples = chunk_samples
+        self.timeout = timeout
+        self.start_char = start_char
+        self.keep_truth = keep_truth
+        self.limit = None if duration is None else int(round(duration * simulator.rate))
+        self.port = "simulator"
+        self.is_open = True
+
+        self._pending = bytearray()
+        self._consumed = 0
+        self._produced = 0
+        # End offset and simulated time of every chunk not read completely yet
+        self._chunk_ends = deque()
+        self._chunk_times = deque()
+        self._truth_times = []
+        self._truth = []
+        self._start = None
+        self._seq = 0
+
+    def open(self) -> None:
+        self.is_open = True
+
+    def close(self) -> None:
+        self.is_open = False
+
+    # Simulation clock starts on first access so setup time does not count
+    def _elapsed(self) -> float:
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now
+        return (now - self._start) * self.speed
+
+    def _remaining(self) -> int:
+        return None if self.limit is None else self.limit - self.simulator.count
+
+    def _generate(self, n : int) -> None:
+        remaining = self._remaining()
+        if remaining is not None:
+            n = min(n, remaining)
+        if n <= 0:
+            return
+
+        samples, truth, times = self.simulator.generate(n)
+        if self.binary:
+            data = encode_frames(samples, start_seq=self._seq)
+            self._seq = (self._seq + n) & 0xFFFF
+        else:
+            data = format_ascii(samples, start_char=self.start_char)
+
+        self._pending += data
+        self._produced += len(data)
+        self._chunk_ends.append(self._produced)
+        self._chunk_times.append(times[-1])
+        if self.keep_truth:
+            self._truth_times.append(times)
+            self._truth.append(truth)
+
+    # Produce whatever is due by now
+    def _update(self) -> None:
+        if not self.speed or self.speed <= 0:
+            if len(self._pending) == 0:
+                self._generate(self.chunk_samples)
+            return
+        self._generate(int(self._elapsed() * self.simulator.rate) + 1 - self.simulator.count)
+
+    @property
+    def in_waiting(self) -> int:
+        self._update()
+        return len(self._pending)
+
+    @property
+    def finished(self) -> bool:
+        return self._remaining() == 0 and len(self._pending) == 0
+
+    @property
+    def receive_time(self) -> float:
+        if self._consumed == 0:
+            return None
+        return self._chunk_times[0]
+
+    def truth(self) -> tuple:
+        if len(self._truth) == 0:
+            return np.empty(0), np.empty((0, 4))
+        return np.concatenate(self._truth_times), np.concatenate(self._truth)
+
+    def read(self, size : int = 1) -> bytes:
+        if self.finished:
+            raise EndOfCapture("end of simulation")
+
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        while True:
+            self._update()
+            if len(self._pending) >= size or self._remaining() == 0 or not self.speed or self.speed <= 0:
+                break
+
+            # Sleep until the next sample is due
+            wait = (self.simulator.count / self.simulator.rate - self._elapsed()) / self.speed
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                wait = min(wait, remaining)
+            time.sleep(max(wait, 0.0))
+
+        n = min(size, len(self._pending))
+        data = bytes(self._pending[:n])
+        del self._pending[:n]
+        self._consumed += n
+
+        # Chunks that were read completely are not needed any more
+        while len(self._chunk_ends) > 1 and self._chunk_ends[0] < self._consumed:
+            self._chunk_ends.popleft()
+            self._chunk_times.popleft()
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def read_all(self) -> bytes:
+        return self.read(self.in_waiting) if self.in_waiting > 0 else b''
+
+
+"""
+Parser reading from a simulator, either directly or through a pty. The wire format follows the imu:
+binary frames for ICM20948Binary, text lines with its start character otherwise
+"""
+class SimulationParser(Parser):
+
+    def __init__(self, imu : components.IMU, simulator : ImuSimulator, speed : float = 1.0, duration : float = None,
+                chunk_samples : int = 64, use_pty : bool = False, threaded : bool = False, buffer_size : int = 4096,
+                keep_truth : bool = False) -> None:
+        binary = imu.framing == 'binary'
+        start_char = getattr(imu, 'start_char', '&')
+
+        self.pty = None
+        if use_pty:
+            # Short timeout so the pty writer notices when it is asked to stop
+            self.source = SimulatedSerial(simulator, binary=binary, speed=speed, duration=duration, chunk_samples=chunk_samples,
+                                        timeout=0.1, start_char=start_char, keep_truth=keep_truth)
+            self.pty = PtyBridge(self.source, name="simulator")
+            self.pty.start()
+            super().__init__(dev_name="simulator", imu=imu, port=self.pty.port_name, baud=115200, threaded=threaded,
+                            buffer_size=buffer_size, ready_timeout=0)
+        else:
+            self.source = SimulatedSerial(simulator, binary=binary, speed=speed, duration=duration, chunk_samples=chunk_samples,
+                                        start_char=start_char, keep_truth=keep_truth)
+            super().__init__(dev_name="simulator", imu=imu, port="simulator", baud=0, threaded=threaded,
+                            buffer_size=buffer_size, ser=self.source)
+
+    # Read directly the reader stops on EndOfCapture, through a pty the port just goes quiet
+    @property
+    def finished(self) -> bool:
+        if self.pty is None:
+            return self.reader_error is not None
+        return self.source.finished and self.ser.in_waiting == 0
+
+    def cleanup(self) -> None:
+        super().cleanup()
+        if self.pty is not None:
+            self.pty.stop()
+
+
+if __name__ == '__main__':
+    pass
@@ -1,53 +1,97 @@
 """
 Assist with calibrating magnetometers
+
+Rotate the sensor through every orientation while this runs. An ellipsoid is fitted to the raw
+samples as they come in, coverage and fit residual are printed along the way and the hard and soft
+iron correction is saved as a profile that model_example.py loads with --mag-profile
 """
 
+import argparse
 import time
-import numpy as np
 
-import components.parser as p
+from components.replay import open_source
 import components.ICM20948 as ICM
 import components.lowpass_filter as flt
 from components.scatter_plotter3D import ScatterPlotter3D
+from components.session import SessionWriter, SessionReader
+from components.mag_calibrator import MagCalibrator
+from components.pipeline import Pipeline, SerialReader, Decoder, LowPass
 
 # Model configuration constants
 MODEL_TIMESTEP = 0.01 # 100hz
 MODEL_FREQUENCY = 1/MODEL_TIMESTEP
 MODEL_LOWPASS_CUTOFF = 10 # 10 hz cutoff
 CALIBRATION_TIME = 30
+REPORT_INTERVAL = 0.5 # seconds between coverage reports
 
 if __name__ == '__main__':
 
-    scatter = ScatterPlotter3D(name='Collected data', fps=24, names=['actual', 'corrected'], colors=[[1, 0, 0, 1], [0, 0, 1, 1]])
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--port', default='COM5', help='serial port of the IMU')
+    arg_parser.add_argument('--record', help='save the raw serial stream to this capture file')
+    arg_parser.add_argument('--reset', action='store_true', help='restart the board through DTR before waiting for its first sample')
+    arg_parser.add_argument('--replay', help='run from a capture file instead of a device')
+    arg_parser.add_argument('--speed', type=float, default=1.0, help='replay speed multiplier, 0 for as fast as possible')
+    arg_parser.add_argument('--log', default=time.strftime('mag_session_%Y%m%d_%H%M%S'), help='session directory to store samples in')
+    arg_parser.add_argument('--profile', default='mag_profile.json', help='file to save the calibration profile to')
+    args = arg_parser.parse_args()
+
+    # Long collection runs only need one point per 0.5 uT cube to show coverage, the session keeps every sample
+    scatter = ScatterPlotter3D(name='Collected data', fps=24, names=['actual', 'corrected'], colors=[[1, 0, 0, 1], [0, 0, 1, 1]],
+                                decimation='voxel', voxel_size=0.5)
     test_imu = ICM.ICM20948(start_char='&')
-    parser = p.Parser(dev_name="ICM20948", imu=test_imu, baud=115200, port='COM5')
-    filter = flt.RCFilter(cutoff=MODEL_LOWPASS_CUTOFF, sample_time=MODEL_TIMESTEP)
+    parser = open_source(imu=test_imu, port=args.port, baud=115200, replay=args.replay, speed=args.speed, record=args.record,
+                        reset=args.reset)
 
     print("Starting!!!")
 
-    num_plotted = 0
-    acc_vec = np.array([0, 0, 0])
-    all_items = np.array([[0, 0, 0]])
+    calibrator = MagCalibrator()
+    session = SessionWriter(args.log)
+
+    def collect(batch : dict) -> None:
+        mag = batch['filtered'][:, 6:9]
+        scatter.plot({'actual' : mag})
+        calibrator.update(mag)
+        session.append(**batch)
+
+    pipeline = Pipeline('mag calibration')
+    pipeline.add_source('reader', SerialReader(parser.ser))
+    pipeline.add_stage('decode', Decoder(test_imu, sample_time=MODEL_TIMESTEP))
+    pipeline.add_stage('filter', LowPass(flt.RCFilter(cutoff=MODEL_LOWPASS_CUTOFF, sample_time=MODEL_TIMESTEP)))
+    pipeline.add_stage('collect', collect, rate=MODEL_FREQUENCY)
 
     t_end = time.time() + CALIBRATION_TIME # 30 second calibration, adjust as needed
 
-    while time.time() < t_end:
-        new_data = parser.run()
-        if new_data == None:
-            continue
+    pipeline.start()
+    try:
+        while not pipeline.join(timeout=REPORT_INTERVAL):
+            residual = f"{calibrator.residual:.2%}" if calibrator.residual is not None else "-"
+            print(f"{calibrator.count} samples, coverage {calibrator.coverage:.0%}, residual {residual}")
+            if time.time() >= t_end:
+                pipeline.stop()
+        if args.replay is not None and time.time() < t_end:
+            print("Replay finished")
+    finally:
+        pipeline.stop()
+        pipeline.join()
+        parser.cleanup()
+        session.close()
 
+    for stage, error in pipeline.errors:
+        print(f"stage {stage} failed: {error}")
 
-        filtered_vals = ICM.ICMRawData.create_from_vector(filter.filter(new_data.convert_to_vector()))
-        scatter.plot({'actual' : np.array([[filtered_vals.mag_x, filtered_vals.mag_y, filtered_vals.mag_z]])})
-        acc_vec = acc_vec + np.array([filtered_vals.mag_x, filtered_vals.mag_y, filtered_vals.mag_z])
-        num_plotted+=1
-        all_items = np.concatenate((all_items, np.array([[filtered_vals.mag_x, filtered_vals.mag_y, filtered_vals.mag_z]])), axis=0)
+    if not calibrator.fit():
+        raise SystemExit(f"No ellipsoid fits the {calibrator.count} samples (coverage {calibrator.coverage:.0%}), "
+                        "rotate the sensor through more orientations")
 
-        time.sleep(MODEL_TIMESTEP)
+    calibrator.save(args.profile)
+    print(f"hard iron {calibrator.hard_iron}")
+    print(f"soft iron\n{calibrator.soft_iron}")
+    print(f"field {calibrator.field_strength:.2f} uT, residual {calibrator.residual:.2%}, "
+          f"coverage {calibrator.coverage:.0%}, saved to {args.profile}")
 
     time.sleep(1) # let the 3D plotter queue empty
 
-    normalized_items = all_items - (acc_vec/num_plotted)
-    scatter.plot({'corrected' : normalized_items})
-    print(acc_vec/num_plotted)
+    # Read the session back without loading it all into memory
+    scatter.plot({'corrected' : calibrator.apply(SessionReader(args.log)['filtered'][:, 6:9])})
 
@@ -2,52 +2,89 @@
 Implement attitude estimation model for ICM20948
 """
 
-import time
+import argparse
 
-import components.parser as p
+from components.replay import open_source
 import components.ICM20948 as ICM
-import components.plotter2D as plt2D
 import components.lowpass_filter as flt
 from components.complementary_filter import ComplementaryFilter
-from components.plotter3D import Plotter3D
+from components.dashboard import Dashboard
+from components.session import SessionWriter
+from components.pipeline import Pipeline, SerialReader, Decoder, LowPass, Estimate, COALESCE
 
 # Model configuration constants
-MODEL_TIMESTEP = 0.005 # Note, we don't actually run this fast because of how slow Python is :(
+MODEL_TIMESTEP = 0.005 # 200 hz estimation, overruns show up in the pipeline report
 MODEL_FREQUENCY = 1/MODEL_TIMESTEP
 MODEL_LOWPASS_CUTOFF = 5 # 5 hz cutoff
+REPORT_INTERVAL = 2 # seconds between pipeline reports with --stats
 
 if __name__ == '__main__':
 
-    #plotter_ac = plt2D.Plotter2D(name='acceleration data', ylabel='acceleration (mg)', xlabel='time (s)',
-    #                            lines=['acc_z', 'acc_z_flt'], line_colors=['r', 'g'], fps=24)
-    #plotter_gy = plt2D.Plotter2D(name='gyro data', ylabel='rotation (dps)', xlabel='time (s)',
-    #                            lines=['gyr_x_flt', 'gyr_y_flt', 'gyr_z_flt'], line_colors=['r', 'g', 'b'], fps=24)
-    #plotter_ma = plt2D.Plotter2D(name='magnetometer data', ylabel='field (uT)', xlabel='time (s)',
-    #                            lines=['mag_x_flt', 'mag_y_flt','mag_z_flt'], line_colors=['r', 'g', 'b'], fps=24)
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--port', default='COM5', help='serial port of the IMU')
+    arg_parser.add_argument('--record', help='save the raw serial stream to this capture file')
+    arg_parser.add_argument('--reset', action='store_true', help='restart the board through DTR before waiting for its first sample')
+    arg_parser.add_argument('--replay', help='run from a capture file instead of a device')
+    arg_parser.add_argument('--speed', type=float, default=1.0, help='replay speed multiplier, 0 for as fast as possible')
+    arg_parser.add_argument('--log', help='session directory to store samples and attitude estimates in')
+    arg_parser.add_argument('--stats', action='store_true', help='print pipeline throughput, queue depth and latency while running')
+    arg_parser.add_argument('--mag-profile', help='magnetometer calibration profile saved by mag_calibration.py')
+    args = arg_parser.parse_args()
 
-    visualizer = Plotter3D('Rotational state', 24)
-    test_imu = ICM.ICM20948(start_char='&')
-    parser = p.Parser(dev_name="ICM20948", imu=test_imu, port='COM5', baud=115200)
-    filter = flt.RCFilter(cutoff=MODEL_LOWPASS_CUTOFF, sample_time=MODEL_TIMESTEP)
-    estimator = ComplementaryFilter(alpha=0.5, time_step=MODEL_TIMESTEP)
-
-    while True:
-        new_data = parser.run()
-        if new_data == None:
-            continue
+    if args.mag_profile is not None:
+        ICM.load_mag_profile(args.mag_profile)
 
+    # Every panel is drawn by the same render process
+    dashboard = Dashboard('IMU model', fps=24, columns=2)
+    #plotter_ac = dashboard.add_plot2d(name='acceleration data', ylabel='acceleration (mg)', xlabel='time (s)',
+    #                            lines=['acc_z', 'acc_z_flt'], line_colors=['r', 'g'], sample_rate=MODEL_FREQUENCY)
+    #plotter_gy = dashboard.add_plot2d(name='gyro data', ylabel='rotation (dps)', xlabel='time (s)',
+    #                            lines=['gyr_x_flt', 'gyr_y_flt', 'gyr_z_flt'], line_colors=['r', 'g', 'b'], sample_rate=MODEL_FREQUENCY)
+    #plotter_ma = dashboard.add_plot2d(name='magnetometer data', ylabel='field (uT)', xlabel='time (s)',
+    #                            lines=['mag_x_flt', 'mag_y_flt','mag_z_flt'], line_colors=['r', 'g', 'b'], sample_rate=MODEL_FREQUENCY)
+    visualizer = dashboard.add_plot3d('Rotational state')
+    dashboard.start()
 
-        filtered_vals = ICM.ICMRawData.create_from_vector(filter.filter(new_data.convert_to_vector()))
-        #plotter_ac.plot({'acc_z' : new_data.ac_z, 'acc_z_flt' : filtered_vals.ac_z})
-        #plotter_gy.plot({'gyr_x_flt' : filtered_vals.gyr_x, 'gyr_y_flt' : filtered_vals.gyr_y, 'gyr_z_flt' : filtered_vals.gyr_z})
-        #plotter_ma.plot({'mag_x_flt' : filtered_vals.mag_x, 'mag_y_flt' : filtered_vals.mag_y, 'mag_z_flt' : filtered_vals.mag_z})
-        #
+    test_imu = ICM.ICM20948(start_char='&')
+    parser = open_source(imu=test_imu, port=args.port, baud=115200, replay=args.replay, speed=args.speed, record=args.record,
+                        reset=args.reset)
+    session = SessionWriter(args.log) if args.log is not None else None
 
-        estimate_matrix = estimator.estimate(accel_data=filtered_vals.get_raw_accel(),
-                                            mag_data=filtered_vals.get_adjusted_mag(),
-                                            gyro_data=filtered_vals.get_raw_gyro())
-        visualizer.plot(estimate_matrix)
+    # Every batch is plotted and stored, the display only needs the newest so its queue coalesces
+    def output(batch : dict) -> None:
+        #plotter_ac.plot({'acc_z' : batch['raw'][:, 2], 'acc_z_flt' : batch['filtered'][:, 2]})
+        #plotter_gy.plot({'gyr_x_flt' : batch['filtered'][:, 3], 'gyr_y_flt' : batch['filtered'][:, 4], 'gyr_z_flt' : batch['filtered'][:, 5]})
+        #plotter_ma.plot({'mag_x_flt' : batch['filtered'][:, 6], 'mag_y_flt' : batch['filtered'][:, 7], 'mag_z_flt' : batch['filtered'][:, 8]})
+        visualizer.plot(batch['quaternion'][-1])
+        if session is not None:
+            session.append(**batch)
 
-        time.sleep(MODEL_TIMESTEP)
+    # Estimation runs on a fixed 200 hz schedule on everything that arrived since the last tick,
+    # using the receive times of the samples
+    pipeline = Pipeline('IMU model')
+    pipeline.add_source('reader', SerialReader(parser.ser))
+    pipeline.add_stage('decode', Decoder(test_imu, sample_time=MODEL_TIMESTEP))
+    pipeline.add_stage('filter', LowPass(flt.RCFilter(cutoff=MODEL_LOWPASS_CUTOFF, sample_time=MODEL_TIMESTEP)))
+    pipeline.add_stage('estimate', Estimate(ComplementaryFilter(alpha=0.5, time_step=MODEL_TIMESTEP), adjust_mag=ICM.adjust_mag),
+                        rate=MODEL_FREQUENCY)
+    pipeline.add_stage('output', output, policy=COALESCE)
 
+    pipeline.start()
+    try:
+        while not pipeline.join(timeout=REPORT_INTERVAL):
+            if args.stats:
+                print(pipeline.report())
+        if args.replay is not None:
+            print("Replay finished")
+    except KeyboardInterrupt:
+        pipeline.stop()
+        pipeline.join()
+    finally:
+        parser.cleanup()
+        dashboard.close()
+        if session is not None:
+            session.close()
 
+    for stage, error in pipeline.errors:
+        print(f"stage {stage} failed: {error}")
+    print(pipeline.report())
@@ -0,0 +1,82 @@
+"""
+Acquire from several ICM20948 boards at once
+
+Every port is read concurrently, decoding, filtering and estimation are spread over worker processes
+and the samples of all boards come back as one stream ordered by host receive time. Prints the
+sample rate of every board while running and can store the merged stream as a session with a device
+column. --simulate N runs N simulated boards instead of real ports
+"""
+
+import argparse
+import time
+
+import components.ICM20948 as ICM
+from components.multi_device import MultiDeviceManager, ProcessingChain
+from components.session import SessionWriter, DEFAULT_COLUMNS
+
+SAMPLE_TIME = 0.005
+LOWPASS_CUTOFF = 5 # 5 hz cutoff
+REPORT_INTERVAL = 2 # seconds between rate reports
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('ports', nargs='*', help='serial ports of the IMUs')
+    arg_parser.add_argument('--baud', type=int, default=115200)
+    arg_parser.add_argument('--workers', type=int, help='worker processes, one per core by default')
+    arg_parser.add_argument('--simulate', type=int, default=0, help='number of simulated boards to add')
+    arg_parser.add_argument('--duration', type=float, help='stop after this many seconds')
+    arg_parser.add_argument('--log', help='session directory to store the merged stream in')
+    arg_parser.add_argument('--mag-profile', help='magnetometer calibration profile saved by mag_calibration.py')
+    args = arg_parser.parse_args()
+
+    if args.mag_profile is not None:
+        ICM.load_mag_profile(args.mag_profile)
+
+    devices = {port : port for port in args.ports}
+    if args.simulate > 0:
+        from components.simulator import ImuSimulator, SimulatedSerial, Tumble
+        for i in range(args.simulate):
+            simulator = ImuSimulator(Tumble(seed=i), rate=1/SAMPLE_TIME, hard_iron=ICM.MAG_SOFT_IRON_ADJUSTMENT, seed=i)
+            devices[f"sim{i}"] = SimulatedSerial(simulator, speed=1, duration=args.duration)
+    if len(devices) == 0:
+        arg_parser.error("give at least one port or --simulate")
+
+    chain = ProcessingChain(ICM.ICM20948(start_char='&'), cutoff=LOWPASS_CUTOFF, sample_time=SAMPLE_TIME, dt=SAMPLE_TIME,
+                            hard_iron=ICM.MAG_SOFT_IRON_ADJUSTMENT, soft_iron=ICM.MAG_SOFT_IRON_MATRIX)
+    manager = MultiDeviceManager(devices, chain, baud=args.baud, workers=args.workers)
+
+    session = None
+    if args.log is not None:
+        session = SessionWriter(args.log, columns=dict(DEFAULT_COLUMNS, device=('<i8', ())))
+
+    print(f"{len(devices)} devices on {manager.workers} workers")
+    manager.start()
+    start = time.perf_counter()
+    next_report = start + REPORT_INTERVAL
+    last_samples = manager.samples.copy()
+    try:
+        while not manager.done:
+            batch = manager.read(timeout=0.1)
+            if batch is not None and session is not None:
+                session.append(**batch)
+
+            now = time.perf_counter()
+            if now >= next_report:
+                rates = (manager.samples - last_samples) / (now - next_report + REPORT_INTERVAL)
+                last_samples = manager.samples.copy()
+                next_report = now + REPORT_INTERVAL
+                print(', '.join(f"{device_id} {rate:.0f}/s" for device_id, rate in zip(manager.device_ids, rates)))
+
+            if args.duration is not None and now - start >= args.duration:
+                manager.stop()
+    except KeyboardInterrupt:
+        manager.stop()
+    finally:
+        manager.cleanup()
+        if session is not None:
+            session.close()
+
+    for device_id, stats in manager.stats().items():
+        error = f", {stats['error']}" if stats['error'] is not None else ""
+        print(f"{device_id}: {stats['samples']} samples, {stats['bytes']} bytes on worker {stats['worker']}{error}")
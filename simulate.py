@@ -0,0 +1,103 @@
+"""
+Run the Parser -> RCFilter -> ComplementaryFilter pipeline on a simulated ICM20948
+
+Reports the sustained sample rate of the pipeline and the attitude error against the simulated
+ground truth. With --speed 0 the simulator produces data as fast as the pipeline takes it, so the
+sample rate printed is the maximum the pipeline can sustain
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import components.ICM20948 as ICM
+import components.lowpass_filter as flt
+from components.complementary_filter import ComplementaryFilter
+from components.simulator import ImuSimulator, SimulationParser, Static, ConstantRate, Oscillation, Tumble
+
+TRAJECTORIES = {
+    'static' : lambda: Static(),
+    'rate' : lambda: ConstantRate([20, -10, 30]),
+    'oscillation' : lambda: Oscillation(amplitude=90, frequency=[0.5, 0.3, 0.2]),
+    'tumble' : lambda: Tumble(max_rate=60, seed=0),
+}
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--rate', type=float, default=1000, help='simulated sample rate (Hz)')
+    arg_parser.add_argument('--duration', type=float, default=10, help='simulated time (s)')
+    arg_parser.add_argument('--speed', type=float, default=0, help='simulation speed multiplier, 0 for as fast as possible')
+    arg_parser.add_argument('--trajectory', choices=TRAJECTORIES.keys(), default='tumble')
+    arg_parser.add_argument('--binary', action='store_true', help='stream binary frames instead of text lines')
+    arg_parser.add_argument('--pty', action='store_true', help='go through a pseudo terminal and pyserial')
+    arg_parser.add_argument('--per-sample', action='store_true', help='filter and estimate one sample at a time')
+    arg_parser.add_argument('--cutoff', type=float, default=5, help='low pass cutoff (Hz)')
+    arg_parser.add_argument('--alpha', type=float, default=0.5, help='complementary filter alpha')
+    arg_parser.add_argument('--noise', action='store_true', help='add sensor noise, bias and vibration')
+    args = arg_parser.parse_args()
+
+    sensor_errors = dict()
+    if args.noise:
+        sensor_errors = dict(accel_noise=5, gyro_noise=0.05, mag_noise=0.3, gyro_bias=[0.2, -0.1, 0.05],
+                            vibration_amplitude=20, vibration_frequency=80)
+
+    sample_time = 1/args.rate
+
+    # Load the chunked filter's dependencies before the simulation clock starts
+    flt.RCFilter(cutoff=args.cutoff, sample_time=sample_time).filter_chunk(np.zeros((1, 9)))
+
+    # Same hard iron offset the pipeline removes with get_adjusted_mag
+    simulator = ImuSimulator(TRAJECTORIES[args.trajectory](), rate=args.rate, initial=[0.9, 0.1, -0.3, 0.2],
+                            hard_iron=ICM.MAG_SOFT_IRON_ADJUSTMENT, seed=0, **sensor_errors)
+    imu = ICM.ICM20948Binary() if args.binary else ICM.ICM20948(start_char='&')
+    parser = SimulationParser(imu=imu, simulator=simulator, speed=args.speed, duration=args.duration, use_pty=args.pty,
+                            threaded=True, buffer_size=1 << 16, keep_truth=True)
+
+    filter = flt.RCFilter(cutoff=args.cutoff, sample_time=sample_time)
+    estimator = ComplementaryFilter(alpha=args.alpha, time_step=sample_time)
+
+    estimates = []
+    start = time.perf_counter()
+    try:
+        while True:
+            finished = parser.finished
+            samples = parser.drain()
+            if len(samples) == 0:
+                if finished:
+                    # Give the reader one read timeout to hand over what it was still decoding
+                    time.sleep(0.1)
+                    samples = parser.drain()
+                    if len(samples) == 0:
+                        break
+                else:
+                    time.sleep(0.001)
+                    continue
+
+            if args.per_sample:
+                for sample in samples:
+                    filtered_vals = ICM.ICMRawData.create_from_vector(filter.filter(sample))
+                    estimator.estimate(accel_data=filtered_vals.get_raw_accel(), mag_data=filtered_vals.get_adjusted_mag(),
+                                        gyro_data=filtered_vals.get_raw_gyro(), dt=sample_time)
+                    estimates.append(estimator.last_estimate)
+            else:
+                filtered = filter.filter_chunk(samples)
+                estimates.append(estimator.estimate_batch(accel_data=filtered[:, 0:3],
+                                                        mag_data=ICM.adjust_mag(filtered[:, 6:9]),
+                                                        gyro_data=filtered[:, 3:6], dt=sample_time))
+    finally:
+        elapsed = time.perf_counter() - start
+        parser.cleanup()
+
+    estimates = np.vstack(estimates) if len(estimates) > 0 else np.empty((0, 4))
+    _, truth = parser.source.truth()
+    print(f"{len(estimates)} samples in {elapsed:.2f} s -> {len(estimates)/elapsed:.0f} samples/s")
+    print(f"buffer overflows {parser.overflow_count}, rejected lines {parser.rejected_lines}")
+
+    # Samples line up with the truth one to one unless some were lost on the way
+    if len(estimates) == len(truth) and len(truth) > 0:
+        error = np.degrees(2 * np.arccos(np.clip(np.abs(np.sum(estimates * truth, axis=1)), 0, 1)))
+        print(f"attitude error (deg): mean {error.mean():.3f} rms {np.sqrt(np.mean(error**2)):.3f} max {error.max():.3f}")
+    else:
+        print(f"received {len(estimates)} of {len(truth)} samples, skipping accuracy check")